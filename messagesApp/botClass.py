@@ -1,181 +1,852 @@
+import asyncio
+import calendar
+import threading
 import time
 import json
-import os
-from dotenv import load_dotenv
-from .models import Conversation, CustomUser, Product, AuxProdUser, Transaction
+import random
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from .models import Conversation, Product, AuxProdUser, Transaction, DailySales
+from . import clients, metrics, threads
+from .jobs import retryable
+from .throttle import Overloaded, async_openai_limiter, openai_limiter
+from .matching import SaleItem, inventory_index, match_items
+from .normalization import name_unit_key, normalize_text
+from .search import bump_catalog_generation, find_canonical_products
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
-from datetime import timedelta
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import Case, DateField, F, FloatField, Q, Sum, Value, When
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+from asgiref.sync import sync_to_async
+from datetime import datetime, timedelta
 import logging
-from openai import OpenAI
-import re 
-from rapidfuzz import process, fuzz
-import unicodedata
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-api_key = os.getenv('OPENAI_API_KEY')
 
-client = OpenAI()
+ASSISTANT_ID = "asst_7gpT6VNSseo58Bh8nOwhqCCP"
+
+
+# TIEMPOS DE ESPERA ENTRE CONSULTAS AL RUN: EMPIEZAN EN DECENAS DE MILISEGUNDOS Y CRECEN
+# EXPONENCIALMENTE CON JITTER HASTA BOT_POLL_MAX_DELAY. SE REINICIAN CUANDO CAMBIA EL ESTADO.
+def backoff_delays():
+    delay = settings.BOT_POLL_INITIAL_DELAY
+    while True:
+        yield random.uniform(delay / 2, delay)
+        delay = min(delay * 2, settings.BOT_POLL_MAX_DELAY)
+
+
+# ESTADOS EN LOS QUE UN RUN YA NO VA A COMPLETARSE
+TERMINAL_STATUSES = ('failed', 'cancelled', 'expired', 'incomplete')
+# ESTADOS DE UN RUN QUE TODAVÍA OCUPA EL THREAD (UN THREAD SOLO ADMITE UN RUN ACTIVO)
+ACTIVE_STATUSES = ('queued', 'in_progress', 'requires_action', 'cancelling')
+TERMINAL_EVENTS = tuple(f"thread.run.{status}" for status in TERMINAL_STATUSES)
+
+
+class RunDeadlineExceeded(Exception):
+    pass
+
+
+class RunFailed(Exception):
+    def __init__(self, status):
+        super().__init__(f"Run ended with status {status}")
+        self.status = status
+
+
+def thread_cache_key(user):
+    return f"thread_id:{user.phone}"
+
+
+# SI UNA HERRAMIENTA YA REGISTRÓ ALGO, PEDIR QUE LO INTENTE DE NUEVO DUPLICARÍA LA VENTA
+def interrupted_reply(tools_ran, reply):
+    return settings.BOT_TOOLS_DONE_REPLY if tools_ran else reply
+
+
+def message_text(message):
+    return message.content[0].text.value
+
+
+# TOKENS DE ENTRADA DE UN RUN TERMINADO (EL TAMAÑO DEL CONTEXTO QUE LEYÓ EL MODELO)
+def prompt_tokens(run):
+    usage = getattr(run, 'usage', None)
+    if usage is None:
+        return None
+    metrics.incr('bot.prompt_tokens', usage.prompt_tokens)
+    metrics.incr('bot.completion_tokens', usage.completion_tokens)
+    return usage.prompt_tokens
+
+
+# TIEMPO ACUMULADO POR ETAPA DE UN MENSAJE: thread, message, tools, reply Y run (EL RESTO,
+# ES DECIR, EL TIEMPO ESPERANDO AL MODELO). SE REPORTAN EN metrics COMO bot.<etapa>.
+class RunTimings:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.stages = defaultdict(float)
+
+    @contextmanager
+    def stage(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.monotonic() - started
+
+    def finish(self, user):
+        total = time.monotonic() - self.started
+        self.stages['run'] = max(0.0, total - sum(v for k, v in self.stages.items() if k != 'run'))
+        self.stages['total'] = total
+        for name, seconds in self.stages.items():
+            metrics.observe(f"bot.{name}", seconds)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(
+                "Bot latency for %s: %s", user, ", ".join(f"{k}={v * 1000:.0f}ms" for k, v in self.stages.items())
+            )
 
 # LA CLASE PREDETERMINADA BOT TIENE EL FIN DE SIMPLIFICAR LA CREACIÓN DE UN ASISTENTE Y EL MANEJO DE SU THREAD.
 # UN ASISTENTE ES UNA INSTANCIA DE UNA CONVERSACIÓN DE CHATGPT. UN THREAD ES LA MEMORIA DE UN ASISTENTE.
 class Bot: 
-    def __init__(self, user):
-        self.client = client
+    def __init__(self, user, on_progress=None):
+        self.client = clients.openai()
 
         self.user = user
+        # on_progress(**campos) guarda el avance en el job (thread_id, run_id, tools_ran; ver jobs.py)
+        self.on_progress = on_progress
+
+        self.timings = RunTimings()
+
+        # CADA MENSAJE TIENE UN PRESUPUESTO DE TIEMPO PARA POLLING Y HERRAMIENTAS
+        self.deadline = self.timings.started + settings.BOT_RUN_DEADLINE_SECONDS
+        self.run_id = None
+        self.prompt_tokens = None
+        self.rotation_due = False
+        # Si ya corrió alguna herramienta, el mensaje no se puede reintentar (ver jobs.process_jobs)
+        self.tools_ran = False
 
         # EL ASISTENTE SE CREARÁ CON UN THREAD ESPECÍFICO CON EL ID CORRESPONDIENTE AL NÚMERO DEL USUARIO. 
-        self.thread = self.create_or_retrieve_thread()
+        with self.timings.stage('thread'):
+            self.thread_id = self.create_or_retrieve_thread()
 
-        self.assistant_id = "asst_7gpT6VNSseo58Bh8nOwhqCCP"
+        self.assistant_id = ASSISTANT_ID
 
     # ESTE MÉTODO EJECUTA UNA CONVERSACIÓN CON EL ASISTENTE.
     # SI ES LA PRIMERA VEZ QUE SE EJECUTA, SE ENVIARÁ EL PRIMER MENSAJE.
-    def run(self, user_message):        
-        # SE ENVÍA EL MENSAJE DEL USUARIO Y SE ESPERA A QUE EL ASISTENTE RESPONDA
-        self.client.beta.threads.messages.create(
-            thread_id=self.thread.id,
-            role="user",
-            content=user_message,
+    # EN UN REINTENTO, user_message SOLO TRAE LO QUE AÚN NO LLEGÓ AL THREAD Y previous_run_id
+    # ES EL RUN DEL INTENTO ANTERIOR (ver resume_run).
+    def run(self, user_message, previous_run_id=None):
+        try:
+            # CUPO LIMITADO DE CONVERSACIONES SIMULTÁNEAS CON OPENAI, EN TOTAL Y POR USUARIO.
+            # SI LA ESPERA SERÍA DEMASIADO LARGA SE RESPONDE DE INMEDIATO QUE ESTAMOS OCUPADOS.
+            with openai_limiter.slot(self.user.phone):
+                last_message = self.converse(user_message, previous_run_id)
+        except Overloaded:
+            logger.warning("Too many concurrent runs, shedding message from %s", self.user)
+            metrics.incr('bot.shed')
+            last_message = settings.BOT_BUSY_REPLY
+
+        self.timings.finish(self.user)
+        return last_message
+
+    def converse(self, user_message, previous_run_id=None):
+        # openai ya está cargado (self.client); importarlo al inicio del módulo lo cargaría en el webhook
+        from openai import APITimeoutError
+
+        try:
+            last_message = None
+            if previous_run_id:
+                last_message = self.resume_run(previous_run_id, reuse_reply=not user_message)
+
+            if last_message is None:
+                # SE ENVÍA EL MENSAJE DEL USUARIO Y SE ESPERA A QUE EL ASISTENTE RESPONDA
+                if user_message:
+                    with self.timings.stage('message'):
+                        self.send_user_message(user_message)
+                    self.record_progress(thread_id=self.thread_id)
+                self.check_deadline()
+
+                # SI EL SDK SOPORTA STREAMING SE USAN LOS EVENTOS DEL RUN; SI NO, SE HACE POLLING
+                if settings.BOT_RUN_STREAMING and hasattr(self.client.beta.threads.runs, 'stream'):
+                    last_message = self.run_streaming()
+                else:
+                    last_message = self.run_polling()
+
+            # EL THREAD SE ROTA DESPUÉS DE ENVIAR LA RESPUESTA (ver rotate_if_due)
+            due = threads.record_run(self.user, self.thread_id, self.prompt_tokens)
+            if due is None:
+                self.reload_thread()
+            self.rotation_due = bool(due)
+
+        # SI SE ACABA EL TIEMPO SE CANCELA EL RUN Y SE RESPONDE DE INMEDIATO AL USUARIO
+        except (RunDeadlineExceeded, APITimeoutError):
+            logger.warning("Run %s for %s exceeded its deadline", self.run_id, self.user)
+            metrics.incr('bot.run_timeout')
+            self.cancel_run()
+            last_message = interrupted_reply(self.tools_ran, settings.BOT_TIMEOUT_REPLY)
+
+        except RunFailed as e:
+            logger.error("Run %s for %s ended with status %s", self.run_id, self.user, e.status)
+            metrics.incr('bot.run_failed')
+            metrics.incr(f"bot.run_failed.{e.status}")
+            last_message = interrupted_reply(self.tools_ran, settings.BOT_FAILURE_REPLY)
+
+        return last_message
+
+    def send_user_message(self, user_message):
+        from openai import NotFoundError
+
+        try:
+            self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=user_message,
+            )
+        except NotFoundError:
+            # EL THREAD EN CACHÉ YA NO EXISTE EN OPENAI: SE CREA UNO NUEVO Y SE REINTENTA
+            logger.warning("Thread %s for %s no longer exists, creating a new one", self.thread_id, self.user)
+            self.thread_id = self.replace_thread()
+            self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=user_message,
+            )
+
+    def record_progress(self, **fields):
+        if self.on_progress is not None:
+            self.on_progress(**fields)
+
+    # REINTENTO DE UN MENSAJE QUE YA TENÍA RUN: SI ESE RUN TERMINÓ BIEN Y NO HAY MENSAJES NUEVOS
+    # SE USA SU RESPUESTA. SI SIGUE ACTIVO SE CANCELA Y SE ESPERA A QUE SUELTE EL THREAD, PARA
+    # QUE NO QUEDEN DOS RUNS ATENDIENDO EL MISMO MENSAJE. DEVUELVE None SI HAY QUE CREAR OTRO RUN.
+    def resume_run(self, run_id, reuse_reply):
+        from openai import NotFoundError
+
+        try:
+            run = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run_id)
+        except NotFoundError:
+            return None
+
+        if run.status == 'completed' and reuse_reply:
+            self.run_id = run.id
+            self.prompt_tokens = prompt_tokens(run)
+            return self.fetch_reply(run.id)
+
+        if run.status in ACTIVE_STATUSES:
+            logger.info("Cancelling run %s of a previous attempt for %s", run.id, self.user)
+            self.run_id = run.id
+            self.cancel_run()
+            delays = backoff_delays()
+            while run.status in ACTIVE_STATUSES:
+                self.check_deadline()
+                time.sleep(min(next(delays), max(0, self.remaining())))
+                run = self.client.beta.threads.runs.retrieve(thread_id=self.thread_id, run_id=run.id)
+            self.run_id = None
+        return None
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def check_deadline(self):
+        if self.remaining() <= 0:
+            raise RunDeadlineExceeded()
+
+    def cancel_run(self):
+        if not self.run_id:
+            return
+        try:
+            self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=self.run_id)
+        except Exception as e:
+            logger.error("Error cancelling run %s: %s", self.run_id, str(e))
+
+    # SI EL THREAD LLEGÓ A SU LÍMITE, SE RESUME Y SE REEMPLAZA POR UNO NUEVO SEMBRADO CON EL
+    # RESUMEN. SE LLAMA DESPUÉS DE ENVIAR LA RESPUESTA PARA QUE EL USUARIO NO LO ESPERE.
+    def rotate_if_due(self):
+        if not self.rotation_due:
+            return
+        self.rotation_due = False
+        started = time.monotonic()
+        try:
+            messages = self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                order='desc',
+                limit=settings.BOT_THREAD_SUMMARY_MESSAGES,
+            )
+            history = threads.history_from_messages(reversed(messages.data))
+            summary, facts = threads.prepare_rotation(self.user, history)
+            thread_id = self.client.beta.threads.create(messages=[threads.seed_message(summary, facts)]).id
+            if threads.save_rotation(self.user, self.thread_id, thread_id, summary, facts):
+                caches['threads'].set(thread_cache_key(self.user), thread_id)
+                self.thread_id = thread_id
+                metrics.incr('bot.thread_rotated')
+            else:
+                self.reload_thread()
+        except Exception as e:
+            logger.error("Error rotating thread %s for %s: %s", self.thread_id, self.user, e)
+        metrics.observe('bot.rotate', time.monotonic() - started)
+
+    def run_streaming(self):
+        last_message = None
+        stream_manager = self.client.beta.threads.runs.stream(
+            thread_id=self.thread_id,
+            assistant_id=self.assistant_id,
+            timeout=self.remaining(),
         )
 
+        # CADA VEZ QUE EL ASISTENTE PIDE HERRAMIENTAS, EL STREAM TERMINA Y SE CONTINÚA CON
+        # EL STREAM QUE DEVUELVE submit_tool_outputs_stream
+        while stream_manager is not None:
+            with stream_manager as stream:
+                stream_manager = None
+                for event in stream:
+                    if event.event == 'thread.run.created':
+                        self.run_id = event.data.id
+                        self.record_progress(run_id=self.run_id)
+                    elif event.event == 'thread.run.completed':
+                        self.prompt_tokens = prompt_tokens(event.data)
+                    elif event.event in TERMINAL_EVENTS:
+                        raise RunFailed(event.data.status)
+                    elif event.event == 'thread.message.completed':
+                        last_message = message_text(event.data)
+                    elif event.event == 'thread.run.requires_action':
+                        run = event.data
+                        self.run_id = run.id
+                        tool_outputs = self.execute_tool_calls(run)
+                        stream_manager = self.client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=self.thread_id,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs,
+                            timeout=self.remaining(),
+                        )
+                        break
+                    self.check_deadline()
+
+        return last_message
+
+    def run_polling(self):
         # INICIAMOS EL RUN DEL ASISTENTE
         run = self.client.beta.threads.runs.create(
-           thread_id=self.thread.id,
+           thread_id=self.thread_id,
            assistant_id=self.assistant_id,
         )
 
+        self.run_id = run.id
+        self.record_progress(run_id=run.id)
+
         # MANEJAMOS LAS ACCIONES REQUERIDAS POR EL ASISTENTE
+        delays = backoff_delays()
         while run.status != 'completed':
-            print(run.status)
+            logger.debug("Run %s status: %s", run.id, run.status)
+            if run.status in TERMINAL_STATUSES:
+                raise RunFailed(run.status)
+            self.check_deadline()
+
             if run.status == 'requires_action':
                 run = self.handle_requires_action(run)
+                delays = backoff_delays()
             else:
-                time.sleep(1)
+                time.sleep(min(next(delays), max(0, self.remaining())))
+                previous_status = run.status
                 run = self.client.beta.threads.runs.retrieve(
-                    thread_id=self.thread.id,
+                    thread_id=self.thread_id,
                     run_id=run.id,
                 )
-        
-        # UNA VEZ QUE EL ASISTENTE HA RESPONDIDO, SE DEVUELVE EL ÚLTIMO MENSAJE
-        messages = self.client.beta.threads.messages.list(thread_id=self.thread.id)
-        last_message = messages.data[0].content[0].text.value
-
-        return last_message
+                if run.status != previous_status:
+                    delays = backoff_delays()
+        self.prompt_tokens = prompt_tokens(run)
+        return self.fetch_reply(run.id)
+
+    # UNA VEZ QUE EL ASISTENTE HA RESPONDIDO, SE DEVUELVE SOLO EL MENSAJE DE ESTE RUN
+    def fetch_reply(self, run_id):
+        with self.timings.stage('reply'):
+            messages = self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                run_id=run_id,
+                order='desc',
+                limit=1,
+            )
+        return message_text(messages.data[0])
 
     def handle_requires_action(self, run):
         required_action = run.required_action
         if required_action.type == 'submit_tool_outputs':
-            tool_calls = required_action.submit_tool_outputs.tool_calls
-            tool_outputs = []
-            for tool_call in tool_calls:
-                function_name = tool_call.function.name
-                arguments = tool_call.function.arguments
-                tool_call_id = tool_call.id
-
-                # Parse arguments safely
-                args = json.loads(arguments)
-
-                # Initialize output
-                output = ""
-
-                # Execute the corresponding function
-                if function_name == "mandar_productos_inventario":
-                    # Get user phone from arguments
-                    products = args['products']
-                    
-                    # Process the batch and get output
-                    output = process_product_batch({"products": products}, self.user)
-
-                elif function_name == "vender_producto":
-                    # Get arguments for selling product
-                    products = args['products']
-                    selling_price = args['selling_price']
-
-                    # Sell the product and get output
-                    output = sell_product({"productos": products, "precio_venta": selling_price}, self.user)
-
-                elif function_name == "generar_reporte_ventas":
-                    # Get timeframe and units from arguments
-                    timeframe = args['timeframe']
-                    units = args['units']
-
-                    # Generate the sales report
-                    output = generate_sales_report(self.user, timeframe, units) 
-
-                # Add the tool output
-                tool_outputs.append({
-                    "tool_call_id": tool_call_id,
-                    "output": output
-                })
-
-            # Submit the tool outputs to the assistant
-            self.client.beta.threads.runs.submit_tool_outputs(
-                thread_id=self.thread.id,
+            tool_outputs = self.execute_tool_calls(run)
+
+            # Submit the tool outputs to the assistant; the response already carries the new status
+            run = self.client.beta.threads.runs.submit_tool_outputs(
+                thread_id=self.thread_id,
                 run_id=run.id,
                 tool_outputs=tool_outputs
             )
-
-        # Update the run status
-        time.sleep(1)
-        run = self.client.beta.threads.runs.retrieve(
-            thread_id=self.thread.id,
-            run_id=run.id,
-        )
         return run
 
-
-    # SI YA EXISTÍA UNA CONVERSACIÓN PREVIA CON ESTE NÚMERO, SE DEVUELVE EL THREAD.
-    # SI NO, SE CREA UN NUEVO THREAD.
+    def execute_tool_calls(self, run):
+        # El plazo se revisa antes del lote y no después: lo que ya se registró se le entrega al
+        # asistente, y si luego se acaba el tiempo el usuario recibe BOT_TOOLS_DONE_REPLY
+        self.check_deadline()
+        if not self.tools_ran:
+            # Se guarda antes de ejecutarlas: si el worker muere a media venta, no se reintenta
+            self.record_progress(tools_ran=True)
+            self.tools_ran = True
+        with self.timings.stage('tools'):
+            return dispatch_tool_calls(run.required_action.submit_tool_outputs.tool_calls, self.user)
+
+
+    # SI YA EXISTÍA UNA CONVERSACIÓN PREVIA CON ESTE NÚMERO, SE DEVUELVE EL ID DE SU THREAD.
+    # SI NO, SE CREA UN NUEVO THREAD. EL ID SE GUARDA EN EL CACHE 'threads' PARA NO CONSULTAR
+    # LA BASE DE DATOS NI A OPENAI EN CADA MENSAJE.
     def create_or_retrieve_thread(self):
+        cache_key = thread_cache_key(self.user)
+        thread_id = caches['threads'].get(cache_key)
+        if thread_id:
+            return thread_id
+
         try:
             # Try to retrieve the existing conversation for the user
             conversation = Conversation.objects.filter(user_conversation=self.user).first()
 
-            if conversation:
-                logger.debug(f"Conversation found for user {self.user.phone}. Thread ID: {conversation.thread_id}")
-            else:
-                logger.debug(f"No conversation found for user {self.user.phone}")
-
             if conversation and conversation.thread_id:
-                # If a conversation exists, retrieve the thread using its thread_id
-                logger.debug(f"Retrieving thread with ID: {conversation.thread_id}")
-                thread = self.client.beta.threads.retrieve(conversation.thread_id)
+                logger.debug("Conversation found for user %s. Thread ID: %s", self.user.phone, conversation.thread_id)
+                thread_id = conversation.thread_id
             else:
                 # If no conversation exists, create a new thread
-                logger.debug(f"Creating a new thread for user {self.user.phone}")
-                thread = self.client.beta.threads.create()
-                thread_id = thread.id
-
-                # Save the new thread in the Conversation model
-                Conversation.objects.create(
-                    thread_id=thread_id,
-                    user_conversation=self.user
+                logger.debug("Creating a new thread for user %s", self.user.phone)
+                thread_id = self.client.beta.threads.create().id
+
+                # Save the new thread in the Conversation model; if another worker saved one
+                # first, the unique constraint makes get_or_create return that one
+                conversation, _ = Conversation.objects.get_or_create(
+                    user_conversation=self.user,
+                    defaults={'thread_id': thread_id}
                 )
-                logger.debug(f"New conversation created with thread ID: {thread_id}")
+                thread_id = conversation.thread_id
+                logger.debug("New conversation created with thread ID: %s", thread_id)
 
-            return thread
+            caches['threads'].set(cache_key, thread_id)
+            return thread_id
 
-        except CustomUser.DoesNotExist:
-            logger.error("User with the given phone number does not exist.")
+        except Exception as e:
+            # Los errores transitorios suben para que la cola reintente el job
+            if retryable(e):
+                raise
+            logger.error("Error: %s", str(e))
             return None
 
+    # EL CACHE 'threads' ES DE CADA PROCESO: SI OTRO WORKER ROTÓ EL THREAD, ESTE SIGUE CON EL
+    # VIEJO HASTA QUE record_run O save_rotation NO ENCUENTRAN LA FILA. SE DESCARTA EL ID EN
+    # CACHÉ Y SE VUELVE A LEER EL DE Conversation.
+    def reload_thread(self):
+        cache_key = thread_cache_key(self.user)
+        caches['threads'].delete(cache_key)
+        thread_id = threads.current_thread_id(self.user)
+        if thread_id:
+            logger.info("Thread %s for %s was replaced by %s in another worker", self.thread_id, self.user, thread_id)
+            caches['threads'].set(cache_key, thread_id)
+            self.thread_id = thread_id
+
+    # EL THREAD EN CACHÉ YA NO EXISTE EN OPENAI. ANTES DE CREAR OTRO SE VUELVE A LEER
+    # Conversation: OTRO WORKER PUDO HABERLO REEMPLAZADO O ROTADO Y ESTE PROCESO NO SE ENTERA.
+    def replace_thread(self):
+        thread_id = threads.current_thread_id(self.user)
+        if not thread_id or thread_id == self.thread_id:
+            # El thread nuevo conserva el contexto guardado en la última rotación
+            thread_id = self.client.beta.threads.create(messages=threads.stored_seed(self.user)).id
+            thread_id = threads.save_replacement(self.user, self.thread_id, thread_id)
+        caches['threads'].set(thread_cache_key(self.user), thread_id)
+        return thread_id
+
+
+# VERSIÓN ASÍNCRONA DEL BOT PARA EL PIPELINE ASGI (BOT_PIPELINE = 'async').
+# USA AsyncOpenAI, asyncio.sleep Y EL ORM ASÍNCRONO, ASÍ UN SOLO WORKER DE UVICORN
+# PUEDE ATENDER CIENTOS DE CONVERSACIONES AL MISMO TIEMPO.
+class AsyncBot:
+    def __init__(self, user):
+        self.client = clients.async_openai()
+
+        self.user = user
+
+        self.timings = RunTimings()
+
+        self.deadline = self.timings.started + settings.BOT_RUN_DEADLINE_SECONDS
+        self.run_id = None
+        self.prompt_tokens = None
+        self.rotation_due = False
+        self.tools_ran = False
+        # Las herramientas corren en un hilo que asyncio.wait_for no puede detener (ver converse)
+        self.tool_task = None
+
+        self.thread_id = None
+
+        self.assistant_id = ASSISTANT_ID
+
+    @classmethod
+    async def create(cls, user):
+        bot = cls(user)
+        with bot.timings.stage('thread'):
+            bot.thread_id = await bot.create_or_retrieve_thread()
+        return bot
+
+    async def run(self, user_message):
+        try:
+            async with async_openai_limiter.slot(self.user.phone):
+                last_message = await self.converse(user_message)
+        except Overloaded:
+            logger.warning("Too many concurrent runs, shedding message from %s", self.user)
+            metrics.incr('bot.shed')
+            last_message = settings.BOT_BUSY_REPLY
+
+        self.timings.finish(self.user)
+        return last_message
+
+    async def converse(self, user_message):
+        from openai import APITimeoutError
+
+        try:
+            last_message = await asyncio.wait_for(self.run_until_completed(user_message), self.remaining())
+            due = await sync_to_async(threads.record_run)(self.user, self.thread_id, self.prompt_tokens)
+            if due is None:
+                await self.reload_thread()
+            self.rotation_due = bool(due)
+
+        except (asyncio.TimeoutError, APITimeoutError):
+            logger.warning("Run %s for %s exceeded its deadline", self.run_id, self.user)
+            metrics.incr('bot.run_timeout')
+            await self.wait_for_tools()
+            await self.cancel_run()
+            last_message = interrupted_reply(self.tools_ran, settings.BOT_TIMEOUT_REPLY)
+
+        except RunFailed as e:
+            logger.error("Run %s for %s ended with status %s", self.run_id, self.user, e.status)
+            metrics.incr('bot.run_failed')
+            metrics.incr(f"bot.run_failed.{e.status}")
+            last_message = interrupted_reply(self.tools_ran, settings.BOT_FAILURE_REPLY)
+
+        return last_message
+
+    async def run_until_completed(self, user_message):
+        with self.timings.stage('message'):
+            await self.send_user_message(user_message)
+
+        if settings.BOT_RUN_STREAMING and hasattr(self.client.beta.threads.runs, 'stream'):
+            return await self.run_streaming()
+        return await self.run_polling()
+
+    async def send_user_message(self, user_message):
+        from openai import NotFoundError
+
+        try:
+            await self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=user_message,
+            )
+        except NotFoundError:
+            logger.warning("Thread %s for %s no longer exists, creating a new one", self.thread_id, self.user)
+            self.thread_id = await self.replace_thread()
+            await self.client.beta.threads.messages.create(
+                thread_id=self.thread_id,
+                role="user",
+                content=user_message,
+            )
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    async def cancel_run(self):
+        if not self.run_id:
+            return
+        try:
+            await self.client.beta.threads.runs.cancel(thread_id=self.thread_id, run_id=self.run_id)
         except Exception as e:
-            logger.error(f"Error: {str(e)}")
+            logger.error("Error cancelling run %s: %s", self.run_id, str(e))
+
+    async def rotate_if_due(self):
+        if not self.rotation_due:
+            return
+        self.rotation_due = False
+        started = time.monotonic()
+        try:
+            messages = await self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                order='desc',
+                limit=settings.BOT_THREAD_SUMMARY_MESSAGES,
+            )
+            history = threads.history_from_messages(reversed(messages.data))
+            summary, facts = await sync_to_async(threads.prepare_rotation)(self.user, history)
+            thread_id = (await self.client.beta.threads.create(messages=[threads.seed_message(summary, facts)])).id
+            if await sync_to_async(threads.save_rotation)(self.user, self.thread_id, thread_id, summary, facts):
+                await caches['threads'].aset(thread_cache_key(self.user), thread_id)
+                self.thread_id = thread_id
+                metrics.incr('bot.thread_rotated')
+            else:
+                await self.reload_thread()
+        except Exception as e:
+            logger.error("Error rotating thread %s for %s: %s", self.thread_id, self.user, e)
+        metrics.observe('bot.rotate', time.monotonic() - started)
+
+    async def run_streaming(self):
+        last_message = None
+        stream_manager = self.client.beta.threads.runs.stream(
+            thread_id=self.thread_id,
+            assistant_id=self.assistant_id,
+        )
+
+        while stream_manager is not None:
+            async with stream_manager as stream:
+                stream_manager = None
+                async for event in stream:
+                    if event.event == 'thread.run.created':
+                        self.run_id = event.data.id
+                    elif event.event == 'thread.run.completed':
+                        self.prompt_tokens = prompt_tokens(event.data)
+                    elif event.event in TERMINAL_EVENTS:
+                        raise RunFailed(event.data.status)
+                    elif event.event == 'thread.message.completed':
+                        last_message = message_text(event.data)
+                    elif event.event == 'thread.run.requires_action':
+                        run = event.data
+                        self.run_id = run.id
+                        tool_outputs = await self.execute_tool_calls(run)
+                        stream_manager = self.client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=self.thread_id,
+                            run_id=run.id,
+                            tool_outputs=tool_outputs,
+                        )
+                        break
+
+        return last_message
+
+    async def run_polling(self):
+        run = await self.client.beta.threads.runs.create(
+           thread_id=self.thread_id,
+           assistant_id=self.assistant_id,
+        )
+
+        self.run_id = run.id
+
+        delays = backoff_delays()
+        while run.status != 'completed':
+            if run.status in TERMINAL_STATUSES:
+                raise RunFailed(run.status)
+
+            if run.status == 'requires_action':
+                run = await self.handle_requires_action(run)
+                delays = backoff_delays()
+            else:
+                await asyncio.sleep(next(delays))
+                previous_status = run.status
+                run = await self.client.beta.threads.runs.retrieve(
+                    thread_id=self.thread_id,
+                    run_id=run.id,
+                )
+                if run.status != previous_status:
+                    delays = backoff_delays()
+        self.prompt_tokens = prompt_tokens(run)
+
+        with self.timings.stage('reply'):
+            messages = await self.client.beta.threads.messages.list(
+                thread_id=self.thread_id,
+                run_id=run.id,
+                order='desc',
+                limit=1,
+            )
+        return message_text(messages.data[0])
+
+    async def handle_requires_action(self, run):
+        required_action = run.required_action
+        if required_action.type == 'submit_tool_outputs':
+            tool_outputs = await self.execute_tool_calls(run)
+
+            run = await self.client.beta.threads.runs.submit_tool_outputs(
+                thread_id=self.thread_id,
+                run_id=run.id,
+                tool_outputs=tool_outputs
+            )
+        return run
+
+    async def execute_tool_calls(self, run):
+        self.tools_ran = True
+        with self.timings.stage('tools'):
+            # Las funciones de herramientas usan el ORM síncrono; se ejecutan en un
+            # hilo aparte para no bloquear el event loop
+            dispatch = sync_to_async(dispatch_tool_calls_in_thread, thread_sensitive=False)
+            self.tool_task = asyncio.ensure_future(
+                dispatch(run.required_action.submit_tool_outputs.tool_calls, self.user)
+            )
+            # shield: si se acaba el plazo, wait_for cancela la espera pero no la tarea
+            return await asyncio.shield(self.tool_task)
+
+    # EL HILO DE LAS HERRAMIENTAS SIGUE CORRIENDO AUNQUE SE HAYA ACABADO EL PLAZO: SE ESPERA A QUE
+    # TERMINE PARA QUE LA RESPUESTA AL USUARIO DIGA LO QUE DE VERDAD QUEDÓ REGISTRADO
+    async def wait_for_tools(self):
+        if self.tool_task is None or self.tool_task.done():
+            return
+        try:
+            await self.tool_task
+        except Exception as e:
+            logger.error("Error in tools of run %s for %s: %s", self.run_id, self.user, e)
+
+    async def create_or_retrieve_thread(self):
+        cache_key = thread_cache_key(self.user)
+        thread_id = await caches['threads'].aget(cache_key)
+        if thread_id:
+            return thread_id
+
+        try:
+            conversation = await Conversation.objects.filter(user_conversation=self.user).afirst()
+
+            if conversation and conversation.thread_id:
+                thread_id = conversation.thread_id
+            else:
+                logger.debug("Creating a new thread for user %s", self.user.phone)
+                thread_id = (await self.client.beta.threads.create()).id
+
+                conversation, _ = await Conversation.objects.aget_or_create(
+                    user_conversation=self.user,
+                    defaults={'thread_id': thread_id}
+                )
+                thread_id = conversation.thread_id
+                logger.debug("New conversation created with thread ID: %s", thread_id)
+
+            await caches['threads'].aset(cache_key, thread_id)
+            return thread_id
+
+        except Exception as e:
+            # Los errores transitorios suben para que la cola reintente el job
+            if retryable(e):
+                raise
+            logger.error("Error: %s", str(e))
             return None
 
+    async def reload_thread(self):
+        cache_key = thread_cache_key(self.user)
+        await caches['threads'].adelete(cache_key)
+        thread_id = await sync_to_async(threads.current_thread_id)(self.user)
+        if thread_id:
+            logger.info("Thread %s for %s was replaced by %s in another worker", self.thread_id, self.user, thread_id)
+            await caches['threads'].aset(cache_key, thread_id)
+            self.thread_id = thread_id
+
+    async def replace_thread(self):
+        thread_id = await sync_to_async(threads.current_thread_id)(self.user)
+        if not thread_id or thread_id == self.thread_id:
+            seed = await sync_to_async(threads.stored_seed)(self.user)
+            thread_id = (await self.client.beta.threads.create(messages=seed)).id
+            thread_id = await sync_to_async(threads.save_replacement)(self.user, self.thread_id, thread_id)
+        await caches['threads'].aset(thread_cache_key(self.user), thread_id)
+        return thread_id
+
+
+# EJECUTA LA FUNCIÓN QUE EL ASISTENTE PIDIÓ CON LOS ARGUMENTOS QUE ENVIÓ
+def execute_tool_call(function_name, args, user):
+    output = ""
+
+    if function_name == "mandar_productos_inventario":
+        products = args['products']
+
+        # Process the batch and get output
+        output = process_product_batch({"products": products}, user)
+
+    elif function_name == "vender_producto":
+        products = args['products']
+        selling_price = args['selling_price']
+
+        # Sell the product and get output
+        output = sell_product({"productos": products, "precio_venta": selling_price}, user)
+
+    elif function_name == "generar_reporte_ventas":
+        timeframe = args['timeframe']
+        units = args['units']
+
+        # Generate the sales report; breakdown and top are optional
+        output = generate_sales_report(user, timeframe, units, args.get('breakdown'), int(args.get('top') or 0))
+
+    return output
+
+
+# HERRAMIENTAS QUE MODIFICAN EL INVENTARIO DEL USUARIO. ENTRE ELLAS SE RESPETA EL ORDEN EN QUE
+# LAS PIDIÓ EL ASISTENTE; LAS DEMÁS (REPORTES) SOLO LEEN Y CORREN DESPUÉS, EN PARALELO.
+STOCK_TOOLS = {"mandar_productos_inventario", "vender_producto"}
+
+_tool_executor = None
+_tool_executor_lock = threading.Lock()
+
+
+def tool_executor():
+    # Se crea al primer uso para que cada proceso (incluidos los hijos de run_bot_worker) tenga el suyo
+    global _tool_executor
+    if _tool_executor is None:
+        with _tool_executor_lock:
+            if _tool_executor is None:
+                _tool_executor = ThreadPoolExecutor(
+                    max_workers=settings.BOT_TOOL_WORKERS, thread_name_prefix='bot-tools'
+                )
+    return _tool_executor
+
+
+def _run_tool_chain(calls, user, outputs, in_thread):
+    try:
+        for position, tool_call_id, function_name, args in calls:
+            started = time.monotonic()
+            output = execute_tool_call(function_name, args, user)
+            metrics.observe(f"bot.tool.{function_name}", time.monotonic() - started)
+            outputs[position] = {"tool_call_id": tool_call_id, "output": output}
+    finally:
+        if in_thread:
+            close_old_connections()
+
+
+# EJECUTA LAS LLAMADAS DE UN requires_action. LAS QUE TOCAN EL INVENTARIO CORREN PRIMERO, EN
+# ORDEN, EN EL HILO ACTUAL; LOS REPORTES CORREN DESPUÉS PARA QUE INCLUYAN LAS VENTAS DEL MISMO
+# LOTE, Y SI SON VARIOS USAN EL POOL (CADA HILO CON SU CONEXIÓN A LA BASE DE DATOS). LAS
+# SALIDAS CONSERVAN EL ORDEN.
+def dispatch_tool_calls(tool_calls, user):
+    stock_chain = []
+    reads = []
+    for position, tool_call in enumerate(tool_calls):
+        name = tool_call.function.name
+        call = (position, tool_call.id, name, json.loads(tool_call.function.arguments))
+        if name in STOCK_TOOLS:
+            stock_chain.append(call)
+        else:
+            reads.append([call])
+
+    outputs = [None] * len(tool_calls)
+    _run_tool_chain(stock_chain, user, outputs, in_thread=False)
+    if len(reads) <= 1 or settings.BOT_TOOL_WORKERS <= 1:
+        for chain in reads:
+            _run_tool_chain(chain, user, outputs, in_thread=False)
+        return outputs
+
+    # La primera lectura corre en el hilo actual mientras el pool atiende las demás
+    futures = [tool_executor().submit(_run_tool_chain, chain, user, outputs, True) for chain in reads[1:]]
+    _run_tool_chain(reads[0], user, outputs, in_thread=False)
+    for future in futures:
+        # Si una herramienta falla, el error llega igual que cuando se ejecutaban en serie
+        future.result()
+    return outputs
+
+
+def dispatch_tool_calls_in_thread(tool_calls, user):
+    # Los hilos del executor abren su propia conexión a la base de datos; se cierra al terminar
+    try:
+        return dispatch_tool_calls(tool_calls, user)
+    finally:
+        close_old_connections()
+
 
 def process_product_batch(data, user):
     products = data.get('products')
     if not products:
         return "Products must be provided. Status: 400"
 
+    # Validar y combinar las líneas repetidas del mismo producto
+    lineas = {}
     for product_data in products:
         # Obtener datos del producto
         name = product_data.get('name')
-        brand = product_data.get('brand')
+        # Sin marca se guarda como NULL (unique_product no distingue NULL de '')
+        brand = product_data.get('brand') or None
         category = product_data.get('category', "Otros")
         amount = product_data.get('amount')
         buying_price = float(product_data.get('buying_price', 0))
@@ -185,54 +856,117 @@ def process_product_batch(data, user):
         if not name or not category or not amount or quantity <= 0:
             continue
 
-        # Obtener o crear el producto principal
-        product, _ = Product.objects.get_or_create(
-            name=name,
-            brand=brand,
-            amount=amount,
-            defaults={
-                'category': category,
-            }
-        )
+        key = (name, brand, amount)
+        if key in lineas:
+            lineas[key]['quantity'] += quantity
+        else:
+            lineas[key] = {'category': category, 'buying_price': buying_price, 'quantity': quantity}
 
-        # Obtener o crear el registro en AuxProdUser
-        aux_prod_user, created = AuxProdUser.objects.get_or_create(
-            user_aux=user,
-            product_aux=product,
-            defaults={
-                'user_aux': user,
-                'product_aux': product,
-                'quantity': quantity,
-                'buying_price': buying_price
-            }
-        )
+    if not lineas:
+        return "Batch processed successfully. Created: 0, updated: 0. Status: 201"
 
-        if not created:
-            # Actualizar cantidad y precio de compra
-            aux_prod_user.quantity += quantity
-            aux_prod_user.save()
+    # Si otra carga crea el mismo producto al mismo tiempo, la restricción única hace fallar
+    # la transacción y se reintenta con los datos ya existentes
+    for intento in range(2):
+        try:
+            with transaction.atomic():
+                creados, actualizados = _guardar_inventario(user, lineas)
+            break
+        except IntegrityError:
+            if intento:
+                raise
+            logger.warning("Conflicto al cargar inventario para '%s', reintentando", user)
+
+    return f"Batch processed successfully. Created: {creados}, updated: {actualizados}. Status: 201"
+
+
+# GUARDA UNA CARGA DE INVENTARIO CON UN NÚMERO CONSTANTE DE QUERIES: LEE LOS PRODUCTOS Y EL
+# INVENTARIO EXISTENTES DE UNA VEZ, CREA LOS NUEVOS CON bulk_create Y SUMA LAS CANTIDADES
+# CON UN SOLO bulk_update DE EXPRESIONES F().
+def _guardar_inventario(user, lineas):
+    def condicion_productos(keys):
+        condicion = Q()
+        for name, brand, amount in keys:
+            marca = Q(brand=brand) if brand else Q(brand__isnull=True) | Q(brand='')
+            condicion |= Q(name=name, amount=amount) & marca
+        return condicion
+
+    # Obtener o crear los productos principales
+    productos = {
+        (p.name, p.brand or None, p.amount): p
+        for p in Product.objects.filter(condicion_productos(lineas))
+    }
+    nuevos = [key for key in lineas if key not in productos]
+    if nuevos and settings.PRODUCT_CANONICAL_THRESHOLD:
+        # Asociar las variantes de escritura ("Coca-Cola 600 ml" / "coca cola 600ml") al
+        # producto que ya existe en el catálogo en lugar de crear un duplicado
+        productos.update(find_canonical_products(nuevos, settings.PRODUCT_CANONICAL_THRESHOLD))
+        nuevos = [key for key in nuevos if key not in productos]
+    if nuevos:
+        Product.objects.bulk_create([
+            Product(name=name, brand=brand, amount=amount, category=lineas[(name, brand, amount)]['category']).with_match_keys()
+            for name, brand, amount in nuevos
+        ])
+        productos.update({
+            (p.name, p.brand or None, p.amount): p
+            for p in Product.objects.filter(condicion_productos(nuevos))
+        })
+        transaction.on_commit(bump_catalog_generation)
+
+    # Varias líneas pueden corresponder al mismo producto del catálogo
+    por_producto = {}
+    for key, linea in lineas.items():
+        product = productos[key]
+        if product.id in por_producto:
+            por_producto[product.id][1]['quantity'] += linea['quantity']
+        else:
+            por_producto[product.id] = (product, dict(linea))
+
+    # Obtener los registros de inventario del usuario para esos productos
+    inventario = {
+        aux.product_aux_id: aux
+        for aux in AuxProdUser.objects.filter(user_aux=user, product_aux_id__in=por_producto)
+    }
+
+    por_crear = []
+    por_actualizar = []
+    for product, linea in por_producto.values():
+        aux_prod_user = inventario.get(product.id)
+        if aux_prod_user is None:
+            por_crear.append(AuxProdUser(
+                user_aux=user,
+                product_aux=product,
+                quantity=linea['quantity'],
+                buying_price=linea['buying_price'],
+            ))
+        else:
+            # Actualizar cantidad en la base de datos, sin leer y escribir desde Python
+            aux_prod_user.quantity = F('quantity') + linea['quantity']
+            por_actualizar.append(aux_prod_user)
 
-    return "Batch processed successfully. Status: 201"
+    if por_crear:
+        AuxProdUser.objects.bulk_create(por_crear)
+    if por_actualizar:
+        AuxProdUser.objects.bulk_update(por_actualizar, ['quantity'])
 
+    # Agregar los productos nuevos a los índices de búsqueda del usuario
+    creados = [(aux.id, aux.product_aux) for aux in por_crear]
+
+    def actualizar_indices():
+        for aux_id, product in creados:
+            inventory_index.add_product(user.id, product, aux_id)
+
+    transaction.on_commit(actualizar_indices)
+    logger.debug("Inventario cargado para '%s': %s productos nuevos, %s registros creados, %s actualizados", user, len(nuevos), len(por_crear), len(por_actualizar))
+
+    return len(por_crear), len(por_actualizar)
 
-def normalize_text(text):
-    if not text:
-        return ''
-    # Eliminar acentos y caracteres especiales
-    text = unicodedata.normalize('NFKD', str(text)).encode('ASCII', 'ignore').decode('utf-8')
-    # Convertir a minúsculas
-    text = text.lower()
-    # Eliminar caracteres especiales como guiones, apóstrofes, puntos, comas, etc.
-    text = re.sub(r'[^a-z0-9\s]', '', text)
-    # Eliminar espacios adicionales
-    text = re.sub(r'\s+', ' ', text).strip()
-    return text
 
 def sell_product(data, user):
     logger.debug("Iniciando la función sell_product")
     productos = data.get('productos')
     precio_venta = data.get('precio_venta')
-    logger.debug(f"Datos recibidos - precio_venta: {precio_venta}, productos: {productos}")
+    logger.debug("Datos recibidos - precio_venta: %s, productos: %s", precio_venta, productos)
 
     if not productos or precio_venta is None:
         logger.error("No se proporcionaron 'productos' o 'precio_venta'")
@@ -241,8 +975,11 @@ def sell_product(data, user):
     precio_venta = float(precio_venta)
     mensajes = []
 
+    # Validar los productos y normalizar sus datos antes del matching
+    items_validos = []
+    ventas = []
     for producto_data in productos:
-        logger.debug(f"Procesando producto: {producto_data}")
+        logger.debug("Procesando producto: %s", producto_data)
         nombre = producto_data.get('nombre')
         marca = producto_data.get('marca')
         categoría = producto_data.get('categoría')
@@ -251,108 +988,52 @@ def sell_product(data, user):
 
         # Validar que los campos requeridos estén presentes y correctos
         if not all([nombre, categoría, unidad_medida, marca is not None]) or cantidad <= 0:
-            logger.error(f"Datos inválidos para el producto '{nombre}': {producto_data}")
+            logger.error("Datos inválidos para el producto '%s': %s", nombre, producto_data)
             mensajes.append(f"El producto '{nombre}' no tiene todos los datos requeridos o los valores son inválidos. No se procesó la venta de este producto.")
             continue
 
         # Normalizar y combinar nombre y unidad de medida
-        nombre_normalizado = normalize_text(nombre)
-        unidad_medida_normalizada = normalize_text(unidad_medida)
-        nombre_unidad = f"{nombre_normalizado} {unidad_medida_normalizada}"
+        nombre_unidad = name_unit_key(nombre, unidad_medida)
         marca_normalizada = normalize_text(marca)
-        categoría_normalizada = normalize_text(categoría)
-        logger.debug(f"Datos normalizados - nombre_unidad: {nombre_unidad}, marca: {marca_normalizada}, categoría: {categoría_normalizada}")
+        logger.debug("Datos normalizados - nombre_unidad: %s, marca: %s, categoría: %s", nombre_unidad, marca_normalizada, categoría)
 
-        # Obtener productos en la categoría
-        productos_en_categoria = AuxProdUser.objects.filter(
-            user_aux=user,
-            product_aux__category__iexact=categoría
-        ).select_related('product_aux')
+        items_validos.append((producto_data, SaleItem(nombre_unidad, marca_normalizada, categoría)))
 
-        logger.debug(f"Productos encontrados en la categoría '{categoría}' para el usuario '{user}': {productos_en_categoria.count()}")
+    # Encontrar de una vez el producto más similar para cada item (umbral de similitud del 80%)
+    coincidencias = match_items(user, [item for _, item in items_validos], threshold=80)
+
+    for (producto_data, item), coincidencia in zip(items_validos, coincidencias):
+        nombre = producto_data.get('nombre')
+        marca = producto_data.get('marca')
+        categoría = producto_data.get('categoría')
+        unidad_medida = producto_data.get('unidad_medida')
+        cantidad = int(producto_data.get('cantidad', 1))
+        logger.debug("Resultado del matching difuso para '%s': %s", item.nombre_unidad, coincidencia)
 
-        if not productos_en_categoria.exists():
-            logger.error(f"No se encontraron productos en la categoría '{categoría}' asociados al usuario '{user}'")
+        if coincidencia.reason == 'no_category':
+            logger.error("No se encontraron productos en la categoría '%s' asociados al usuario '%s'", categoría, user)
             mensajes.append(f"No se encontraron productos en la categoría '{categoría}' asociados a tu inventario.")
             continue
-
-        # Crear listas de nombres (nombre + unidad) y marcas normalizados
-        nombres_unidad_productos = []
-        marcas_productos = []
-        productos_lista = []
-
-        for producto in productos_en_categoria:
-            nombre_prod_norm = normalize_text(producto.name)
-            unidad_medida_prod_norm = normalize_text(producto.amount)
-            nombre_unidad_prod = f"{nombre_prod_norm} {unidad_medida_prod_norm}"
-            marca_prod_norm = normalize_text(producto.brand)
-            nombres_unidad_productos.append(nombre_unidad_prod)
-            marcas_productos.append(marca_prod_norm)
-            productos_lista.append(producto)
-
-        # Encontrar el producto con el nombre y unidad más similar
-        match = process.extractOne(nombre_unidad, nombres_unidad_productos, scorer=fuzz.token_sort_ratio)
-        logger.debug(f"Resultado del matching difuso para '{nombre_unidad}': {match}")
-
-        if match and match[1] >= 80:  # Umbral de similitud del 80%
-            idx = nombres_unidad_productos.index(match[0])
-            producto_encontrado = productos_lista[idx]
-            logger.debug(f"Producto encontrado: {producto_encontrado.name} (ID: {producto_encontrado.id}), Unidad: {producto_encontrado.amount}, con similitud de {match[1]}%")
-
-            # Si se proporcionó marca, verificar similitud de marca
-            if marca_normalizada:
-                ratio_marca = fuzz.token_sort_ratio(marca_normalizada, marcas_productos[idx])
-                logger.debug(f"Similitud de marca para '{marca_normalizada}': {ratio_marca}%")
-                if ratio_marca < 80:
-                    logger.error(f"La marca '{marca}' no coincide suficientemente con '{producto_encontrado.brand}'")
-                    mensajes.append(f"No se encontró una marca similar a '{marca}' para el producto '{nombre}'.")
-                    continue
-        else:
-            logger.error(f"No se encontró un producto similar a '{nombre}' con unidad '{unidad_medida}' en la categoría '{categoría}'")
-            mensajes.append(f"No se encontró un producto similar a '{nombre}' con unidad '{unidad_medida}' en la categoría '{categoría}'.")
+        if coincidencia.reason == 'brand':
+            logger.error("La marca '%s' no coincide suficientemente con la de los productos similares a '%s'", marca, nombre)
+            mensajes.append(f"No se encontró una marca similar a '{marca}' para el producto '{nombre}'.")
             continue
-
-        # Buscar el AuxProdUser asociado al usuario para obtener 'buying_price'
-        try:
-            aux_prod_user = AuxProdUser.objects.get(product_aux=producto_encontrado, user_aux=user)
-            logger.debug(f"Producto en inventario del usuario. Cantidad disponible: {aux_prod_user.quantity}")
-        except AuxProdUser.DoesNotExist:
-            logger.error(f"El usuario no tiene el producto '{producto_encontrado.name}' en su inventario")
-            mensajes.append(f"No tienes disponible el producto '{producto_encontrado.name}' para vender.")
+        if coincidencia.reason == 'no_match':
+            logger.error("No se encontró un producto similar a '%s' con unidad '%s' en la categoría '%s'", nombre, unidad_medida, categoría)
+            mensajes.append(f"No se encontró un producto similar a '{nombre}' con unidad '{unidad_medida}' en la categoría '{categoría}'.")
             continue
 
-        if aux_prod_user.quantity < cantidad:
-            logger.error(f"Cantidad insuficiente del producto '{producto_encontrado.name}'. Disponible: {aux_prod_user.quantity}, solicitada: {cantidad}")
-            mensajes.append(f"No hay suficientes unidades del producto '{producto_encontrado.name}' para vender. Disponibles: {aux_prod_user.quantity}.")
-            continue
+        nombre_encontrado = coincidencia.product_name
+        aux_id = coincidencia.aux_id
+        logger.debug("Producto encontrado: %s (ID: %s), con similitud de %s%%", nombre_encontrado, coincidencia.product_id, coincidencia.score)
 
-        # Obtener el precio de compra del AuxProdUser
-        precio_compra = aux_prod_user.buying_price
-        logger.debug(f"Precio de compra obtenido del AuxProdUser: {precio_compra}")
+        # El descuento de inventario se hace después, para todo el carrito en una sola transacción
+        ventas.append((len(mensajes), aux_id, cantidad, nombre_encontrado))
+        mensajes.append(None)
 
-        # Reducir la cantidad del producto
-        aux_prod_user.quantity -= cantidad
-        logger.debug(f"Reduciendo cantidad del producto '{producto_encontrado.name}' en el inventario del usuario. Nueva cantidad: {aux_prod_user.quantity}")
-
-        # Eliminar el AuxProdUser si la cantidad llega a 0
-        if aux_prod_user.quantity == 0:
-            aux_prod_user.delete()
-            logger.debug(f"El producto '{producto_encontrado.name}' se ha agotado en el inventario del usuario y se eliminó el registro de AuxProdUser")
-        else:
-            aux_prod_user.save()
-            logger.debug(f"Actualizada la cantidad del producto '{producto_encontrado.name}' en el inventario del usuario")
-
-        # Registrar la transacción
-        transaction = Transaction.objects.create(
-            product_transaction=producto_encontrado,
-            user_transaction=user,
-            selling_price_unitario=precio_venta,
-            buying_price_unitario=precio_compra,
-            quantity=cantidad
-        )
-        logger.debug(f"Transacción registrada: ID {transaction.id} - Producto '{producto_encontrado.name}', Cantidad: {cantidad}, Precio venta unitario: {precio_venta}")
-
-        mensajes.append(f"Producto '{producto_encontrado.name}' vendido con éxito. Cantidad vendida: {cantidad}.")
+    if ventas:
+        for posicion, mensaje in registrar_ventas(user, ventas, precio_venta).items():
+            mensajes[posicion] = mensaje
 
     if mensajes:
         logger.debug("Proceso de venta completado con mensajes")
@@ -361,9 +1042,244 @@ def sell_product(data, user):
         logger.error("No se pudo procesar ninguna venta")
         return "No se pudo procesar ninguna venta. Verifique los datos proporcionados. Status: 400"
 
-def generate_sales_report(user, timeframe, units):
+
+class StockConflict(Exception):
+    pass
+
+
+# DESCUENTA EL INVENTARIO Y REGISTRA LAS TRANSACCIONES DE TODO EL CARRITO DENTRO DE UNA SOLA
+# TRANSACCIÓN DE BASE DE DATOS, CON UN NÚMERO CONSTANTE DE QUERIES SIN IMPORTAR CUÁNTOS ITEMS
+# TENGA. ventas ES UNA LISTA DE (posición del mensaje, aux_id, cantidad, nombre del producto).
+def registrar_ventas(user, ventas, precio_venta, intentos=2):
+    for intento in range(intentos):
+        try:
+            with transaction.atomic():
+                return _registrar_ventas(user, ventas, precio_venta)
+        except (StockConflict, IntegrityError):
+            logger.warning("Conflicto de inventario al vender para '%s', intento %s", user, intento + 1)
+
+    return {
+        posicion: f"El inventario del producto '{nombre}' cambió mientras se procesaba la venta. Intenta de nuevo."
+        for posicion, _, _, nombre in ventas
+    }
+
+
+def _registrar_ventas(user, ventas, precio_venta):
+    # 1. Bloquear las filas de inventario involucradas
+    filas = {
+        fila.id: fila
+        for fila in AuxProdUser.objects.select_for_update().select_related('product_aux').filter(
+            user_aux=user,
+            id__in={aux_id for _, aux_id, _, _ in ventas},
+        )
+    }
+
+    mensajes = {}
+    disponibles = {aux_id: fila.quantity for aux_id, fila in filas.items()}
+    vendidos = defaultdict(int)
+    transacciones = []
+
+    for posicion, aux_id, cantidad, nombre in ventas:
+        fila = filas.get(aux_id)
+        if fila is None:
+            logger.error("El usuario no tiene el producto '%s' en su inventario", nombre)
+            mensajes[posicion] = f"No tienes disponible el producto '{nombre}' para vender."
+            continue
+
+        producto = fila.product_aux
+        if disponibles[aux_id] < cantidad:
+            logger.error("Cantidad insuficiente del producto '%s'. Disponible: %s, solicitada: %s", producto.name, disponibles[aux_id], cantidad)
+            mensajes[posicion] = f"No hay suficientes unidades del producto '{producto.name}' para vender. Disponibles: {disponibles[aux_id]}."
+            continue
+
+        disponibles[aux_id] -= cantidad
+        vendidos[aux_id] += cantidad
+        transacciones.append(Transaction(
+            product_transaction=producto,
+            user_transaction=user,
+            selling_price_unitario=precio_venta,
+            buying_price_unitario=fila.buying_price,
+            quantity=cantidad
+        ))
+        mensajes[posicion] = f"Producto '{producto.name}' vendido con éxito. Cantidad vendida: {cantidad}."
+
+    faltantes = {aux_id for _, aux_id, _, _ in ventas} - set(filas)
+    if faltantes:
+        inventory_index.remove_aux(user.id, faltantes)
+
+    if not vendidos:
+        return mensajes
+
+    # 2. Un solo UPDATE condicional: cada fila solo se descuenta si aún tiene suficientes unidades
+    condicion = Q()
+    for aux_id, cantidad in vendidos.items():
+        condicion |= Q(id=aux_id, quantity__gte=cantidad)
+    actualizadas = AuxProdUser.objects.filter(condicion).update(
+        quantity=Case(
+            *[When(id=aux_id, then=F('quantity') - cantidad) for aux_id, cantidad in vendidos.items()],
+            default=F('quantity'),
+        )
+    )
+    if actualizadas != len(vendidos):
+        # Otra venta tocó el mismo inventario; se deshace todo y se reintenta
+        raise StockConflict()
+
+    # 3. Eliminar los registros que se agotaron
+    agotados = [aux_id for aux_id in vendidos if disponibles[aux_id] == 0]
+    if agotados:
+        AuxProdUser.objects.filter(id__in=agotados, quantity=0).delete()
+        transaction.on_commit(lambda: inventory_index.remove_aux(user.id, agotados))
+
+    # 4. Registrar todas las transacciones de una vez
+    Transaction.objects.bulk_create(transacciones)
+
+    # 5. Acumular la venta en el resumen diario usado por los reportes
+    actualizar_ventas_diarias(user, transacciones)
+    logger.debug("Venta registrada para '%s': %s transacciones, %s productos agotados", user, len(transacciones), len(agotados))
+
+    return mensajes
+
+
+# SUMA LAS TRANSACCIONES RECIÉN CREADAS AL RESUMEN DIARIO (usuario, producto, día): UNA
+# CONSULTA PARA LEER LAS FILAS DEL DÍA Y A LO MÁS UN bulk_update Y UN bulk_create.
+def actualizar_ventas_diarias(user, transacciones):
+    dia = timezone.localdate()
+    totales = defaultdict(lambda: [0, 0.0, 0.0])
+    for t in transacciones:
+        total = totales[t.product_transaction_id]
+        total[0] += t.quantity
+        total[1] += t.selling_price_unitario * t.quantity
+        total[2] += t.buying_price_unitario * t.quantity
+
+    existentes = {
+        fila.product_rollup_id: fila
+        for fila in DailySales.objects.select_for_update().filter(
+            user_rollup=user, day=dia, product_rollup_id__in=totales
+        )
+    }
+
+    por_crear = []
+    for product_id, (unidades, ingresos, costo) in totales.items():
+        fila = existentes.get(product_id)
+        if fila is None:
+            por_crear.append(DailySales(
+                user_rollup=user, product_rollup_id=product_id, day=dia,
+                quantity=unidades, revenue=ingresos, cost=costo,
+            ))
+        else:
+            fila.quantity = F('quantity') + unidades
+            fila.revenue = F('revenue') + ingresos
+            fila.cost = F('cost') + costo
+
+    if existentes:
+        DailySales.objects.bulk_update(existentes.values(), ['quantity', 'revenue', 'cost'])
+    if por_crear:
+        DailySales.objects.bulk_create(por_crear)
+
+
+def restar_meses(fecha, meses):
+    # Mismo día del mes, N meses calendario antes (el 31 de marzo menos un mes es el 28/29 de febrero)
+    mes = fecha.month - 1 - meses
+    año = fecha.year + mes // 12
+    mes = mes % 12 + 1
+    dia = min(fecha.day, calendar.monthrange(año, mes)[1])
+    return fecha.replace(year=año, month=mes, day=dia)
+
+
+PERIODOS = {'day': TruncDay, 'week': TruncWeek, 'month': TruncMonth}
+DESGLOSES = {
+    'product': ('name', 'amount', 'brand'),
+    'category': ('category',),
+}
+METRICAS = ('unidades', 'ingresos', 'costo')
+
+
+# LOS REPORTES SE CALCULAN SOBRE EL RESUMEN DIARIO (DailySales) O, SI SALES_REPORT_USE_ROLLUP
+# ES FALSE, SOBRE LAS TRANSACCIONES. CADA FUENTE ES UN QUERYSET CON EL PREFIJO DEL PRODUCTO, EL
+# CAMPO DE FECHA Y LAS EXPRESIONES SQL PARA UNIDADES, INGRESOS Y COSTO.
+FuenteReporte = namedtuple('FuenteReporte', ['ventas', 'producto', 'campo_fecha', 'metricas'])
+
+
+def _fuente_transacciones(queryset):
+    return FuenteReporte(queryset, 'product_transaction', 'time', {
+        'unidades': Sum('quantity'),
+        'ingresos': Sum(F('selling_price_unitario') * F('quantity'), output_field=FloatField()),
+        'costo': Sum(F('buying_price_unitario') * F('quantity'), output_field=FloatField()),
+    })
+
+
+# EL RESUMEN ES POR DÍA, ASÍ QUE SOLO CUBRE LOS DÍAS COMPLETOS DEL PERIODO: DEL PRIMER DÍA SE
+# LEEN LAS TRANSACCIONES DESDE start_date, Y EL REPORTE CUADRA CON EL DE LAS TRANSACCIONES.
+def _fuentes_reporte(user, start_date):
+    transacciones = Transaction.objects.filter(user_transaction=user, time__gte=start_date)
+    if not settings.SALES_REPORT_USE_ROLLUP:
+        return [_fuente_transacciones(transacciones)]
+
+    primer_dia = timezone.localdate(start_date)
+    fin_primer_dia = timezone.make_aware(datetime.combine(primer_dia + timedelta(days=1), datetime.min.time()))
+    resumen = FuenteReporte(DailySales.objects.filter(user_rollup=user, day__gt=primer_dia), 'product_rollup', 'day', {
+        'unidades': Sum('quantity'),
+        'ingresos': Sum('revenue'),
+        'costo': Sum('cost'),
+    })
+    return [resumen, _fuente_transacciones(transacciones.filter(time__lt=fin_primer_dia))]
+
+
+# AGRUPA TODAS LAS FUENTES EN UNA SOLA QUERY (UNION ALL) Y SUMA EN SQL LOS GRUPOS QUE APARECEN
+# EN VARIAS. grupos DEVUELVE, PARA CADA FUENTE, LAS EXPRESIONES QUE FORMAN LA LLAVE DEL GRUPO.
+# orden LISTA LAS MÉTRICAS POR LAS QUE SE ORDENA ('-' PARA DESCENDENTE); LOS EMPATES SE ROMPEN
+# POR LA LLAVE. CON limite SOLO SE LEEN ESOS GRUPOS.
+def _agrupar(fuentes, grupos, orden=(), limite=None):
+    consultas = [fuente.ventas.values(**grupos(fuente)).annotate(**fuente.metricas) for fuente in fuentes]
+    filas = consultas[0].union(*consultas[1:], all=True) if len(consultas) > 1 else consultas[0]
+
+    # El ORM no agrupa sobre un UNION: la query compilada va como subconsulta
+    connection = connections[filas.db]
+    sql, params = filas.query.get_compiler(filas.db).as_sql()
+    quote = connection.ops.quote_name
+    llaves = [quote(campo) for campo in grupos(fuentes[0])]
+    metricas = [f"SUM({quote(metrica)}) AS {quote(metrica)}" for metrica in METRICAS]
+    ordenar = [
+        f"{quote(metrica.lstrip('-'))} DESC" if metrica.startswith('-') else quote(metrica) for metrica in orden
+    ] + llaves
+    consulta = (
+        f"SELECT {', '.join(llaves + metricas)} FROM ({sql}) ventas GROUP BY {', '.join(llaves)} "
+        f"HAVING SUM({quote('unidades')}) IS NOT NULL ORDER BY {', '.join(ordenar)}"
+    )
+    if limite:
+        consulta += " LIMIT %s"
+        params = (*params, limite)
+
+    with connection.cursor() as cursor:
+        cursor.execute(consulta, params)
+        return {
+            tuple(fila[:len(llaves)]): dict(zip(METRICAS, fila[len(llaves):]))
+            for fila in cursor.fetchall()
+        }
+
+
+def _grupos_desglose(tipo):
+    if tipo in PERIODOS:
+        # Ambas fuentes agrupan por fecha local (date) para que sus periodos coincidan
+        return lambda fuente: {'grupo0': PERIODOS[tipo](fuente.campo_fecha, output_field=DateField())}
+    return lambda fuente: {
+        f"grupo{i}": F(f"{fuente.producto}__{campo}") for i, campo in enumerate(DESGLOSES[tipo])
+    }
+
+
+def _formatear_grupo(valores, tipo):
+    if tipo == 'product':
+        nombre, unidad, marca = valores
+        return f"{nombre} {unidad}" + (f" ({marca})" if marca else "")
+    if tipo in PERIODOS:
+        # SQLite devuelve la fecha como texto 'YYYY-MM-DD' y PostgreSQL como date
+        return str(valores[0])
+    return str(valores[0])
+
+
+def generate_sales_report(user, timeframe, units, breakdown=None, top=0):
     logger.debug("Iniciando la función generate_sales_report")
-    logger.debug(f"Datos recibidos - user: {user}, timeframe: {timeframe}, units: {units}")
+    logger.debug("Datos recibidos - user: %s, timeframe: %s, units: %s, breakdown: %s, top: %s", user, timeframe, units, breakdown, top)
 
     # Validar el timeframe
     now = timezone.now()
@@ -372,34 +1288,36 @@ def generate_sales_report(user, timeframe, units):
     elif timeframe == 'weeks':
         start_date = now - timedelta(weeks=units)
     elif timeframe == 'months':
-        start_date = now - timedelta(days=30 * units)
+        start_date = restar_meses(now, units)
     else:
         logger.error("Periodo de tiempo inválido")
         return "Periodo de tiempo inválido. Use 'days', 'weeks' o 'months'. Status: 400"
 
-    # Filtrar transacciones por usuario y fecha
-    transactions = Transaction.objects.filter(
-        user_transaction=user,
-        time__gte=start_date
-    )
-    logger.debug(f"Transacciones encontradas: {transactions.count()}")
+    if breakdown and breakdown not in DESGLOSES and breakdown not in PERIODOS:
+        logger.error("Desglose inválido: %s", breakdown)
+        return "Desglose inválido. Use 'product', 'category', 'day', 'week' o 'month'. Status: 400"
 
-    if not transactions.exists():
-        logger.debug("No se encontraron transacciones en el periodo especificado")
-        return f"No se encontraron transacciones para el usuario {user} en el periodo especificado. Status: 404"
+    # Filtrar ventas por usuario y fecha
+    fuentes = _fuentes_reporte(user, start_date)
 
-    # Calcular métricas
-    total_products_sold = sum(transaction.quantity for transaction in transactions)
-    logger.debug(f"Total de productos vendidos: {total_products_sold}")
+    # Desglose opcional por producto, categoría o periodo, agrupado y ordenado en SQL
+    desglose = None
+    if breakdown:
+        desglose = _agrupar(fuentes, _grupos_desglose(breakdown), () if breakdown in PERIODOS else ('-ingresos',))
+        # Los totales son la suma de los grupos: no hace falta otra query
+        totales = {metrica: sum(fila[metrica] for fila in desglose.values()) for metrica in METRICAS}
+    else:
+        # Calcular todas las métricas en una sola consulta
+        totales = _agrupar(fuentes, lambda fuente: {'grupo0': Value(1)}).get((1,))
 
-    total_revenue = sum(transaction.selling_price_unitario * transaction.quantity for transaction in transactions)
-    logger.debug(f"Ingresos totales: {total_revenue}")
+    if not totales or not totales['unidades']:
+        logger.debug("No se encontraron transacciones en el periodo especificado")
+        return f"No se encontraron transacciones para el usuario {user} en el periodo especificado. Status: 404"
 
-    total_profit = sum(
-        (transaction.selling_price_unitario - transaction.buying_price_unitario) * transaction.quantity
-        for transaction in transactions
-    )
-    logger.debug(f"Ganancia total: {total_profit}")
+    total_products_sold = totales['unidades']
+    total_revenue = totales['ingresos']
+    total_profit = totales['ingresos'] - totales['costo']
+    logger.debug("Totales - productos vendidos: %s, ingresos: %s, ganancia: %s", total_products_sold, total_revenue, total_profit)
 
     # Generar el reporte como string
     report = (
@@ -409,8 +1327,24 @@ def generate_sales_report(user, timeframe, units):
         f"Total de productos vendidos: {total_products_sold}\n"
         f"Ingresos totales: ${total_revenue:.2f}\n"
         f"Ganancia total: ${total_profit:.2f}\n"
-        f"Status: 200 - Reporte generado exitosamente."
     )
-    logger.debug(f"Reporte generado: {report}")
 
-    return report
\ No newline at end of file
+    if desglose is not None:
+        report += f"Desglose por {breakdown}:\n"
+        for llave, fila in desglose.items():
+            report += (
+                f"- {_formatear_grupo(llave, breakdown)}: {fila['unidades']} unidades, "
+                f"${fila['ingresos']:.2f} ingresos, ${fila['ingresos'] - fila['costo']:.2f} ganancia\n"
+            )
+
+    # Productos más vendidos: la base ordena por unidades y solo devuelve los primeros
+    if top:
+        mas_vendidos = _agrupar(fuentes, _grupos_desglose('product'), ('-unidades',), top)
+        report += f"Top {top} productos más vendidos:\n"
+        for posicion, (llave, fila) in enumerate(mas_vendidos.items(), start=1):
+            report += f"{posicion}. {_formatear_grupo(llave, 'product')}: {fila['unidades']} unidades\n"
+
+    report += "Status: 200 - Reporte generado exitosamente."
+    logger.debug("Reporte generado: %s", report)
+
+    return report
@@ -0,0 +1,101 @@
+import os
+import threading
+
+from decouple import config
+from django.conf import settings
+
+from .throttle import ThrottledClient, openai_bucket
+
+# REGISTRO DE LOS CLIENTES DE APIS EXTERNAS (OPENAI, TWILIO). CADA CLIENTE SE CREA CON SU
+# PRIMER USO Y SE COMPARTE EN TODO EL PROCESO, ASÍ QUE IMPORTAR UN MÓDULO NO CARGA openai NI
+# ABRE CONEXIONES. SI EL PROCESO SE BIFURCA (gunicorn --preload), EL HIJO CREA SUS PROPIOS
+# CLIENTES: LAS CONEXIONES Y LOS HILOS DEL PADRE NO SE PUEDEN REUSAR.
+
+_clients = {}
+_pid = None
+# Reentrante: la fábrica de un cliente puede pedir otro (la cola de salida usa el de Twilio)
+_lock = threading.RLock()
+
+
+def _check_pid():
+    global _pid
+    if _pid != os.getpid():
+        with _lock:
+            if _pid != os.getpid():
+                _clients.clear()
+                _pid = os.getpid()
+
+
+def get(name, factory):
+    _check_pid()
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def peek(name):
+    # El cliente si ya existe en este proceso, sin crearlo
+    _check_pid()
+    return _clients.get(name)
+
+
+def reset():
+    # Descarta los clientes creados, por ejemplo para apuntarlos a los servidores falsos de loadtest
+    with _lock:
+        _clients.clear()
+
+
+def _http_options():
+    try:
+        import httpx
+    except ImportError:  # openai 3 usa httpx2
+        import httpx2 as httpx
+
+    return {
+        'limits': httpx.Limits(
+            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.OPENAI_MAX_KEEPALIVE,
+            keepalive_expiry=settings.OPENAI_KEEPALIVE_EXPIRY,
+        ),
+        'timeout': httpx.Timeout(settings.OPENAI_TIMEOUT, connect=settings.OPENAI_CONNECT_TIMEOUT),
+    }
+
+
+def _openai():
+    from openai import DefaultHttpxClient, OpenAI
+
+    return ThrottledClient(
+        OpenAI(
+            api_key=config('OPENAI_API_KEY'),
+            base_url=settings.OPENAI_BASE_URL,
+            http_client=DefaultHttpxClient(**_http_options()),
+        ),
+        openai_bucket,
+    )
+
+
+def _async_openai():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+    return ThrottledClient(
+        AsyncOpenAI(
+            api_key=config('OPENAI_API_KEY'),
+            base_url=settings.OPENAI_BASE_URL,
+            http_client=DefaultAsyncHttpxClient(**_http_options()),
+        ),
+        openai_bucket,
+        is_async=True,
+    )
+
+
+# Cada llamada a la API toma un token del bucket compartido (ver throttle.py)
+def openai():
+    return get('openai', _openai)
+
+
+def async_openai():
+    return get('async_openai', _async_openai)
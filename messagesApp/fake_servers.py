@@ -0,0 +1,357 @@
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# SERVIDORES HTTP FALSOS DE LA API DE ASSISTANTS DE OPENAI Y DE LA API DE MENSAJES DE TWILIO,
+# PARA MEDIR EL SISTEMA SIN LLAMAR A LOS SERVICIOS REALES (ver el comando loadtest). SE
+# APUNTAN CON OPENAI_BASE_URL Y TWILIO_API_BASE_URL. SOLO IMPLEMENTAN LO QUE USA EL BOT.
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, host='127.0.0.1', port=0):
+        super().__init__((host, port), handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 para que los clientes reutilicen las conexiones como con los servicios reales
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# ---------------------------------------------------------------------------------------------
+# OPENAI
+# ---------------------------------------------------------------------------------------------
+
+def no_tools(text):
+    return []
+
+
+def default_reply(text, tool_outputs):
+    # La salida de la última herramienta, o una respuesta genérica si no se usaron herramientas
+    return tool_outputs[-1] if tool_outputs else "Entendido."
+
+
+# ESTADO DE LOS THREADS Y RUNS DEL SERVIDOR FALSO. CADA RUN SIGUE EL GUION QUE DEVUELVE
+# script(texto del último mensaje del usuario): UNA LISTA DE PASOS, CADA UNO UNA LISTA DE
+# (herramienta, argumentos) QUE EL RUN PIDE EN UN requires_action. CADA PASO DEL MODELO
+# (ANTES DE PEDIR HERRAMIENTAS Y ANTES DE RESPONDER) TARDA latency ± jitter SEGUNDOS.
+class FakeAssistants:
+    def __init__(self, latency=0.5, jitter=0.0, script=no_tools, reply=default_reply, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.script = script
+        self.reply = reply
+        self.threads = {}
+        self.runs = {}
+        self.counts = {'threads': 0, 'messages': 0, 'runs': 0, 'tool_calls': 0, 'streams': 0}
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids):08d}"
+
+    def _think_time(self):
+        with self._lock:
+            return max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+
+    def _message(self, thread_id, role, text, run_id=None, metadata=None):
+        return {
+            'id': self._id('msg'), 'object': 'thread.message', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'run_id': run_id, 'assistant_id': None, 'role': role,
+            'status': 'completed', 'attachments': [], 'metadata': metadata or {},
+            'content': [{'type': 'text', 'text': {'value': text, 'annotations': []}}],
+        }
+
+    def create_thread(self, body):
+        thread_id = self._id('thread')
+        with self._lock:
+            self.counts['threads'] += 1
+            self.threads[thread_id] = []
+        for message in body.get('messages') or []:
+            self.add_message(thread_id, message)
+        return {'id': thread_id, 'object': 'thread', 'created_at': int(time.time()), 'metadata': {}}
+
+    def add_message(self, thread_id, body):
+        content = body.get('content')
+        text = content if isinstance(content, str) else " ".join(part.get('text', '') for part in content or [])
+        message = self._message(thread_id, body.get('role', 'user'), text, metadata=body.get('metadata'))
+        with self._lock:
+            if thread_id not in self.threads:
+                return None
+            self.counts['messages'] += 1
+            self.threads[thread_id].append(message)
+        return message
+
+    def list_messages(self, thread_id, run_id=None, order='desc', limit=20):
+        with self._lock:
+            messages = list(self.threads.get(thread_id, []))
+        if run_id:
+            messages = [message for message in messages if message['run_id'] == run_id]
+        if order == 'desc':
+            messages.reverse()
+        return {'object': 'list', 'data': messages[:limit], 'has_more': len(messages) > limit}
+
+    def create_run(self, thread_id, body):
+        with self._lock:
+            messages = self.threads.get(thread_id)
+            if messages is None:
+                return None
+            last_user = next((m for m in reversed(messages) if m['role'] == 'user'), None)
+            self.counts['runs'] += 1
+        text = last_user['content'][0]['text']['value'] if last_user else ""
+        run = {
+            'id': self._id('run'), 'object': 'thread.run', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'assistant_id': body.get('assistant_id'), 'status': 'queued',
+            'required_action': None, 'usage': None, 'model': 'fake', 'instructions': '', 'tools': [],
+        }
+        state = {
+            'run': run, 'text': text, 'steps': list(self.script(text)), 'outputs': [],
+            'ready_at': time.monotonic() + self._think_time(),
+        }
+        with self._lock:
+            self.runs[run['id']] = state
+        return run
+
+    def _advance(self, state):
+        # Estado del run según el tiempo transcurrido; al completarse agrega la respuesta
+        run = state['run']
+        if run['status'] in ('completed', 'cancelled', 'requires_action'):
+            return run
+        if time.monotonic() < state['ready_at']:
+            run['status'] = 'in_progress'
+            return run
+
+        if state['steps']:
+            calls = [
+                {'id': self._id('call'), 'type': 'function', 'function': {'name': name, 'arguments': json.dumps(args)}}
+                for name, args in state['steps'][0]
+            ]
+            with self._lock:
+                self.counts['tool_calls'] += len(calls)
+            run['status'] = 'requires_action'
+            run['required_action'] = {'type': 'submit_tool_outputs', 'submit_tool_outputs': {'tool_calls': calls}}
+            return run
+
+        thread_id = run['thread_id']
+        reply = self.reply(state['text'], state['outputs'])
+        message = self._message(thread_id, 'assistant', reply, run_id=run['id'])
+        with self._lock:
+            history = self.threads.get(thread_id, [])
+            history.append(message)
+            # Aproximadamente 4 caracteres por token, como un modelo real que lee todo el thread
+            prompt_tokens = 500 + sum(len(m['content'][0]['text']['value']) for m in history) // 4
+        run['status'] = 'completed'
+        run['required_action'] = None
+        run['usage'] = {
+            'prompt_tokens': prompt_tokens, 'completion_tokens': len(reply) // 4,
+            'total_tokens': prompt_tokens + len(reply) // 4,
+        }
+        state['message'] = message
+        return run
+
+    def get_run(self, run_id):
+        with self._lock:
+            state = self.runs.get(run_id)
+        return self._advance(state) if state else None
+
+    def submit_tool_outputs(self, run_id, body):
+        with self._lock:
+            state = self.runs.get(run_id)
+        if state is None or state['run']['status'] != 'requires_action':
+            return None
+        state['outputs'].extend(output.get('output', '') for output in body.get('tool_outputs', []))
+        state['steps'].pop(0)
+        state['run']['status'] = 'queued'
+        state['run']['required_action'] = None
+        state['ready_at'] = time.monotonic() + self._think_time()
+        return state['run']
+
+    def cancel_run(self, run_id):
+        with self._lock:
+            state = self.runs.get(run_id)
+        if state is None:
+            return None
+        state['run']['status'] = 'cancelled'
+        return state['run']
+
+    # EVENTOS DEL STREAM HASTA QUE EL RUN PIDE HERRAMIENTAS O TERMINA
+    def stream_events(self, run_id):
+        with self._lock:
+            state = self.runs.get(run_id)
+            self.counts['streams'] += 1
+        run = state['run']
+        # Después de submit_tool_outputs el stream continúa el mismo run
+        yield ('thread.run.queued' if state['outputs'] else 'thread.run.created'), run
+        run['status'] = 'in_progress'
+        yield 'thread.run.in_progress', run
+        time.sleep(max(0.0, state['ready_at'] - time.monotonic()))
+        run = self._advance(state)
+        if run['status'] == 'requires_action':
+            yield 'thread.run.requires_action', run
+            return
+        message = state['message']
+        yield 'thread.message.created', message
+        yield 'thread.message.completed', message
+        yield 'thread.run.completed', run
+
+
+ROUTES = [
+    ('POST', re.compile(r"^/v1/threads$"), 'create_thread'),
+    ('POST', re.compile(r"^/v1/threads/(?P<thread_id>[^/]+)/messages$"), 'add_message'),
+    ('GET', re.compile(r"^/v1/threads/(?P<thread_id>[^/]+)/messages$"), 'list_messages'),
+    ('POST', re.compile(r"^/v1/threads/(?P<thread_id>[^/]+)/runs$"), 'create_run'),
+    ('GET', re.compile(r"^/v1/threads/[^/]+/runs/(?P<run_id>[^/]+)$"), 'get_run'),
+    ('POST', re.compile(r"^/v1/threads/[^/]+/runs/(?P<run_id>[^/]+)/submit_tool_outputs$"), 'submit_tool_outputs'),
+    ('POST', re.compile(r"^/v1/threads/[^/]+/runs/(?P<run_id>[^/]+)/cancel$"), 'cancel_run'),
+]
+
+
+class _OpenAIHandler(_Handler):
+    def _route(self, method):
+        url = urlparse(self.path)
+        body = json.loads(self._body() or b'{}') if method == 'POST' else {}
+        for route_method, pattern, name in ROUTES:
+            match = pattern.match(url.path)
+            if route_method == method and match:
+                return name, match.groupdict(), body, parse_qs(url.query)
+        return None, {}, body, {}
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        state = self.server.assistants
+        name, params, body, query = self._route(method)
+        if name is None:
+            return self._send_json(404, {'error': {'message': f"Ruta no soportada: {method} {self.path}"}})
+
+        if name == 'list_messages':
+            result = state.list_messages(
+                params['thread_id'],
+                run_id=query.get('run_id', [None])[0],
+                order=query.get('order', ['desc'])[0],
+                limit=int(query.get('limit', [20])[0]),
+            )
+        elif name == 'create_thread':
+            result = state.create_thread(body)
+        elif name == 'add_message':
+            result = state.add_message(params['thread_id'], body)
+        elif name == 'create_run':
+            result = state.create_run(params['thread_id'], body)
+        elif name == 'submit_tool_outputs':
+            result = state.submit_tool_outputs(params['run_id'], body)
+        else:
+            result = getattr(state, name)(params['run_id'])
+
+        if result is None:
+            return self._send_json(404, {'error': {'message': "No encontrado", 'type': 'invalid_request_error'}})
+        if body.get('stream'):
+            return self._stream(result['id'])
+        self._send_json(200, result)
+
+    def _stream(self, run_id):
+        # Server-sent events como los de la API real; la conexión se cierra al terminar
+        self.close_connection = True
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        for event, data in self.server.assistants.stream_events(run_id):
+            self.wfile.write(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"event: done\ndata: [DONE]\n\n")
+
+
+class FakeOpenAIServer(_Server):
+    def __init__(self, assistants=None, host='127.0.0.1', port=0):
+        super().__init__(_OpenAIHandler, host, port)
+        self.assistants = assistants or FakeAssistants()
+
+    @property
+    def base_url(self):
+        return f"{self.url}/v1"
+
+
+# ---------------------------------------------------------------------------------------------
+# TWILIO
+# ---------------------------------------------------------------------------------------------
+
+class _TwilioHandler(_Handler):
+    def do_POST(self):
+        server = self.server
+        form = parse_qs(self._body().decode())
+        if not re.match(r"^/2010-04-01/Accounts/[^/]+/Messages\.json$", urlparse(self.path).path):
+            return self._send_json(404, {'message': "Not found"})
+
+        time.sleep(server.latency)
+        with server.lock:
+            fail = server.random.random() < server.error_rate
+            if fail:
+                server.errors += 1
+        if fail:
+            return self._send_json(503, {'message': "Service unavailable"}, headers={'Retry-After': '0'})
+
+        to_number = form.get('To', [''])[0].split('whatsapp:')[-1]
+        body = form.get('Body', [''])[0]
+        delivered_at = time.monotonic()
+        with server.lock:
+            server.deliveries.append((delivered_at, to_number, body))
+        if server.on_delivery is not None:
+            server.on_delivery(to_number, body, delivered_at)
+        self._send_json(201, {'sid': f"SM{len(server.deliveries):032d}", 'to': to_number, 'status': 'queued'})
+
+
+# GUARDA CADA MENSAJE ENVIADO (monotonic, número, texto) Y LLAMA A on_delivery SI SE DEFINE.
+# CON error_rate RESPONDE 503 A ESA FRACCIÓN DE LAS PETICIONES PARA EJERCITAR LOS REINTENTOS.
+class FakeTwilioServer(_Server):
+    def __init__(self, latency=0.0, error_rate=0.0, on_delivery=None, seed=None, host='127.0.0.1', port=0):
+        super().__init__(_TwilioHandler, host, port)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.on_delivery = on_delivery
+        self.deliveries = []
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
@@ -0,0 +1,252 @@
+import logging
+import re
+import time
+import unicodedata
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import close_old_connections
+from rapidfuzz import fuzz, process
+
+from . import metrics
+from .botClass import generate_sales_report, process_product_batch, sell_product
+from .matching import inventory_index
+from .models import AuxProdUser
+from .normalization import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# INTÉRPRETE LOCAL DE LOS MENSAJES MÁS COMUNES ("vendí 2 coca 600ml a 18", "compré 12 coca
+# 600ml a 11", "reporte de la semana"). SI EL MENSAJE ENCAJA EN LA GRAMÁTICA Y EL PRODUCTO
+# SE IDENTIFICA SIN AMBIGÜEDAD, SE LLAMA A LA HERRAMIENTA DIRECTAMENTE Y NO SE USA EL ASISTENTE.
+# EN CUALQUIER OTRO CASO try_fast_path DEVUELVE None Y EL MENSAJE SIGUE AL ASISTENTE.
+
+Intent = namedtuple('Intent', ['kind', 'fields'])
+
+NUMEROS = {
+    'un': 1, 'una': 1, 'uno': 1, 'dos': 2, 'tres': 3, 'cuatro': 4, 'cinco': 5,
+    'seis': 6, 'siete': 7, 'ocho': 8, 'nueve': 9, 'diez': 10, 'doce': 12,
+}
+# "0 cocas" no es una venta ni una compra: la cantidad empieza con un dígito distinto de cero
+CANTIDAD = r"(?P<cantidad>0*[1-9]\d*|" + "|".join(NUMEROS) + r")"
+UNIDAD = r"(?P<unidad>\d+(?:[.,]\d+)?\s*(?:ml|l|lt|lts|litros?|g|gr|grs|gramos?|kg|kilos?|pz|pzs|piezas?))"
+# "a 18", "a $18", "en 18 pesos", "a 18 c/u": precio unitario. "por 36" puede ser el total y
+# se deja al asistente.
+PRECIO = r"(?:a|en)\s+\$?\s*(?P<precio>\d+(?:[.,]\d{1,2})?)(?:\s*(?:pesos|c/u|cada\s+un[oa]))?"
+PRODUCTO = r"(?P<producto>[a-z0-9 ]+?)(?:\s+(?:de\s+)?" + UNIDAD + r")?"
+
+VENTA = re.compile(
+    r"^(?:vend[ei]|vendimos|se vendio|se vendieron)\s+" + CANTIDAD + r"\s+" + PRODUCTO + r"\s+" + PRECIO + r"$"
+)
+COMPRA = re.compile(
+    r"^(?:compre|compramos|me llegaron|llegaron|surti|recibi)\s+" + CANTIDAD + r"\s+" + PRODUCTO
+    + r"(?:\s+" + PRECIO + r")?$"
+)
+REPORTE = re.compile(
+    r"^(?:dame\s+(?:el\s+)?|quiero\s+(?:el\s+)?)?(?:reporte|ventas|resumen)\s+(?:de\s+|del\s+)?"
+    r"(?:(?P<hoy>hoy|dia)|(?:la\s+|esta\s+)?(?P<semana>semana)|(?:el\s+|este\s+)?(?P<mes>mes)"
+    r"|(?:los\s+)?ultim[oa]s\s+(?P<n>\d+)\s+(?P<periodo>dias|semanas|meses))"
+    r"(?:\s+por\s+(?P<desglose>producto|categoria|dia|semana|mes))?"
+    r"(?:\s+(?:y\s+)?top\s+(?P<top>\d+))?$"
+)
+PERIODOS = {'dias': 'days', 'semanas': 'weeks', 'meses': 'months'}
+DESGLOSES = {'producto': 'product', 'categoria': 'category', 'dia': 'day', 'semana': 'week', 'mes': 'month'}
+
+STATUS = re.compile(r"\s*Status: \d{3}\b.*$")
+
+
+def _clean(text):
+    text = unicodedata.normalize('NFKD', text or '').encode('ASCII', 'ignore').decode('utf-8')
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    return text.rstrip('.!')
+
+
+def _number(value):
+    return NUMEROS.get(value) or int(value)
+
+
+def _compact_units(text):
+    # "600 ml" y "600ml" deben ser el mismo token
+    return re.sub(r"(\d)\s+(?=[a-z])", r"\1", text)
+
+
+def parse_intent(text):
+    # Varios mensajes combinados en uno (ver jobs.process_jobs) llegan separados por saltos de
+    # línea; cada línea puede ser una venta distinta, así que se dejan al asistente
+    if '\n' in (text or '').strip():
+        return None
+    text = _clean(text)
+    # Varios productos en un mensaje ("2 coca y 3 sabritas") se dejan al asistente
+    if re.search(r"\by\s+(?:\d|" + "|".join(NUMEROS) + r")\b", text):
+        return None
+
+    match = VENTA.match(text)
+    if match:
+        return Intent('sale', {
+            'cantidad': _number(match['cantidad']),
+            'producto': match['producto'],
+            'unidad': match['unidad'],
+            'precio': float(match['precio'].replace(',', '.')),
+        })
+
+    match = COMPRA.match(text)
+    if match:
+        return Intent('restock', {
+            'cantidad': _number(match['cantidad']),
+            'producto': match['producto'],
+            'unidad': match['unidad'],
+            'precio': float(match['precio'].replace(',', '.')) if match['precio'] else None,
+        })
+
+    match = REPORTE.match(text)
+    if match:
+        if match['hoy']:
+            timeframe, units = 'days', 1
+        elif match['semana']:
+            timeframe, units = 'weeks', 1
+        elif match['mes']:
+            timeframe, units = 'months', 1
+        else:
+            timeframe, units = PERIODOS[match['periodo']], int(match['n'])
+        return Intent('report', {
+            'timeframe': timeframe,
+            'units': units,
+            'breakdown': DESGLOSES.get(match['desglose']),
+            'top': int(match['top'] or 0),
+        })
+
+    return None
+
+
+# PARTE DE LAS PALABRAS DEL PRODUCTO QUE APARECEN EN EL MENSAJE
+def _coverage(query, choice):
+    words = set(query.split())
+    tokens = _compact_units(choice).split()
+    return sum(token in words for token in tokens) / len(tokens) if tokens else 0
+
+
+def _candidates(query, index):
+    candidates = process.extract(
+        query, index.names_units, scorer=fuzz.token_set_ratio, processor=_compact_units,
+        score_cutoff=settings.BOT_FAST_PATH_MIN_SCORE, limit=None,
+    )
+    return [
+        candidate for candidate in candidates
+        if _coverage(query, candidate[0]) >= settings.BOT_FAST_PATH_MIN_COVERAGE
+    ][:2]
+
+
+# EL PRODUCTO DEL INVENTARIO AL QUE SE REFIERE EL MENSAJE. token_set_ratio DA 100 CUANDO TODAS
+# LAS PALABRAS DEL MENSAJE ESTÁN EN EL NOMBRE ("coca 600ml" / "coca cola 600 ml"), AUNQUE SEA
+# UNA SOLA ("coca" / "coca cola light 2 l"). POR ESO EL MENSAJE DEBE CUBRIR UNA PARTE DE LAS
+# PALABRAS DEL PRODUCTO, EL MEJOR CANDIDATO DEBE SUPERAR CLARAMENTE AL SEGUNDO Y, SI EL USUARIO
+# TIENE VARIAS PRESENTACIONES DEL PRODUCTO, EL MENSAJE DEBE DECIR CUÁL.
+def _find_product(user, fields):
+    query = _compact_units(f"{fields['producto']} {fields['unidad'] or ''}".strip())
+    index = inventory_index.get(user, None)
+    candidates = _candidates(query, index)
+    if not candidates:
+        rebuilt = inventory_index.rebuild_after_miss(user, None, index)
+        if rebuilt is not None:
+            index = rebuilt
+            candidates = _candidates(query, index)
+    if not candidates:
+        return None, 'no_product'
+    if not fields['unidad']:
+        name = normalize_text(index.product_names[candidates[0][2]])
+        if sum(normalize_text(other) == name for other in index.product_names) > 1:
+            return None, 'ambiguous_unit'
+    if len(candidates) > 1 and candidates[0][1] - candidates[1][1] < settings.BOT_FAST_PATH_MARGIN:
+        return None, 'ambiguous_product'
+
+    aux = AuxProdUser.objects.select_related('product_aux').filter(id=index.aux_ids[candidates[0][2]]).first()
+    if aux is None:
+        return None, 'no_product'
+    return aux.product_aux, None
+
+
+def _run_intent(user, intent):
+    fields = intent.fields
+    if intent.kind == 'report':
+        return generate_sales_report(user, fields['timeframe'], fields['units'], fields['breakdown'], fields['top']), None
+
+    product, reason = _find_product(user, fields)
+    if product is None:
+        return None, reason
+
+    if intent.kind == 'sale':
+        return sell_product({
+            'productos': [{
+                'nombre': product.name,
+                'marca': product.brand or '',
+                'categoría': product.category,
+                'unidad_medida': product.amount,
+                'cantidad': fields['cantidad'],
+            }],
+            'precio_venta': fields['precio'],
+        }, user), None
+
+    output = process_product_batch({
+        'products': [{
+            'name': product.name,
+            'brand': product.brand,
+            'category': product.category,
+            'amount': product.amount,
+            'buying_price': fields['precio'] or 0,
+            'quantity': fields['cantidad'],
+        }],
+    }, user)
+    if not output.endswith("Status: 201"):
+        return output, None
+    return f"Inventario actualizado: {fields['cantidad']} x {product.name} {product.amount}.", None
+
+
+def try_fast_path(user, text):
+    if not settings.BOT_FAST_PATH:
+        return None
+
+    started = time.monotonic()
+    intent = parse_intent(text)
+    if intent is None:
+        metrics.incr('fastpath.miss')
+        metrics.incr('fastpath.miss.no_intent')
+        return None
+
+    output, reason = _run_intent(user, intent)
+    if output is None:
+        logger.debug("Fast path sin resultado para %s (%s): %s", user, intent.kind, reason)
+        metrics.incr('fastpath.miss')
+        metrics.incr(f"fastpath.miss.{reason}")
+        return None
+
+    metrics.incr('fastpath.hit')
+    metrics.incr(f"fastpath.hit.{intent.kind}")
+    metrics.observe('fastpath.latency', time.monotonic() - started)
+    logger.info("Fast path %s para %s en %.0fms", intent.kind, user, (time.monotonic() - started) * 1000)
+
+    # Las salidas de las herramientas terminan con un código de estado pensado para el asistente
+    return STATUS.sub("", output).strip()
+
+
+def try_fast_path_in_thread(user, text):
+    try:
+        return try_fast_path(user, text)
+    finally:
+        close_old_connections()
+
+
+# TASA DE ACIERTO Y AHORRO ESTIMADO: CADA ACIERTO EVITA UN RUN DEL ASISTENTE (LATENCIA MEDIANA
+# bot.total) A CAMBIO DE LA LATENCIA MEDIANA DEL FAST PATH.
+def stats(snapshot):
+    counters = snapshot['counters']
+    hits = counters.get('fastpath.hit', 0)
+    total = hits + counters.get('fastpath.miss', 0)
+    bot_p50 = snapshot['timings'].get('bot.total', {}).get('p50', 0.0)
+    fast_p50 = snapshot['timings'].get('fastpath.latency', {}).get('p50', 0.0)
+    return {
+        'hits': hits,
+        'misses': total - hits,
+        'hit_rate': hits / total if total else 0.0,
+        'llm_runs_saved': hits,
+        'estimated_seconds_saved': hits * max(0.0, bot_p50 - fast_p50),
+    }
@@ -0,0 +1,69 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import metrics
+from .models import ProcessedMessage
+
+logger = logging.getLogger(__name__)
+
+# TWILIO REENVÍA EL WEBHOOK SI LA RESPUESTA TARDA. CADA MessageSid SE REGISTRA UNA VEZ EN
+# ProcessedMessage (ÍNDICE ÚNICO) Y EN EL CACHE 'webhooks'; LOS REENVÍOS SE DESCARTAN SIN
+# VOLVER A CORRER EL BOT NI LAS HERRAMIENTAS.
+
+
+def _cache_key(sid):
+    return f"sid:{sid}"
+
+
+def _duplicate(sid):
+    logger.info("Webhook duplicado ignorado: %s", sid)
+    metrics.incr('webhook.duplicate')
+    return False
+
+
+# DEVUELVE True SI ES LA PRIMERA VEZ QUE SE RECIBE EL MENSAJE. DENTRO DE UNA TRANSACCIÓN, EL
+# REGISTRO SE CONFIRMA O SE DESHACE JUNTO CON LO DEMÁS (POR EJEMPLO, ENCOLAR EL MENSAJE).
+def first_delivery(sid):
+    if not sid:
+        return True
+    cache = caches['webhooks']
+    if cache.get(_cache_key(sid)):
+        return _duplicate(sid)
+
+    try:
+        with transaction.atomic():
+            ProcessedMessage.objects.create(sid=sid)
+    except IntegrityError:
+        cache.set(_cache_key(sid), True)
+        return _duplicate(sid)
+
+    transaction.on_commit(lambda: cache.set(_cache_key(sid), True))
+    return True
+
+
+async def afirst_delivery(sid):
+    if not sid:
+        return True
+    cache = caches['webhooks']
+    if await cache.aget(_cache_key(sid)):
+        return _duplicate(sid)
+
+    try:
+        await ProcessedMessage.objects.acreate(sid=sid)
+    except IntegrityError:
+        await cache.aset(_cache_key(sid), True)
+        return _duplicate(sid)
+
+    await cache.aset(_cache_key(sid), True)
+    return True
+
+
+def purge_processed_messages():
+    cutoff = timezone.now() - timedelta(seconds=settings.WEBHOOK_DEDUP_TTL)
+    deleted, _ = ProcessedMessage.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
@@ -0,0 +1,235 @@
+import logging
+import sys
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import OperationalError, close_old_connections
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from . import metrics
+from .models import CustomUser, MessageJob
+
+logger = logging.getLogger(__name__)
+
+
+# LA COLA DE MENSAJES VIVE EN LA BASE DE DATOS. EL WEBHOOK SOLO INSERTA UN JOB Y
+# LOS WORKERS (python manage.py run_bot_worker) LOS PROCESAN EN SEGUNDO PLANO.
+def enqueue_message(phone, body):
+    job = MessageJob.objects.create(phone=phone, body=body)
+    logger.debug("Job %s encolado para %s", job.id, phone)
+    return job
+
+
+# LOS MENSAJES QUE UN USUARIO MANDA SEGUIDOS SE JUNTAN EN UNA SOLA CORRIDA DEL BOT: UN NÚMERO
+# SOLO SE TOMA CUANDO LLEVA BOT_COALESCE_WINDOW SEGUNDOS SIN MENSAJES NUEVOS (O CUANDO SU
+# MENSAJE MÁS ANTIGUO YA ESPERÓ BOT_COALESCE_MAX_WAIT), Y SE TOMAN TODOS SUS PENDIENTES.
+# CON phone SOLO SE TOMAN LOS DE ESE NÚMERO, SIN VENTANA: EL PIPELINE ASÍNCRONO YA LA ESPERÓ.
+def claim_next_jobs(phone=None):
+    # Solo se puede tomar el job más antiguo pendiente de cada número, y solo si
+    # ese número no tiene otro job corriendo. Así los mensajes de un mismo
+    # usuario nunca se procesan fuera de orden ni en paralelo; los que llegan
+    # durante una corrida quedan pendientes para la siguiente.
+    now = timezone.now()
+    running_phones = MessageJob.objects.filter(status=MessageJob.STATUS_RUNNING).values('phone')
+    older_pending = MessageJob.objects.filter(
+        phone=OuterRef('phone'),
+        status=MessageJob.STATUS_PENDING,
+        id__lt=OuterRef('id'),
+    )
+    recent_pending = MessageJob.objects.filter(
+        phone=OuterRef('phone'),
+        status=MessageJob.STATUS_PENDING,
+        created_at__gt=now - timedelta(seconds=settings.BOT_COALESCE_WINDOW),
+    )
+
+    candidates = (
+        MessageJob.objects
+        .filter(status=MessageJob.STATUS_PENDING)
+        .filter(Q(available_at__isnull=True) | Q(available_at__lte=now))
+        .exclude(phone__in=running_phones)
+        .exclude(Exists(older_pending))
+    )
+    if phone is None:
+        candidates = candidates.filter(
+            ~Exists(recent_pending)
+            | Q(created_at__lte=now - timedelta(seconds=settings.BOT_COALESCE_MAX_WAIT))
+        )
+    else:
+        candidates = candidates.filter(phone=phone)
+
+    while True:
+        candidate = candidates.order_by('id').values_list('id', 'phone').first()
+        if candidate is None:
+            return []
+
+        # UPDATE condicional: si otro worker ganó la carrera, se intenta con el siguiente
+        job_id, phone = candidate
+        claim = {
+            'status': MessageJob.STATUS_RUNNING,
+            'started_at': timezone.now(),
+            'available_at': None,
+            'attempts': F('attempts') + 1,
+        }
+        claimed = MessageJob.objects.filter(id=job_id, status=MessageJob.STATUS_PENDING).update(**claim)
+        if claimed:
+            # Con el más antiguo en "running" ningún otro worker puede tomar los demás de ese número
+            MessageJob.objects.filter(phone=phone, status=MessageJob.STATUS_PENDING, id__gt=job_id).update(**claim)
+            return list(
+                MessageJob.objects.filter(phone=phone, status=MessageJob.STATUS_RUNNING, id__gte=job_id).order_by('id')
+            )
+
+
+# ERRORES TRANSITORIOS QUE VALE LA PENA REINTENTAR: LA API DE OPENAI NO RESPONDIÓ, LIMITÓ LA
+# TASA O FALLÓ DE SU LADO, O SE PERDIÓ LA CONEXIÓN A LA BASE DE DATOS
+def retryable(error):
+    from openai import APIConnectionError, InternalServerError, RateLimitError
+
+    return isinstance(error, (APIConnectionError, InternalServerError, RateLimitError, OperationalError))
+
+
+def process_jobs(jobs):
+    # Se importa aquí para que encolar desde el webhook no cargue el cliente de OpenAI
+    from .botClass import Bot
+    from .fastpath import try_fast_path
+    from .utils import send_message
+
+    phone = jobs[0].phone
+    ids = [job.id for job in jobs]
+    attempts = max(job.attempts for job in jobs)
+    body = "\n".join(job.body for job in jobs)
+    if len(jobs) > 1:
+        metrics.incr('jobs.coalesced', len(jobs) - 1)
+        logger.debug("Jobs %s de %s combinados en una sola corrida", ids, phone)
+
+    def record_progress(**fields):
+        MessageJob.objects.filter(id__in=ids).update(**fields)
+
+    bot = None
+    sent = False
+    try:
+        user, _ = CustomUser.objects.get_or_create(phone=str(phone))
+        # Los mensajes comunes se resuelven sin el asistente; un reintento de algo que ya llegó
+        # al asistente sigue con él
+        response = None if any(job.thread_id for job in jobs) else try_fast_path(user, body)
+        if response is not None:
+            # La herramienta del fast path ya registró la venta o la compra
+            record_progress(tools_ran=True)
+        else:
+            bot = Bot(user, on_progress=record_progress)
+            # Lo que un intento anterior ya mandó a este thread no se vuelve a mandar
+            posted = [job for job in jobs if job.thread_id and job.thread_id == bot.thread_id]
+            previous_run_id = next((job.run_id for job in reversed(posted) if job.run_id), None)
+            response = bot.run("\n".join(job.body for job in jobs if job not in posted), previous_run_id)
+        send_message(phone, response)
+        sent = True
+        # Con la respuesta ya enviada, se rota el thread si llegó a su límite
+        if bot is not None:
+            bot.rotate_if_due()
+    except Exception as e:
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        logger.error(
+            "Error processing jobs %s for %s at line %s: %s\nTraceback:\n%s",
+            ids, phone, exc_tb.tb_lineno, str(e), traceback.format_exc(),
+        )
+
+        # Si ya corrió alguna herramienta, repetir el mensaje podría registrar dos veces una venta
+        if (
+            not sent and retryable(e) and attempts < settings.BOT_JOB_MAX_ATTEMPTS
+            and not (bot is not None and bot.tools_ran)
+        ):
+            delay = settings.BOT_JOB_RETRY_BACKOFF * 2 ** (attempts - 1)
+            MessageJob.objects.filter(id__in=ids).update(
+                status=MessageJob.STATUS_PENDING,
+                error=str(e),
+                available_at=timezone.now() + timedelta(seconds=delay),
+            )
+            metrics.incr('jobs.retried')
+            logger.warning("Jobs %s for %s will be retried in %.1fs (attempt %s)", ids, phone, delay, attempts)
+            return False
+
+        MessageJob.objects.filter(id__in=ids).update(
+            status=MessageJob.STATUS_FAILED,
+            error=str(e),
+            finished_at=timezone.now(),
+        )
+        metrics.incr('jobs.failed')
+        if not sent:
+            if bot is not None:
+                # Que el run del asistente no siga corriendo sin nadie que lo atienda
+                bot.cancel_run()
+            tools_ran = bot is not None and bot.tools_ran
+            send_message(phone, settings.BOT_TOOLS_DONE_REPLY if tools_ran else settings.BOT_FAILURE_REPLY)
+        return False
+
+    MessageJob.objects.filter(id__in=ids).update(
+        status=MessageJob.STATUS_DONE,
+        finished_at=timezone.now(),
+    )
+    return True
+
+
+# JOBS QUE QUEDARON "running" PORQUE SU WORKER MURIÓ. SI ALGUNA HERRAMIENTA YA EMPEZÓ, LA VENTA
+# PUDO QUEDAR REGISTRADA: EL JOB FALLA Y SE LE AVISA AL USUARIO EN VEZ DE REPETIRLO. LOS DEMÁS
+# VUELVEN A LA COLA CON SU thread_id Y run_id, ASÍ EL REINTENTO NO VUELVE A MANDAR EL MENSAJE
+# AL THREAD Y CANCELA O APROVECHA EL RUN ANTERIOR (ver Bot.resume_run).
+def requeue_stale_jobs():
+    from .utils import send_message
+
+    cutoff = timezone.now() - timedelta(seconds=settings.BOT_JOB_STALE_SECONDS)
+    stale = MessageJob.objects.filter(status=MessageJob.STATUS_RUNNING, started_at__lt=cutoff)
+
+    tools_ran = dict(stale.filter(tools_ran=True).values_list('id', 'phone'))
+    stale.filter(id__in=tools_ran).update(
+        status=MessageJob.STATUS_FAILED, error="Stale job after its tools ran", finished_at=timezone.now(),
+    )
+    requeued = stale.filter(attempts__lt=settings.BOT_JOB_MAX_ATTEMPTS).update(status=MessageJob.STATUS_PENDING)
+    failed = stale.update(status=MessageJob.STATUS_FAILED, error="Stale job", finished_at=timezone.now())
+
+    for phone in set(tools_ran.values()):
+        send_message(phone, settings.BOT_TOOLS_DONE_REPLY)
+    if requeued or failed or tools_ran:
+        logger.warning(
+            "Stale jobs: %s requeued, %s marked as failed, %s not retried because their tools ran",
+            requeued, failed, len(tools_ran),
+        )
+    return requeued
+
+
+def purge_finished_jobs():
+    cutoff = timezone.now() - timedelta(seconds=settings.BOT_JOB_RETENTION_SECONDS)
+    deleted, _ = MessageJob.objects.filter(
+        status__in=[MessageJob.STATUS_DONE, MessageJob.STATUS_FAILED],
+        finished_at__lt=cutoff,
+    ).delete()
+    return deleted
+
+
+def publish_metrics_if_due():
+    if not metrics.report_if_due(settings.BOT_METRICS_REPORT_INTERVAL):
+        return
+    try:
+        metrics.publish()
+    except Exception as e:
+        logger.error("Error publishing metrics: %s", str(e))
+
+
+def work(stop_event, poll_interval=None):
+    # Ciclo principal de un worker: toma jobs hasta que se pida detenerse
+    poll_interval = settings.BOT_WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+    while not stop_event.is_set():
+        close_old_connections()
+        publish_metrics_if_due()
+        try:
+            jobs = claim_next_jobs()
+        except Exception as e:
+            logger.error("Error claiming job: %s", str(e))
+            jobs = []
+
+        if not jobs:
+            stop_event.wait(poll_interval)
+            continue
+
+        process_jobs(jobs)
+    close_old_connections()
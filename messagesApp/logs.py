@@ -0,0 +1,70 @@
+import logging
+import os
+import queue
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# LOGGING DE LA APLICACIÓN (ver LOGGING en settings). LOS REGISTROS SE PASAN CON ARGUMENTOS
+# ESTILO % (logger.debug("... %s", valor)) PARA QUE EL TEXTO SOLO SE ARME SI EL NIVEL ESTÁ
+# ACTIVO. BackgroundFileHandler ESCRIBE EL ARCHIVO DESDE UN HILO APARTE Y SamplingFilter
+# DEJA PASAR SOLO UNA FRACCIÓN DE LOS REGISTROS DEBUG E INFO.
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, debug_rate=1.0, info_rate=1.0):
+        super().__init__()
+        self.rates = {logging.DEBUG: float(debug_rate), logging.INFO: float(info_rate)}
+
+    def filter(self, record):
+        # WARNING y superiores siempre pasan
+        rate = self.rates.get(record.levelno, 1.0)
+        return rate >= 1.0 or random.random() < rate
+
+
+# QueueHandler QUE ENTREGA LOS REGISTROS A UN QueueListener CON UN FileHandler. EL HILO DE LA
+# PETICIÓN SOLO FORMATEA EL REGISTRO Y LO ENCOLA; LA ESCRITURA AL ARCHIVO OCURRE EN EL HILO
+# DEL LISTENER. EL LISTENER SE ARRANCA CON EL PRIMER REGISTRO DE CADA PROCESO, ASÍ QUE
+# FUNCIONA TAMBIÉN EN WORKERS CREADOS CON fork.
+class BackgroundFileHandler(QueueHandler):
+    def __init__(self, filename, encoding='utf-8', max_queue=10000):
+        super().__init__(queue.Queue(max_queue))
+        self.filename = filename
+        self.encoding = encoding
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # Tras un fork el hilo del listener no existe en el proceso hijo
+            self.queue = queue.Queue(self.queue.maxsize)
+            file_handler = logging.FileHandler(self.filename, encoding=self.encoding, delay=True)
+            self._listener = QueueListener(self.queue, file_handler, respect_handler_level=False)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def emit(self, record):
+        self._ensure_listener()
+        super().emit(record)
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Si el disco no da abasto se pierden registros en vez de frenar las peticiones
+            self.dropped += 1
+
+    # logging.shutdown LLAMA A close AL SALIR: SE ESCRIBE LO QUE QUEDE EN LA COLA
+    def close(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._pid = None
+        super().close()
@@ -0,0 +1,64 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+MODULES = [
+    'messagesApp.views',
+    'messagesApp.jobs',
+    'messagesApp.botClass',
+    'messagesApp.fastpath',
+    'messagesApp.outbound',
+]
+HEAVY = ['openai', 'httpx', 'httpx2', 'numpy', 'rapidfuzz', 'requests']
+
+# SE EJECUTA EN UN INTÉRPRETE NUEVO PARA QUE NINGÚN MÓDULO ESTÉ YA CARGADO
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+setup = time.perf_counter() - started
+started = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps({
+    'setup': setup,
+    'import': time.perf_counter() - started,
+    'loaded': [name for name in sys.argv[2:] if name in sys.modules],
+}))
+"""
+
+
+# MIDE CUÁNTO TARDA CADA PROCESO EN ARRANCAR: django.setup() Y LA IMPORTACIÓN DE CADA MÓDULO
+# DEL BOT, CADA UNO EN UN INTÉRPRETE NUEVO, Y QUÉ DEPENDENCIAS PESADAS CARGA (EL WEBHOOK Y LOS
+# WORKERS NO DEBEN CARGAR openai HASTA QUE SE USA EL CLIENTE, ver clients.py).
+class Command(BaseCommand):
+    help = "Tiempo de importación de los módulos del bot y dependencias pesadas que cargan."
+
+    def add_arguments(self, parser):
+        parser.add_argument('modules', nargs='*', default=MODULES)
+        parser.add_argument('--repeat', type=int, default=5)
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1:
+            raise CommandError("--repeat debe ser al menos 1")
+
+        self.stdout.write(f"{'módulo':<24} {'setup ms':>9} {'import ms':>10}  dependencias cargadas")
+        for module in options['modules']:
+            runs = [self._probe(module) for _ in range(options['repeat'])]
+            # El mínimo descarta el ruido del sistema de archivos y del planificador
+            setup = min(run['setup'] for run in runs) * 1000
+            elapsed = min(run['import'] for run in runs) * 1000
+            loaded = ", ".join(runs[0]['loaded']) or "-"
+            self.stdout.write(f"{module:<24} {setup:>9.1f} {elapsed:>10.1f}  {loaded}")
+
+    def _probe(self, module):
+        result = subprocess.run(
+            [sys.executable, '-c', PROBE, module, *HEAVY],
+            capture_output=True, text=True, env=os.environ.copy(),
+        )
+        if result.returncode:
+            raise CommandError(f"No se pudo importar {module}:\n{result.stderr}")
+        return json.loads(result.stdout.strip().splitlines()[-1])
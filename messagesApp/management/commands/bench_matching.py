@@ -0,0 +1,85 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from rapidfuzz import fuzz, process
+
+from messagesApp.matching import CategoryIndex, SaleItem, _match_in_index, _no_match
+from messagesApp.normalization import name_unit_key, normalize_text
+
+NAMES = [
+    "coca cola", "pepsi", "sprite", "fanta", "agua natural", "jugo de naranja", "leche entera",
+    "leche deslactosada", "yogurt fresa", "queso panela", "jamon de pavo", "salchicha", "pan blanco",
+    "pan integral", "galletas maria", "papas sabritas", "doritos nacho", "chocolate", "chicles",
+    "cereal de maiz", "avena", "salsa valentina", "mayonesa", "catsup", "atun en agua", "frijoles",
+    "arroz", "harina de trigo", "aceite vegetal", "detergente", "jabon de barra", "papel higienico",
+]
+UNITS = ["250ml", "355ml", "500ml", "600ml", "1l", "2l", "100g", "250g", "500g", "1kg", "pieza", "paquete"]
+BRANDS = ["coca cola", "pepsico", "lala", "alpura", "bimbo", "sabritas", "gamesa", "kelloggs", "nestle",
+          "herdez", "la costena", "verde valle", "maseca", "nutrioli", "ariel", "zote", "petalo"]
+
+
+# COMPARA EL MATCHING ITEM POR ITEM (extractOne + list.index) CON EL MATCHING POR LOTES
+# (process.cdist SOBRE TODO EL CARRITO) CON DATOS SINTÉTICOS EN MEMORIA.
+class Command(BaseCommand):
+    help = "Benchmark del matching difuso de ventas: ciclo por item contra process.cdist por lotes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--inventory', type=int, nargs='+', default=[500, 5000, 20000])
+        parser.add_argument('--basket', type=int, nargs='+', default=[1, 10, 50])
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        self.stdout.write(f"{'inventory':>10} {'basket':>7} {'loop ms':>10} {'batch ms':>10} {'speedup':>8}")
+
+        for inventory_size in options['inventory']:
+            index = CategoryIndex(generation=0)
+            for i in range(inventory_size):
+                name = f"{rng.choice(NAMES)} {rng.choice(['', 'light', 'sin azucar', 'original', 'familiar'])} {i}".strip()
+                index.add(i, i, name, name_unit_key(name, rng.choice(UNITS)), normalize_text(rng.choice(BRANDS)))
+
+            for basket_size in options['basket']:
+                picks = [rng.randrange(inventory_size) for _ in range(basket_size)]
+                items = [
+                    SaleItem(index.names_units[p], index.brands[p], None)
+                    for p in picks
+                ]
+
+                loop = self._best_of(options['repeat'], lambda: self._loop(index, items))
+                batch = self._best_of(options['repeat'], lambda: self._batch(index, items))
+                self.stdout.write(
+                    f"{inventory_size:>10} {basket_size:>7} {loop * 1000:>10.2f} {batch * 1000:>10.2f} {loop / batch:>7.1f}x"
+                )
+
+    @staticmethod
+    def _best_of(repeat, fn):
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - started)
+        return best
+
+    @staticmethod
+    def _loop(index, items):
+        # Algoritmo anterior de sell_product
+        results = []
+        for item in items:
+            match = process.extractOne(item.nombre_unidad, index.names_units, scorer=fuzz.token_sort_ratio)
+            if match and match[1] >= 80:
+                idx = index.names_units.index(match[0])
+                if item.marca and fuzz.token_sort_ratio(normalize_text(item.marca), index.brands[idx]) < 80:
+                    results.append(None)
+                    continue
+                results.append(index.aux_ids[idx])
+            else:
+                results.append(None)
+        return results
+
+    @staticmethod
+    def _batch(index, items):
+        results = [_no_match('no_category') for _ in items]
+        _match_in_index(index, items, list(range(len(items))), results, 80)
+        return results
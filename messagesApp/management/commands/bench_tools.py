@@ -0,0 +1,149 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from messagesApp.botClass import generate_sales_report, process_product_batch, sell_product
+from messagesApp.matching import inventory_index
+from messagesApp.models import AuxProdUser, CustomUser, DailySales, Product
+
+NAMES = [
+    "coca cola", "pepsi", "sprite", "agua natural", "leche entera", "yogurt fresa", "queso panela",
+    "jamon de pavo", "pan blanco", "galletas maria", "papas", "doritos nacho", "chocolate", "cereal",
+    "salsa valentina", "atun en agua", "frijoles", "arroz", "aceite vegetal", "detergente", "jabon",
+]
+UNITS = ["355 ml", "600 ml", "1 l", "2 l", "100 g", "250 g", "500 g", "1 kg", "pieza", "paquete"]
+BRANDS = ["Coca-Cola", "PepsiCo", "Lala", "Bimbo", "Sabritas", "Gamesa", "Herdez", "La Costeña", "Zote"]
+
+REPORTS = [
+    ('days', 1, None, 0),
+    ('weeks', 1, 'product', 5),
+    ('months', 1, 'category', 0),
+    ('months', 3, 'product', 10),
+]
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# MIDE LAS HERRAMIENTAS DEL ASISTENTE (sell_product, process_product_batch Y
+# generate_sales_report) CONTRA LA BASE DE DATOS CONFIGURADA: LATENCIA POR LLAMADA Y QUERIES.
+# CREA UNA TIENDA SINTÉTICA (O USA LA DE --user) DENTRO DE UNA TRANSACCIÓN QUE SE DESHACE AL
+# TERMINAR, ASÍ QUE NO DEJA DATOS.
+class Command(BaseCommand):
+    help = "Benchmark de las herramientas del bot: ventas, cargas de inventario y reportes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=500, help="Productos de la tienda sintética")
+        parser.add_argument('--history-days', type=int, default=90, help="Días de ventas previas para los reportes")
+        parser.add_argument('--basket', type=int, default=3, help="Productos por venta y por carga")
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--user', help="Teléfono de un usuario existente en vez de la tienda sintética")
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        if options['repeat'] < 1:
+            raise CommandError("--repeat debe ser al menos 1")
+
+        with transaction.atomic():
+            if options['user']:
+                try:
+                    user = CustomUser.objects.get(phone=options['user'])
+                except CustomUser.DoesNotExist:
+                    raise CommandError(f"No existe el usuario {options['user']}")
+            else:
+                user = self._shop(rng, options['products'], options['history_days'])
+
+            inventario = list(
+                AuxProdUser.objects.filter(user_aux=user)
+                .values_list('product_aux__name', 'product_aux__brand', 'product_aux__category', 'product_aux__amount')
+            )
+            if not inventario:
+                raise CommandError(f"{user} no tiene inventario")
+            # Se vende una unidad por producto: que nunca se acabe el inventario
+            AuxProdUser.objects.filter(user_aux=user).update(quantity=options['repeat'] * options['basket'] + 1000)
+
+            self.stdout.write(
+                f"{len(inventario)} productos en inventario, {DailySales.objects.filter(user_rollup=user).count()} "
+                f"filas de ventas diarias, canasta de {options['basket']}"
+            )
+            self.stdout.write(f"{'herramienta':<26} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+
+            basket = min(options['basket'], len(inventario))
+            self._bench("sell_product", options['repeat'], lambda: sell_product({
+                'productos': [
+                    {'nombre': name, 'marca': brand, 'categoría': category, 'unidad_medida': amount, 'cantidad': 1}
+                    for name, brand, category, amount in rng.sample(inventario, basket)
+                ],
+                'precio_venta': rng.randint(10, 50),
+            }, user))
+            self._bench("process_product_batch", options['repeat'], lambda: process_product_batch({
+                'products': [
+                    {'name': name, 'brand': brand, 'category': category, 'amount': amount,
+                     'buying_price': rng.randint(5, 30), 'quantity': rng.randint(1, 24)}
+                    for name, brand, category, amount in rng.sample(inventario, basket)
+                ],
+            }, user))
+            for timeframe, units, breakdown, top in REPORTS:
+                self._bench(
+                    f"reporte {units} {timeframe} {breakdown or ''}".strip(), options['repeat'],
+                    lambda: generate_sales_report(user, timeframe, units, breakdown, top),
+                )
+
+            transaction.set_rollback(True)
+
+        # Los índices y cachés en memoria apuntan a filas que ya no existen
+        inventory_index.clear()
+        caches['default'].clear()
+
+    def _shop(self, rng, size, history_days):
+        user = CustomUser.objects.create(phone=f"+52199{rng.randrange(10 ** 8):08d}")
+        categories = [value for value, _ in Product.CATEGORY_CHOICES]
+        products = Product.objects.bulk_create([
+            Product(
+                name=f"{rng.choice(NAMES)} bench {i}", brand=rng.choice(BRANDS),
+                category=categories[i % len(categories)], amount=rng.choice(UNITS),
+            ).with_match_keys()
+            for i in range(size)
+        ])
+        # bulk_create no devuelve los ids en todas las bases de datos
+        products = list(Product.objects.filter(name__in=[product.name for product in products]))
+        AuxProdUser.objects.bulk_create([
+            AuxProdUser(user_aux=user, product_aux=product, quantity=0, buying_price=rng.randint(5, 30))
+            for product in products
+        ])
+
+        today = timezone.localdate()
+        DailySales.objects.bulk_create([
+            DailySales(
+                user_rollup=user, product_rollup=product, day=today - timedelta(days=day),
+                quantity=quantity, revenue=quantity * rng.randint(12, 50), cost=quantity * rng.randint(5, 30),
+            )
+            for day in range(history_days)
+            for product in rng.sample(products, min(len(products), 30))
+            for quantity in [rng.randint(1, 10)]
+        ], batch_size=2000)
+        return user
+
+    def _bench(self, label, repeat, fn):
+        fn()  # Calienta los índices y cachés en memoria
+        latencies = []
+        queries = 0
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as captured:
+                started = time.perf_counter()
+                fn()
+                latencies.append(time.perf_counter() - started)
+            queries += len(captured)
+        self.stdout.write(
+            f"{label:<26} {_percentile(latencies, 0.50) * 1000:>8.2f} {_percentile(latencies, 0.95) * 1000:>8.2f} "
+            f"{_percentile(latencies, 0.99) * 1000:>8.2f} {queries / repeat:>8.1f}"
+        )
@@ -0,0 +1,94 @@
+import re
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models.functions import Lower
+from django.utils import timezone
+
+from messagesApp.models import AuxProdUser, Conversation, CustomUser, DailySales, MessageJob, Product, Transaction
+
+# "Seq Scan" en PostgreSQL y "SCAN <tabla>" sin índice en SQLite indican un recorrido completo
+SEQUENTIAL_SCAN = re.compile(r"Seq Scan|SCAN (?!.*USING (?:COVERING )?INDEX)\w+", re.IGNORECASE)
+
+
+# MUESTRA EL PLAN DE EJECUCIÓN Y EL TIEMPO DE LAS CONSULTAS DEL CAMINO CRÍTICO, Y AVISA SI
+# ALGUNA RECORRE UNA TABLA COMPLETA. CONVIENE CORRERLO CON VOLÚMENES DE DATOS REALISTAS.
+class Command(BaseCommand):
+    help = "Muestra EXPLAIN y tiempos de las consultas más frecuentes y detecta recorridos secuenciales."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Teléfono del usuario a usar (por defecto, el de la transacción más reciente)")
+        parser.add_argument('--category', default="Bebidas no alcohólicas")
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        user = self._user(options['user'])
+        category = options['category']
+        product = Product.objects.filter(auxproduser__user_aux=user).first() or Product.objects.first()
+        if product is None:
+            raise CommandError("No hay productos en la base de datos")
+
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        queries = {
+            "Transaction por (usuario, fecha)": Transaction.objects.filter(
+                user_transaction=user, time__gte=timezone.now() - timedelta(days=30)
+            ).values('quantity'),
+            "DailySales por (usuario, día)": DailySales.objects.filter(
+                user_rollup=user, day__gte=timezone.localdate() - timedelta(days=180)
+            ).values('quantity'),
+            "AuxProdUser por (usuario, producto)": AuxProdUser.objects.filter(user_aux=user, product_aux=product),
+            "AuxProdUser por lower(categoría)": AuxProdUser.objects.filter(user_aux=user).alias(
+                category_lower=Lower('product_aux__category')
+            ).filter(category_lower=category.lower()).values('id', 'product_aux__name'),
+            "Product por (nombre, marca, unidad)": Product.objects.filter(
+                name=product.name, brand=product.brand, amount=product.amount
+            ),
+            "AuxProdUser por clave normalizada": AuxProdUser.objects.filter(
+                user_aux=user, product_aux__match_key__in=[product.match_key]
+            ).values('id', 'product_aux__brand_key'),
+            "Conversation por usuario": Conversation.objects.filter(user_conversation=user),
+            "MessageJob pendientes": MessageJob.objects.filter(status=MessageJob.STATUS_PENDING).order_by('id')[:1],
+        }
+
+        sequential = []
+        for name, queryset in queries.items():
+            plan = queryset.explain()
+            elapsed = self._time(queryset, options['repeat'])
+            self.stdout.write(f"== {name}: {elapsed * 1000:.2f} ms")
+            self.stdout.write(plan)
+            if SEQUENTIAL_SCAN.search(plan):
+                sequential.append(name)
+
+        if sequential:
+            self.stdout.write(self.style.WARNING(f"Recorridos secuenciales en: {', '.join(sequential)}"))
+        else:
+            self.stdout.write(self.style.SUCCESS("Ninguna consulta recorre tablas completas"))
+
+    @staticmethod
+    def _user(phone):
+        if phone:
+            try:
+                return CustomUser.objects.get(phone=phone)
+            except CustomUser.DoesNotExist:
+                raise CommandError(f"No existe el usuario {phone}")
+        user_id = (
+            Transaction.objects.values_list('user_transaction', flat=True).order_by('-id').first()
+            or CustomUser.objects.values_list('id', flat=True).first()
+        )
+        if user_id is None:
+            raise CommandError("No hay usuarios en la base de datos")
+        return CustomUser.objects.get(id=user_id)
+
+    @staticmethod
+    def _time(queryset, repeat):
+        best = float('inf')
+        for _ in range(repeat):
+            started = time.perf_counter()
+            list(queryset.all())
+            best = min(best, time.perf_counter() - started)
+        return best
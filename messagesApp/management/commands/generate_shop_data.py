@@ -0,0 +1,406 @@
+import itertools
+import random
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from messagesApp.models import AuxProdUser, CustomUser, DailySales, Product, Transaction
+
+# CATÁLOGO BASE POR CATEGORÍA: (NOMBRES, MARCAS, PRESENTACIONES). LOS PRODUCTOS SON
+# COMBINACIONES DE NOMBRE + VARIANTE, MARCA Y PRESENTACIÓN, COMO LOS QUE MANDAN LOS TENDEROS.
+CATALOG = {
+    "Lácteos": (
+        ["Leche entera", "Leche deslactosada", "Leche light", "Yogurt bebible", "Yogurt griego", "Queso panela",
+         "Queso oaxaca", "Crema ácida", "Mantequilla", "Queso manchego"],
+        ["Lala", "Alpura", "Santa Clara", "Danone", "Yoplait", "Nestlé", "Chilchota", "Esmeralda"],
+        ["250 ml", "500 ml", "1 l", "1.5 l", "200 g", "400 g", "1 kg"],
+    ),
+    "Carnes y embutidos": (
+        ["Jamón de pavo", "Jamón de pierna", "Salchicha de pavo", "Salchicha viena", "Chorizo", "Tocino",
+         "Salami", "Mortadela", "Pechuga de pavo"],
+        ["FUD", "San Rafael", "Zwan", "Kir", "Bafar", "Parma", "Capistrano"],
+        ["250 g", "500 g", "1 kg", "paquete"],
+    ),
+    "Panadería": (
+        ["Pan blanco", "Pan integral", "Medias noches", "Bolillo", "Tortillinas", "Mantecadas", "Donas",
+         "Conchas", "Roles de canela", "Pan tostado"],
+        ["Bimbo", "Wonder", "Marinela", "Tía Rosa", "Oroweat", "Suandy"],
+        ["pieza", "paquete", "210 g", "680 g", "1 kg"],
+    ),
+    "Frutas": (
+        ["Plátano", "Manzana", "Naranja", "Limón", "Papaya", "Sandía", "Mango", "Uva", "Pera", "Piña"],
+        ["Granel", "Del Monte", "Chiquita", "Rancho", "Huerta"],
+        ["pieza", "500 g", "1 kg", "bolsa"],
+    ),
+    "Verduras": (
+        ["Jitomate", "Cebolla", "Papa", "Chile serrano", "Chile jalapeño", "Zanahoria", "Calabaza", "Lechuga",
+         "Aguacate", "Pepino"],
+        ["Granel", "Rancho", "Huerta", "Del Campo"],
+        ["pieza", "250 g", "500 g", "1 kg"],
+    ),
+    "Bebidas no alcohólicas": (
+        ["Coca Cola", "Refresco de naranja", "Refresco de limón", "Agua natural", "Agua mineral", "Jugo de naranja",
+         "Jugo de manzana", "Té helado", "Refresco de toronja", "Agua de jamaica"],
+        ["Coca-Cola", "PepsiCo", "Jarritos", "Peñafiel", "Ciel", "Bonafont", "Jumex", "Del Valle", "Boing"],
+        ["355 ml", "500 ml", "600 ml", "1 l", "1.5 l", "2 l", "3 l"],
+    ),
+    "Bebidas alcohólicas": (
+        ["Cerveza clara", "Cerveza oscura", "Cerveza lager", "Tequila", "Mezcal", "Ron", "Brandy", "Vodka"],
+        ["Corona", "Victoria", "Modelo", "Tecate", "Indio", "Cuervo", "Bacardi", "Presidente"],
+        ["355 ml", "473 ml", "940 ml", "750 ml", "1 l", "six pack"],
+    ),
+    "Botanas": (
+        ["Papas fritas", "Doritos nacho", "Cheetos", "Churrumais", "Cacahuates japoneses", "Palomitas",
+         "Chicharrones", "Ruffles", "Tostitos", "Rancheritos"],
+        ["Sabritas", "Barcel", "Mafer", "Act II", "Totis", "Leo"],
+        ["30 g", "45 g", "62 g", "110 g", "170 g", "240 g"],
+    ),
+    "Dulces": (
+        ["Chocolate con leche", "Paleta de caramelo", "Chicles de menta", "Gomitas", "Mazapán", "Galletas marías",
+         "Galletas de chocolate", "Pulparindo", "Bombones", "Obleas"],
+        ["Gamesa", "Nestlé", "Hershey's", "De la Rosa", "Ricolino", "Vero", "Trident", "Carlos V"],
+        ["pieza", "28 g", "50 g", "100 g", "170 g", "bolsa"],
+    ),
+    "Cereales": (
+        ["Hojuelas de maíz", "Cereal de chocolate", "Avena", "Granola", "Cereal integral", "Cereal de miel",
+         "Arroz inflado", "Cereal de fibra"],
+        ["Kellogg's", "Nestlé", "Quaker", "Great Value", "Nature Valley", "Fitness"],
+        ["300 g", "500 g", "640 g", "1 kg"],
+    ),
+    "Salsas y condimentos": (
+        ["Salsa picante", "Catsup", "Mayonesa", "Mostaza", "Salsa inglesa", "Salsa de soya", "Consomé de pollo",
+         "Vinagre blanco", "Salsa verde", "Chipotle adobado"],
+        ["Valentina", "Herdez", "McCormick", "La Costeña", "Heinz", "Knorr", "Búfalo", "Clemente Jacques"],
+        ["100 g", "190 g", "390 g", "500 ml", "1 l", "cubo"],
+    ),
+    "Especias": (
+        ["Pimienta negra", "Comino", "Orégano", "Canela", "Clavo", "Ajo en polvo", "Laurel", "Chile en polvo"],
+        ["McCormick", "La Anita", "Badia", "Granel", "El Guapo"],
+        ["sobre", "25 g", "50 g", "100 g"],
+    ),
+    "Enlatados": (
+        ["Atún en agua", "Atún en aceite", "Frijoles bayos", "Frijoles negros", "Elote amarillo", "Chiles en vinagre",
+         "Sardinas en tomate", "Duraznos en almíbar", "Champiñones", "Verduras mixtas"],
+        ["Dolores", "Tuny", "La Costeña", "Herdez", "Del Monte", "Calmex", "San Marcos"],
+        ["140 g", "220 g", "340 g", "425 g", "560 g", "800 g"],
+    ),
+    "Pastas": (
+        ["Spaghetti", "Fideo", "Codito", "Macarrón", "Letras", "Estrellas", "Lasaña", "Tallarín", "Sopa instantánea"],
+        ["La Moderna", "Barilla", "Yemina", "Maruchan", "Nissin", "Great Value"],
+        ["64 g", "200 g", "500 g", "1 kg"],
+    ),
+    "Arroz y granos": (
+        ["Arroz blanco", "Arroz integral", "Frijol negro", "Frijol pinto", "Lenteja", "Garbanzo", "Haba", "Alubia"],
+        ["Verde Valle", "Schettino", "Sos", "Granel", "Great Value"],
+        ["500 g", "900 g", "1 kg", "5 kg"],
+    ),
+    "Harinas": (
+        ["Harina de trigo", "Harina de maíz", "Harina para hot cakes", "Maicena", "Harina integral", "Polvo para hornear"],
+        ["Maseca", "Tres Estrellas", "Selecta", "Gamesa", "Royal", "Minsa"],
+        ["500 g", "800 g", "1 kg", "2 kg"],
+    ),
+    "Aceites": (
+        ["Aceite vegetal", "Aceite de canola", "Aceite de oliva", "Aceite de maíz", "Manteca vegetal", "Aceite en aerosol"],
+        ["Nutrioli", "Capullo", "1-2-3", "Carbonell", "Mazola", "Inca"],
+        ["500 ml", "850 ml", "1 l", "946 ml", "1 kg"],
+    ),
+    "Congelados": (
+        ["Helado de vainilla", "Helado de chocolate", "Paleta de hielo", "Nuggets de pollo", "Papas a la francesa",
+         "Pizza congelada", "Verduras congeladas", "Hielo"],
+        ["Holanda", "Nestlé", "Bachoco", "McCain", "Great Value", "Bonafont"],
+        ["pieza", "500 ml", "1 l", "1 kg", "bolsa"],
+    ),
+    "Bebés": (
+        ["Pañales etapa 3", "Pañales etapa 4", "Toallitas húmedas", "Fórmula infantil", "Papilla de manzana",
+         "Shampoo para bebé", "Aceite para bebé"],
+        ["Huggies", "KleenBebé", "Pampers", "Nan", "Enfamil", "Gerber", "Johnson's"],
+        ["pieza", "paquete", "113 g", "400 g", "200 ml"],
+    ),
+    "Higiene personal": (
+        ["Shampoo", "Acondicionador", "Jabón de tocador", "Pasta dental", "Desodorante", "Cepillo dental",
+         "Rastrillo", "Crema corporal"],
+        ["Head & Shoulders", "Pantene", "Palmolive", "Colgate", "Rexona", "Dove", "Gillette", "Nivea"],
+        ["pieza", "100 ml", "150 g", "400 ml", "750 ml"],
+    ),
+    "Limpieza": (
+        ["Detergente en polvo", "Jabón de barra", "Cloro", "Limpiador multiusos", "Suavizante", "Lavatrastes",
+         "Fibra", "Desengrasante"],
+        ["Ariel", "Zote", "Cloralex", "Fabuloso", "Pinol", "Suavitel", "Salvo", "Roma"],
+        ["pieza", "400 g", "500 ml", "1 kg", "1 l", "2 l"],
+    ),
+    "Papel y desechables": (
+        ["Papel higiénico", "Servilletas", "Toallas de papel", "Platos desechables", "Vasos desechables",
+         "Bolsas para basura", "Pañuelos"],
+        ["Pétalo", "Regio", "Kleenex", "Sanitas", "Jaguar", "Great Value"],
+        ["pieza", "4 piezas", "12 piezas", "paquete", "rollo"],
+    ),
+    "Cuidado femenino": (
+        ["Toallas femeninas", "Protectores diarios", "Tampones", "Toallas nocturnas"],
+        ["Saba", "Kotex", "Always", "Naturella", "Tampax"],
+        ["10 piezas", "14 piezas", "paquete", "40 piezas"],
+    ),
+    "Mascotas": (
+        ["Croquetas para perro", "Croquetas para gato", "Alimento húmedo para gato", "Arena para gato",
+         "Premios para perro"],
+        ["Pedigree", "Whiskas", "Purina", "Dog Chow", "Minino", "Ganador"],
+        ["85 g", "1 kg", "2 kg", "4 kg", "bolsa"],
+    ),
+    "Farmacia": (
+        ["Paracetamol", "Ibuprofeno", "Antiácido", "Suero oral", "Alcohol", "Curitas", "Vaporub", "Pastillas para la tos"],
+        ["Tempra", "Advil", "Alka-Seltzer", "Electrolit", "Sal de Uvas", "Vick", "Genérico"],
+        ["pieza", "10 tabletas", "20 tabletas", "625 ml", "250 ml"],
+    ),
+    "Café y té": (
+        ["Café soluble", "Café molido", "Café de olla", "Té de manzanilla", "Té verde", "Chocolate en polvo",
+         "Sustituto de crema"],
+        ["Nescafé", "Legal", "Café Combate", "Los Portales", "McCormick", "Abuelita", "Coffee-mate"],
+        ["sobre", "25 piezas", "100 g", "200 g", "400 g"],
+    ),
+    "Azúcar y endulzantes": (
+        ["Azúcar estándar", "Azúcar refinada", "Azúcar morena", "Endulzante", "Miel de abeja", "Piloncillo"],
+        ["Zulka", "Great Value", "Splenda", "Canderel", "Carlota", "Granel"],
+        ["sobre", "250 g", "500 g", "1 kg", "2 kg"],
+    ),
+    "Energéticas": (
+        ["Bebida energética", "Bebida energética zero", "Bebida isotónica", "Bebida hidratante"],
+        ["Red Bull", "Monster", "Vive 100", "Boost", "Gatorade", "Powerade", "Electrolit"],
+        ["237 ml", "355 ml", "473 ml", "500 ml", "625 ml", "1 l"],
+    ),
+    "Importados": (
+        ["Galletas danesas", "Chocolate suizo", "Pasta italiana", "Salsa de soya japonesa", "Ramen coreano",
+         "Aceitunas españolas"],
+        ["Kjeldsens", "Lindt", "De Cecco", "Kikkoman", "Nongshim", "La Española"],
+        ["120 g", "250 g", "340 g", "500 g", "1 kg"],
+    ),
+    "Festivos": (
+        ["Rosca de reyes", "Pan de muerto", "Bacalao", "Ponche en lata", "Piñata", "Velas", "Esferas navideñas"],
+        ["Bimbo", "El Globo", "La Costeña", "Granel", "Artesanal"],
+        ["pieza", "paquete", "500 g", "1 kg"],
+    ),
+    "Otros": (
+        ["Pilas AA", "Pilas AAA", "Encendedor", "Cerillos", "Foco LED", "Cinta adhesiva", "Recarga telefónica"],
+        ["Duracell", "Energizer", "Bic", "Clásicos", "Philips", "Scotch", "Telcel"],
+        ["pieza", "2 piezas", "4 piezas", "paquete"],
+    ),
+}
+
+VARIANTS = ["", "light", "sin azúcar", "original", "familiar", "chico", "grande", "clásico", "extra",
+            "natural", "picante", "sabor fresa", "sabor vainilla", "edición especial", "premium", "económico"]
+# PAQUETES DE VARIAS PIEZAS ("6 x 355 ml"); SOLO COMPLETAN LAS CATEGORÍAS CON POCAS COMBINACIONES
+PACKS = ["2 x", "3 x", "4 x", "6 x", "12 x"]
+SINGLE_SHARE = 0.7
+
+# HORAS DE VENTA DE UNA TIENDITA: MÁS VENTAS EN LA MAÑANA Y EN LA TARDE
+HOURS = list(range(7, 23))
+HOUR_WEIGHTS = list(itertools.accumulate([3, 5, 6, 5, 4, 5, 6, 5, 4, 5, 6, 7, 7, 6, 4, 2]))
+
+
+def _popular(rng, size, exponent=2.0):
+    # Índice sesgado hacia el inicio: unos pocos productos se venden (y se surten) mucho más
+    return min(size - 1, int(size * rng.random() ** exponent))
+
+
+# LLENA LA BASE DE DATOS CON UNA TIENDA A ESCALA PARA MEDIR EL MATCHING Y LOS REPORTES:
+# CATÁLOGO DE PRODUCTOS EN TODAS LAS CATEGORÍAS, USUARIOS CON SU INVENTARIO Y UN HISTORIAL
+# DE TRANSACCIONES CON SU RESUMEN DIARIO (DailySales). TODO SE INSERTA EN LOTES Y
+# SALE IGUAL CON LA MISMA --seed Y --end, ASÍ QUE LOS BENCHMARKS SE PUEDEN COMPARAR.
+# LOS USUARIOS TIENEN TELÉFONOS CON --prefix; USAR SOLO CON UNA BASE DE DATOS DE DESARROLLO.
+class Command(BaseCommand):
+    help = "Genera datos sintéticos reproducibles: productos, usuarios, inventario y transacciones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--products', type=int, default=100000)
+        parser.add_argument('--stock', type=int, default=300, help="Productos en inventario por usuario (promedio)")
+        parser.add_argument('--transactions', type=int, default=2000000)
+        parser.add_argument('--days', type=int, default=365, help="Días de historial de ventas")
+        parser.add_argument('--end', help="Último día del historial, YYYY-MM-DD (por defecto, hoy)")
+        parser.add_argument('--prefix', default="+52188", help="Prefijo de los teléfonos de los usuarios generados")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--clear', action='store_true', help="Borra antes los usuarios generados con --prefix")
+
+    def handle(self, *args, **options):
+        try:
+            self.end = date.fromisoformat(options['end']) if options['end'] else timezone.localdate()
+        except ValueError:
+            raise CommandError("--end debe tener el formato YYYY-MM-DD")
+        if options['users'] < 1 or options['products'] < 1 or options['days'] < 1:
+            raise CommandError("--users, --products y --days deben ser al menos 1")
+
+        generated = CustomUser.objects.filter(phone__startswith=options['prefix'])
+        if options['clear']:
+            deleted, _ = generated.delete()
+            self.stdout.write(f"{deleted} filas generadas antes eliminadas")
+        elif generated.exists():
+            raise CommandError(f"Ya hay usuarios con el prefijo {options['prefix']}; usa --clear para reemplazarlos")
+
+        rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        started = time.monotonic()
+
+        products = self._products(rng, options['products'])
+        self.stdout.write(f"Catálogo: {len(products)} productos ({time.monotonic() - started:.1f}s)")
+
+        users = self._users(options['prefix'], options['users'])
+        self.stdout.write(f"Usuarios: {len(users)} ({time.monotonic() - started:.1f}s)")
+
+        stock = self._stock(rng, users, products, options['stock'])
+        self.stdout.write(
+            f"Inventario: {sum(len(rows) for rows in stock.values())} filas ({time.monotonic() - started:.1f}s)"
+        )
+
+        transactions, rollup = self._transactions(rng, users, stock, options['transactions'], options['days'])
+        self.stdout.write(
+            f"Transacciones: {transactions}, ventas diarias: {rollup} ({time.monotonic() - started:.1f}s)"
+        )
+
+    # Cada categoría aporta la misma parte del catálogo
+    def _products(self, rng, size):
+        categories = [value for value, _ in Product.CATEGORY_CHOICES]
+        per_category, extra = divmod(size, len(categories))
+
+        catalog = []
+        seen = set()
+        for i, category in enumerate(categories):
+            names, brands, units = CATALOG[category]
+            wanted = per_category + (1 if i < extra else 0)
+            # Un nombre con variante puede repetir otro nombre del catálogo: cada clave se usa una vez
+            singles = [
+                key for key in dict.fromkeys(
+                    (f"{name} {variant}".strip(), brand, unit)
+                    for name, variant, brand, unit in itertools.product(names, VARIANTS, brands, units)
+                )
+                if key not in seen
+            ]
+            packs = [
+                (name, brand, f"{pack} {unit}") for name, brand, unit in singles for pack in PACKS
+                if (name, brand, f"{pack} {unit}") not in seen
+            ]
+            if wanted > len(singles) + len(packs):
+                raise CommandError(f"La categoría {category} solo tiene {len(singles) + len(packs)} combinaciones")
+            chosen = rng.sample(singles, min(len(singles), round(wanted * SINGLE_SHARE)))
+            chosen += rng.sample(packs, wanted - len(chosen))
+            seen.update(chosen)
+            for name, brand, unit in chosen:
+                catalog.append(Product(name=name, brand=brand, category=category, amount=unit).with_match_keys())
+
+        # Los productos que ya existen se conservan: el catálogo es compartido entre usuarios
+        for start in range(0, len(catalog), self.batch_size):
+            Product.objects.bulk_create(catalog[start:start + self.batch_size], ignore_conflicts=True)
+
+        ids = {
+            (name, brand, amount): product_id
+            for product_id, name, brand, amount in Product.objects.values_list('id', 'name', 'brand', 'amount')
+        }
+        # El orden del catálogo define qué productos son populares, así que se mezcla con la semilla
+        rng.shuffle(catalog)
+        return [ids[(product.name, product.brand, product.amount)] for product in catalog]
+
+    def _users(self, prefix, count):
+        phones = [f"{prefix}{i:07d}" for i in range(count)]
+        if len(phones[-1]) > CustomUser._meta.get_field('phone').max_length:
+            raise CommandError(f"El prefijo {prefix} es demasiado largo")
+        password = make_password(None)
+        CustomUser.objects.bulk_create(
+            [CustomUser(phone=phone, password=password) for phone in phones],
+            batch_size=self.batch_size,
+        )
+        return list(CustomUser.objects.filter(phone__startswith=prefix).order_by('phone').values_list('id', flat=True))
+
+    # Con millones de filas, armar instancias del modelo y compilar cada bulk_create tarda más
+    # que la propia base de datos: las tablas grandes se llenan con executemany de tuplas
+    def _insert(self, model, fields, rows):
+        if not rows:
+            return 0
+        quote = connection.ops.quote_name
+        columns = ", ".join(quote(model._meta.get_field(field).column) for field in fields)
+        sql = f"INSERT INTO {quote(model._meta.db_table)} ({columns}) VALUES ({', '.join(['%s'] * len(fields))})"
+        # Un lote por transacción: en autocommit cada fila sería un commit
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(sql, rows)
+        return len(rows)
+
+    # INVENTARIO: CADA TIENDA TIENE ENTRE --stock/2 Y 3*--stock/2 PRODUCTOS, CON MÁS PROBABILIDAD
+    # LOS POPULARES. DEVUELVE {usuario: [(producto, precio de compra), ...]} DEL MÁS AL MENOS POPULAR.
+    def _stock(self, rng, users, products, average):
+        fields = ['user_aux', 'product_aux', 'quantity', 'buying_price']
+        stock = {}
+        rows = []
+        for user_id in users:
+            wanted = min(len(products), rng.randint(max(1, average // 2), max(1, average * 3 // 2)))
+            chosen = set()
+            while len(chosen) < wanted:
+                chosen.add(_popular(rng, len(products)))
+
+            stock[user_id] = []
+            for index in sorted(chosen):
+                buying_price = round(rng.uniform(5, 120), 2)
+                quantity = rng.choice([0, 1, 2, 3]) if rng.random() < 0.1 else rng.randint(4, 200)
+                stock[user_id].append((products[index], buying_price))
+                rows.append((user_id, products[index], quantity, buying_price))
+            if len(rows) >= self.batch_size:
+                self._insert(AuxProdUser, fields, rows)
+                rows = []
+        self._insert(AuxProdUser, fields, rows)
+        return stock
+
+    # TRANSACCIONES: LAS TIENDAS GRANDES VENDEN MÁS (EL REPARTO ENTRE USUARIOS ES SESGADO) Y CADA
+    # VENTA CAE EN UN DÍA DEL HISTORIAL Y EN UNA HORA DE TIENDA. EL RESUMEN DIARIO SE CALCULA AL
+    # MISMO TIEMPO, COMO LO HACE actualizar_ventas_diarias, EN VEZ DE RECORRER LAS TRANSACCIONES
+    # DE NUEVO CON rebuild_sales_rollup.
+    def _transactions(self, rng, users, stock, total, days):
+        fields = ['product_transaction', 'quantity', 'user_transaction', 'buying_price_unitario',
+                  'selling_price_unitario', 'time']
+        rollup_fields = ['user_rollup', 'product_rollup', 'day', 'quantity', 'revenue', 'cost']
+        adapt_datetime = connection.ops.adapt_datetimefield_value
+        adapt_date = connection.ops.adapt_datefield_value
+        weights = [rng.paretovariate(1.5) for _ in users]
+        scale = total / sum(weights)
+        tz = timezone.get_current_timezone()
+        calendar = [self.end - timedelta(days=day) for day in range(days)]
+
+        created = rollup_rows = 0
+        rows = []
+        rollup = []
+        remaining = total
+        for position, user_id in enumerate(users):
+            count = remaining if position == len(users) - 1 else min(remaining, round(weights[position] * scale))
+            remaining -= count
+            products = stock[user_id]
+            daily = defaultdict(lambda: [0, 0.0, 0.0])
+
+            for _ in range(count):
+                product_id, buying_price = products[_popular(rng, len(products))]
+                quantity = rng.choice((1, 1, 1, 2, 2, 3, 4, 6))
+                selling_price = round(buying_price * rng.uniform(1.1, 1.6), 2)
+                day = calendar[rng.randrange(days)]
+                hour = rng.choices(HOURS, cum_weights=HOUR_WEIGHTS)[0]
+                moment = datetime(day.year, day.month, day.day, hour, rng.randrange(60), rng.randrange(60), tzinfo=tz)
+                rows.append((product_id, quantity, user_id, buying_price, selling_price, adapt_datetime(moment)))
+                total_day = daily[(product_id, day)]
+                total_day[0] += quantity
+                total_day[1] += selling_price * quantity
+                total_day[2] += buying_price * quantity
+
+                if len(rows) >= self.batch_size:
+                    created += self._insert(Transaction, fields, rows)
+                    rows = []
+
+            rollup.extend(
+                (user_id, product_id, adapt_date(day), quantity, revenue, cost)
+                for (product_id, day), (quantity, revenue, cost) in daily.items()
+            )
+            if len(rollup) >= self.batch_size:
+                rollup_rows += self._insert(DailySales, rollup_fields, rollup)
+                rollup = []
+            if position % 100 == 99:
+                self.stdout.write(f"  {position + 1}/{len(users)} usuarios, {created + len(rows)} transacciones")
+        created += self._insert(Transaction, fields, rows)
+        rollup_rows += self._insert(DailySales, rollup_fields, rollup)
+        return created, rollup_rows
@@ -0,0 +1,462 @@
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import override_settings
+
+from messagesApp import clients, metrics, outbound
+from messagesApp.fake_servers import FakeAssistants, FakeOpenAIServer, FakeTwilioServer
+from messagesApp.jobs import work
+from messagesApp.models import AuxProdUser, CustomUser, MessageJob, ProcessedMessage, Product
+
+LOADTEST_PREFIX = "+5210000"
+SID_PREFIX = "SMloadtest"
+
+# LA PRUEBA ESCRIBE EN LA BASE DE DATOS CONFIGURADA: SIN --i-know-this-is-not-prod SOLO CORRE SI
+# EL NOMBRE DE LA BASE DICE QUE ES DE PRUEBA O DE DESARROLLO
+SAFE_DATABASE = re.compile(r"test|dev|loadtest", re.IGNORECASE)
+
+CATALOG = [
+    ("Coca Cola", "Coca-Cola", "Bebidas no alcohólicas", "600 ml"),
+    ("Pepsi", "PepsiCo", "Bebidas no alcohólicas", "600 ml"),
+    ("Agua Natural", "Ciel", "Bebidas no alcohólicas", "1 l"),
+    ("Leche Entera", "Lala", "Lácteos", "1 l"),
+    ("Yogurt Fresa", "Danone", "Lácteos", "1 kg"),
+    ("Pan Blanco", "Bimbo", "Panadería", "680 g"),
+    ("Papas Sabritas", "Sabritas", "Botanas", "45 g"),
+    ("Doritos Nacho", "Sabritas", "Botanas", "62 g"),
+    ("Galletas Marías", "Gamesa", "Dulces", "170 g"),
+    ("Atún en Agua", "Dolores", "Enlatados", "140 g"),
+    ("Frijoles Bayos", "La Costeña", "Enlatados", "560 g"),
+    ("Arroz", "Verde Valle", "Arroz y granos", "1 kg"),
+    ("Aceite Vegetal", "Nutrioli", "Aceites", "850 ml"),
+    ("Papel Higiénico", "Pétalo", "Papel y desechables", "4 piezas"),
+    ("Jabón de Barra", "Zote", "Limpieza", "400 g"),
+]
+
+# TIPOS DE MENSAJE DEL TRÁFICO SINTÉTICO: (tipo, peso). venta_rapida Y reporte_rapido LOS
+# RESUELVE EL FAST PATH; LOS DEMÁS PASAN POR EL ASISTENTE FALSO CON EL GUION DE HERRAMIENTAS
+# CORRESPONDIENTE.
+MIX = [
+    ('venta_rapida', 35),
+    ('venta_asistente', 25),
+    ('reporte_rapido', 10),
+    ('reporte_asistente', 10),
+    ('inventario', 10),
+    ('charla', 10),
+]
+
+TAG = re.compile(r"#(\d+)")
+
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+# CUENTA LAS QUERIES DE TODAS LAS CONEXIONES, SEPARADAS POR ETIQUETA: LOS HILOS QUE ENVÍAN
+# WEBHOOKS SE MARCAN COMO 'webhook' Y TODO LO DEMÁS (WORKERS, ENVÍOS) CUENTA COMO 'worker'.
+class QueryCounter:
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.local = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, execute, sql, params, many, context):
+        label = getattr(self.local, 'label', 'worker')
+        with self._lock:
+            self.counts[label] += 1
+        return execute(sql, params, many, context)
+
+    def _install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def start(self):
+        connection_created.connect(self._install)
+        for connection in connections.all(initialized_only=True):
+            self._install(None, connection)
+
+    def stop(self):
+        connection_created.disconnect(self._install)
+        for connection in connections.all(initialized_only=True):
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+# REPRODUCE TRÁFICO DE WEBHOOKS DE TWILIO A UNA TASA FIJA CONTRA /message/ Y MIDE EL SISTEMA
+# DE PUNTA A PUNTA CON SERVIDORES FALSOS DE OPENAI Y TWILIO: EL WEBHOOK Y LOS WORKERS CORREN
+# EN ESTE PROCESO (PIPELINE 'queue'). CON --url LOS WEBHOOKS SE ENVÍAN A UN SERVIDOR YA
+# LEVANTADO CUYOS WORKERS DEBEN APUNTAR A LOS SERVIDORES FALSOS (--openai-port, --twilio-port).
+# CREA USUARIOS DE PRUEBA CON TELÉFONO +5210000... Y LOS PRODUCTOS DEL CATÁLOGO QUE FALTEN;
+# CON --cleanup SE BORRA TODO ESO AL TERMINAR.
+class Command(BaseCommand):
+    help = "Prueba de carga del webhook y los workers con servidores falsos de OpenAI y Twilio."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, default=10.0, help="Mensajes por segundo")
+        parser.add_argument('--duration', type=float, default=30.0, help="Segundos de tráfico")
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--workers', type=int, default=settings.BOT_WORKER_CONCURRENCY)
+        parser.add_argument('--senders', type=int, default=32, help="Hilos que envían webhooks")
+        parser.add_argument('--replay', help="Archivo JSONL con {\"phone\", \"body\"} a reproducir en orden")
+        parser.add_argument('--openai-latency', type=float, default=0.8)
+        parser.add_argument('--openai-jitter', type=float, default=0.3)
+        parser.add_argument('--twilio-latency', type=float, default=0.05)
+        parser.add_argument('--twilio-error-rate', type=float, default=0.0)
+        parser.add_argument('--streaming', choices=['on', 'off'], help="Por defecto, BOT_RUN_STREAMING")
+        parser.add_argument('--drain-timeout', type=float, default=60.0)
+        parser.add_argument('--url', help="URL de un webhook externo en vez del proceso actual")
+        parser.add_argument('--openai-port', type=int, default=0)
+        parser.add_argument('--twilio-port', type=int, default=0)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument(
+            '--cleanup', action='store_true',
+            help="Borra al terminar los usuarios, jobs y productos que creó la prueba",
+        )
+        parser.add_argument(
+            '--i-know-this-is-not-prod', action='store_true',
+            help="Corre aunque el nombre de la base de datos no parezca de prueba o de desarrollo",
+        )
+
+    def handle(self, *args, **options):
+        database = str(connections['default'].settings_dict['NAME'])
+        if not SAFE_DATABASE.search(os.path.basename(database)) and not options['i_know_this_is_not_prod']:
+            raise CommandError(
+                f"La base de datos '{database}' no parece de prueba ni de desarrollo; "
+                "usa --i-know-this-is-not-prod si de verdad no es la de producción"
+            )
+
+        self.rng = random.Random(options['seed'])
+        self.created_products = []
+        self.scripts = {}
+        self.unexpected = 0
+        self.lock = threading.Lock()
+
+        assistants = FakeAssistants(
+            latency=options['openai_latency'], jitter=options['openai_jitter'],
+            script=self._script, seed=options['seed'],
+        )
+        openai_server = FakeOpenAIServer(assistants, port=options['openai_port']).start()
+        twilio_server = FakeTwilioServer(
+            latency=options['twilio_latency'], error_rate=options['twilio_error_rate'],
+            seed=options['seed'], port=options['twilio_port'],
+        ).start()
+        self.stdout.write(f"OpenAI falso: {openai_server.base_url}  Twilio falso: {twilio_server.url}")
+
+        # Credenciales de mentira para los clientes; los servidores falsos no las revisan
+        for name, value in (('OPENAI_API_KEY', 'sk-loadtest'), ('TWILIO_ACCOUNT_SID', 'ACloadtest'),
+                            ('TWILIO_AUTH_TOKEN', 'loadtest'), ('TWILIO_NUMBER', '+10000000000')):
+            os.environ.setdefault(name, value)
+
+        overrides = {
+            'OPENAI_BASE_URL': openai_server.base_url,
+            'TWILIO_API_BASE_URL': twilio_server.url,
+            'ALLOWED_HOSTS': ['*'],
+            # Sin esperas artificiales: los mensajes que llegan durante una corrida se siguen juntando
+            'BOT_COALESCE_WINDOW': 0.0,
+            'BOT_COALESCE_MAX_WAIT': 0.0,
+            'WHATSAPP_MAX_LENGTH': 100000,
+            'OUTBOUND_BACKOFF': 0.05,
+        }
+        if options['streaming']:
+            overrides['BOT_RUN_STREAMING'] = options['streaming'] == 'on'
+
+        try:
+            with override_settings(**overrides):
+                clients.reset()
+                metrics.reset()
+                phones = self._users(options['users'])
+                messages = self._traffic(options, phones)
+
+                first_job = MessageJob.objects.order_by('-id').values_list('id', flat=True).first() or 0
+                jobs = MessageJob.objects.filter(id__gt=first_job, phone__startswith=LOADTEST_PREFIX)
+                started = time.monotonic()
+                if options['url']:
+                    report = self._run_external(options, messages, jobs, twilio_server)
+                else:
+                    report = self._run_local(options, messages, jobs, twilio_server)
+                report['elapsed'] = time.monotonic() - started
+
+                report['end_to_end'] = self._end_to_end(jobs, list(twilio_server.deliveries))
+                statuses = dict(jobs.order_by().values_list('status').annotate(total=Count('id')))
+                report['jobs'] = sum(statuses.values())
+                report['jobs_failed'] = statuses.get(MessageJob.STATUS_FAILED, 0)
+                report['jobs_pending'] = statuses.get(MessageJob.STATUS_PENDING, 0) + statuses.get(MessageJob.STATUS_RUNNING, 0)
+            self._report(options, report, assistants, twilio_server)
+        finally:
+            openai_server.stop()
+            twilio_server.stop()
+            clients.reset()
+            if options['cleanup']:
+                self._cleanup()
+
+    # ---- datos y tráfico -------------------------------------------------------------------
+
+    def _users(self, count):
+        phones = [f"{LOADTEST_PREFIX}{i:05d}" for i in range(count)]
+        existing = set(CustomUser.objects.filter(phone__in=phones).values_list('phone', flat=True))
+        CustomUser.objects.bulk_create([CustomUser(phone=phone) for phone in phones if phone not in existing])
+
+        products = []
+        for name, brand, category, amount in CATALOG:
+            product, created = Product.objects.get_or_create(
+                name=name, brand=brand, amount=amount, defaults={'category': category}
+            )
+            products.append(product)
+            if created:
+                self.created_products.append(product.id)
+        users = CustomUser.objects.filter(phone__in=phones)
+        AuxProdUser.objects.bulk_create(
+            [
+                AuxProdUser(user_aux=user, product_aux=product, quantity=100000, buying_price=10)
+                for user in users for product in products
+            ],
+            ignore_conflicts=True,
+        )
+        AuxProdUser.objects.filter(user_aux__in=users).update(quantity=100000)
+        return phones
+
+    def _cleanup(self):
+        # Con los usuarios se borran en cascada su inventario, ventas y conversaciones
+        CustomUser.objects.filter(phone__startswith=LOADTEST_PREFIX).delete()
+        MessageJob.objects.filter(phone__startswith=LOADTEST_PREFIX).delete()
+        ProcessedMessage.objects.filter(sid__startswith=SID_PREFIX).delete()
+        # Los productos del catálogo que creó esta corrida, si ningún otro usuario los usa
+        Product.objects.filter(
+            id__in=self.created_products, auxproduser=None, transaction=None, dailysales=None
+        ).delete()
+
+    def _traffic(self, options, phones):
+        if options['replay']:
+            try:
+                with open(options['replay']) as replay:
+                    return [json.loads(line) for line in replay if line.strip()]
+            except (OSError, ValueError) as e:
+                raise CommandError(f"No se pudo leer {options['replay']}: {e}")
+
+        kinds = [kind for kind, _ in MIX]
+        weights = [weight for _, weight in MIX]
+        total = int(options['rate'] * options['duration'])
+        messages = []
+        for i in range(total):
+            # Los usuarios se recorren en orden para que un mismo número no reciba ráfagas
+            phone = phones[i % len(phones)]
+            kind = self.rng.choices(kinds, weights)[0]
+            messages.append({'phone': phone, 'body': self._body(kind, i), 'kind': kind})
+        return messages
+
+    def _body(self, kind, i):
+        name, brand, category, amount = self.rng.choice(CATALOG)
+        quantity = self.rng.randint(1, 5)
+        if kind == 'venta_rapida':
+            return f"vendí {quantity} {name.lower()} {amount} a {self.rng.randint(12, 40)}"
+        if kind == 'reporte_rapido':
+            return self.rng.choice(["reporte de la semana", "reporte de hoy", "ventas del mes por producto"])
+
+        # Los mensajes para el asistente llevan una marca #i que el OpenAI falso usa para su guion
+        if kind == 'venta_asistente':
+            steps = [[("vender_producto", {
+                'products': [{'nombre': name, 'marca': brand, 'categoría': category,
+                              'unidad_medida': amount, 'cantidad': quantity}],
+                'selling_price': self.rng.randint(12, 40),
+            })]]
+            body = f"oye me compraron {quantity} de {name.lower()} hace rato #{i}"
+        elif kind == 'reporte_asistente':
+            steps = [[("generar_reporte_ventas", {'timeframe': 'weeks', 'units': 2, 'breakdown': 'category', 'top': 3})]]
+            body = f"¿cómo me fue estas dos semanas? #{i}"
+        elif kind == 'inventario':
+            steps = [[("mandar_productos_inventario", {'products': [{
+                'name': name, 'brand': brand, 'category': category, 'amount': amount,
+                'buying_price': self.rng.randint(8, 30), 'quantity': self.rng.randint(6, 24),
+            }]})]]
+            body = f"me llegó mercancía de {name.lower()} #{i}"
+        else:
+            steps = []
+            body = f"hola, ¿qué me recomiendas vender más? #{i}"
+        self.scripts[str(i)] = steps
+        return body
+
+    def _script(self, text):
+        match = TAG.search(text)
+        return self.scripts.get(match.group(1), []) if match else []
+
+    # ---- medición ---------------------------------------------------------------------------
+
+    def _schedule(self, options, messages, send):
+        interval = 1.0 / options['rate'] if options['rate'] > 0 else 0.0
+        webhook = []
+        errors = defaultdict(int)
+        started = time.monotonic()
+
+        def fire(i, message):
+            time.sleep(max(0.0, started + i * interval - time.monotonic()))
+            sent_at = time.monotonic()
+            try:
+                status = send(message, f"{SID_PREFIX}{options['seed']:04d}{i:022d}")
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.monotonic() - sent_at
+            with self.lock:
+                webhook.append(elapsed)
+                if status != 200:
+                    errors[str(status)] += 1
+
+        with ThreadPoolExecutor(options['senders'], thread_name_prefix='loadtest-sender') as pool:
+            for i, message in enumerate(messages):
+                pool.submit(fire, i, message)
+        return {'sent': len(messages), 'sent_seconds': time.monotonic() - started, 'webhook': webhook,
+                'http_errors': dict(errors)}
+
+    def _drain(self, options, jobs, twilio_server):
+        # Espera a que los workers terminen los jobs y a que dejen de llegar respuestas
+        deadline = time.monotonic() + options['drain_timeout']
+        active = [MessageJob.STATUS_PENDING, MessageJob.STATUS_RUNNING]
+        while time.monotonic() < deadline and jobs.filter(status__in=active).exists():
+            time.sleep(0.2)
+        delivered = -1
+        while time.monotonic() < deadline and delivered != len(twilio_server.deliveries):
+            delivered = len(twilio_server.deliveries)
+            time.sleep(0.5)
+
+    # LOS WORKERS JUNTAN LOS MENSAJES PENDIENTES DE UN NÚMERO EN UNA SOLA CORRIDA (LOS JOBS DE
+    # UN LOTE COMPARTEN started_at) Y MANDAN UNA SOLA RESPUESTA. COMO LOS LOTES DE UN NÚMERO
+    # CORREN UNO TRAS OTRO, CADA RESPUESTA ES DEL ÚLTIMO LOTE QUE EMPEZÓ ANTES DE ELLA. LA
+    # LATENCIA DE PUNTA A PUNTA DE CADA MENSAJE VA DE QUE SE ENCOLÓ SU JOB A QUE TWILIO RECIBIÓ
+    # LA RESPUESTA DE SU LOTE.
+    def _end_to_end(self, jobs, deliveries):
+        batches = defaultdict(lambda: defaultdict(list))
+        for phone, started_at, created_at in jobs.exclude(started_at=None).values_list('phone', 'started_at', 'created_at'):
+            batches[phone][started_at.timestamp()].append(created_at.timestamp())
+
+        # Las entregas se registran con time.monotonic()
+        offset = time.time() - time.monotonic()
+        answered = {}
+        for delivered_at, phone, body in deliveries:
+            delivered_at += offset
+            started = [start for start in batches.get(phone, ()) if start <= delivered_at]
+            if not started:
+                self.unexpected += 1
+                continue
+            # Una respuesta larga se manda en varias partes: cuenta la primera
+            answered.setdefault((phone, max(started)), delivered_at)
+
+        latencies = []
+        for (phone, start), delivered_at in answered.items():
+            latencies.extend(delivered_at - created_at for created_at in batches[phone][start])
+        return latencies
+
+    def _run_local(self, options, messages, jobs, twilio_server):
+        counter = QueryCounter()
+        counter.local.label = 'loadtest'
+        stop_event = threading.Event()
+        workers = [
+            threading.Thread(target=work, args=(stop_event, 0.05), name=f"loadtest-worker-{i}", daemon=True)
+            for i in range(max(1, options['workers']))
+        ]
+        local = threading.local()
+
+        def send(message, sid):
+            counter.local.label = 'webhook'
+            client = getattr(local, 'client', None)
+            if client is None:
+                client = local.client = Client()
+            response = client.post('/message/', {
+                'From': f"whatsapp:{message['phone']}", 'Body': message['body'], 'MessageSid': sid,
+            })
+            close_old_connections()
+            return response.status_code
+
+        counter.start()
+        for worker in workers:
+            worker.start()
+        try:
+            report = self._schedule(options, messages, send)
+            self._drain(options, jobs, twilio_server)
+        finally:
+            stop_event.set()
+            for worker in workers:
+                worker.join(timeout=settings.BOT_RUN_DEADLINE_SECONDS)
+            outbound.flush(timeout=settings.OUTBOUND_TIMEOUT)
+            counter.stop()
+        report['queries'] = dict(counter.counts)
+        return report
+
+    def _run_external(self, options, messages, jobs, twilio_server):
+        import requests
+
+        session = requests.Session()
+
+        def send(message, sid):
+            response = session.post(options['url'], data={
+                'From': f"whatsapp:{message['phone']}", 'Body': message['body'], 'MessageSid': sid,
+            }, timeout=30)
+            return response.status_code
+
+        report = self._schedule(options, messages, send)
+        self._drain(options, jobs, twilio_server)
+        return report
+
+    # ---- reporte ----------------------------------------------------------------------------
+
+    def _latencies(self, label, values):
+        return (
+            f"{label:<14} p50={_percentile(values, 0.50) * 1000:8.1f}ms p95={_percentile(values, 0.95) * 1000:8.1f}ms "
+            f"p99={_percentile(values, 0.99) * 1000:8.1f}ms max={max(values, default=0) * 1000:8.1f}ms n={len(values)}"
+        )
+
+    def _report(self, options, report, assistants, twilio_server):
+        sent = report['sent']
+        answered = len(report['end_to_end'])
+        unanswered = report['jobs'] - answered
+        http_errors = sum(report['http_errors'].values())
+        counters = metrics.snapshot()['counters']
+
+        self.stdout.write("")
+        self.stdout.write(
+            f"Mensajes: {sent} en {report['sent_seconds']:.1f}s "
+            f"({sent / report['sent_seconds'] if report['sent_seconds'] else 0:.1f}/s, objetivo {options['rate']:.1f}/s)"
+        )
+        self.stdout.write(
+            f"Respondidos: {answered} en {report['elapsed']:.1f}s ({answered / report['elapsed']:.1f}/s), "
+            f"{counters.get('jobs.coalesced', 0)} juntados con otro mensaje"
+        )
+        self.stdout.write(self._latencies("Webhook", report['webhook']))
+        self.stdout.write(self._latencies("Punta a punta", report['end_to_end']))
+
+        queries = report.get('queries')
+        if queries is not None:
+            self.stdout.write(
+                f"Queries por mensaje: webhook {queries.get('webhook', 0) / max(sent, 1):.1f}, "
+                f"workers {queries.get('worker', 0) / max(sent, 1):.1f}"
+            )
+        self.stdout.write(
+            f"Errores: HTTP {http_errors} ({http_errors / max(sent, 1):.1%}) {report['http_errors'] or ''}, "
+            f"sin respuesta {unanswered} ({unanswered / max(report['jobs'], 1):.1%}), "
+            f"jobs fallidos {report['jobs_failed']}, pendientes {report['jobs_pending']}, "
+            f"respuestas sin job {self.unexpected}"
+        )
+        self.stdout.write(
+            f"Twilio: {len(twilio_server.deliveries)} entregas, {twilio_server.errors} errores inyectados, "
+            f"{counters.get('outbound.retries', 0)} reintentos, {counters.get('outbound.failed', 0)} fallidas"
+        )
+        self.stdout.write(f"OpenAI falso: {assistants.counts}")
+        hits = counters.get('fastpath.hit', 0)
+        misses = counters.get('fastpath.miss', 0)
+        if hits + misses:
+            self.stdout.write(f"Fast path: {hits}/{hits + misses} ({hits / (hits + misses):.0%})")
+        if counters.get('bot.shed'):
+            self.stdout.write(f"Mensajes rechazados por carga: {counters['bot.shed']}")
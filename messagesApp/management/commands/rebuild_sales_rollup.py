@@ -0,0 +1,71 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, FloatField, Sum
+from django.db.models.functions import TruncDate
+
+from messagesApp.models import CustomUser, DailySales, Transaction
+
+
+class Command(BaseCommand):
+    help = "Reconstruye el resumen diario de ventas (DailySales) a partir de las transacciones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', help="Teléfono del usuario a reconstruir (por defecto, todos)")
+        parser.add_argument('--since', help="Primer día a reconstruir, YYYY-MM-DD (por defecto, todo el historial)")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        transactions = Transaction.objects.filter(user_transaction__isnull=False).annotate(day=TruncDate('time'))
+        rollup = DailySales.objects.all()
+
+        if options['user']:
+            try:
+                user = CustomUser.objects.get(phone=options['user'])
+            except CustomUser.DoesNotExist:
+                raise CommandError(f"No existe el usuario {options['user']}")
+            transactions = transactions.filter(user_transaction=user)
+            rollup = rollup.filter(user_rollup=user)
+
+        if options['since']:
+            try:
+                since = date.fromisoformat(options['since'])
+            except ValueError:
+                raise CommandError("--since debe tener el formato YYYY-MM-DD")
+            transactions = transactions.filter(day__gte=since)
+            rollup = rollup.filter(day__gte=since)
+
+        grupos = (
+            transactions
+            .values('user_transaction_id', 'product_transaction_id', 'day')
+            .annotate(
+                unidades=Sum('quantity'),
+                ingresos=Sum(F('selling_price_unitario') * F('quantity'), output_field=FloatField()),
+                costo=Sum(F('buying_price_unitario') * F('quantity'), output_field=FloatField()),
+            )
+            .order_by()
+        )
+
+        creados = 0
+        with transaction.atomic():
+            borrados, _ = rollup.delete()
+            filas = []
+            for grupo in grupos.iterator():
+                filas.append(DailySales(
+                    user_rollup_id=grupo['user_transaction_id'],
+                    product_rollup_id=grupo['product_transaction_id'],
+                    day=grupo['day'],
+                    quantity=grupo['unidades'],
+                    revenue=grupo['ingresos'],
+                    cost=grupo['costo'],
+                ))
+                if len(filas) >= options['batch_size']:
+                    DailySales.objects.bulk_create(filas)
+                    creados += len(filas)
+                    filas = []
+            if filas:
+                DailySales.objects.bulk_create(filas)
+                creados += len(filas)
+
+        self.stdout.write(f"Resumen diario reconstruido: {borrados} filas eliminadas, {creados} filas creadas")
@@ -0,0 +1,78 @@
+import logging
+import multiprocessing
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from messagesApp import outbound
+from messagesApp.idempotency import purge_processed_messages
+from messagesApp.jobs import purge_finished_jobs, requeue_stale_jobs, work
+
+logger = logging.getLogger(__name__)
+
+
+def _process_main(poll_interval):
+    # Cada proceso hijo ignora SIGINT; el padre se encarga de terminarlo
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+    work(stop_event, poll_interval)
+    outbound.flush(timeout=settings.OUTBOUND_TIMEOUT)
+
+
+class Command(BaseCommand):
+    help = "Procesa en segundo plano los mensajes de WhatsApp encolados por el webhook."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=settings.BOT_WORKER_CONCURRENCY)
+        parser.add_argument('--mode', choices=['threads', 'processes'], default=settings.BOT_WORKER_MODE)
+        parser.add_argument('--poll-interval', type=float, default=settings.BOT_WORKER_POLL_INTERVAL)
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        mode = options['mode']
+        poll_interval = options['poll_interval']
+
+        requeue_stale_jobs()
+        purge_finished_jobs()
+        purge_processed_messages()
+
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *args: stop_event.set())
+
+        self.stdout.write(f"Starting {concurrency} bot workers ({mode})")
+        logger.info("Starting %s bot workers (%s)", concurrency, mode)
+
+        if mode == 'processes':
+            # Las conexiones abiertas no deben heredarse a los procesos hijos
+            connections.close_all()
+            workers = [
+                multiprocessing.Process(target=_process_main, args=(poll_interval,), daemon=True)
+                for _ in range(concurrency)
+            ]
+        else:
+            workers = [
+                threading.Thread(target=work, args=(stop_event, poll_interval), daemon=True)
+                for _ in range(concurrency)
+            ]
+
+        for worker in workers:
+            worker.start()
+
+        # Mantenimiento periódico mientras los workers trabajan
+        while not stop_event.wait(settings.BOT_JOB_STALE_SECONDS):
+            requeue_stale_jobs()
+            purge_finished_jobs()
+            purge_processed_messages()
+
+        self.stdout.write("Stopping bot workers")
+        for worker in workers:
+            if mode == 'processes':
+                worker.terminate()
+            worker.join(timeout=settings.BOT_JOB_STALE_SECONDS)
+        # Las respuestas que quedaron en la cola de envío se entregan antes de salir
+        outbound.flush(timeout=settings.OUTBOUND_TIMEOUT)
@@ -0,0 +1,351 @@
+import bisect
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models.functions import Lower
+from rapidfuzz import fuzz, process
+
+from .models import AuxProdUser
+from .search import get_search_backend
+
+try:
+    import numpy as np
+except ImportError:  # process.cdist necesita numpy; sin él se usa extractOne item por item
+    np = None
+
+logger = logging.getLogger(__name__)
+
+# Una marca más corta que esto ("c", "co") solo coincide completa, no como prefijo
+MIN_BRAND_PREFIX = 3
+
+
+# ÍNDICE DE LOS PRODUCTOS QUE UN USUARIO TIENE EN UNA CATEGORÍA, CON LOS TEXTOS YA
+# NORMALIZADOS. LAS LISTAS SON PARALELAS: LA POSICIÓN i DESCRIBE EL MISMO AuxProdUser.
+class CategoryIndex:
+    def __init__(self, generation):
+        self.generation = generation
+        self.built_at = time.monotonic()
+        self.names_units = []
+        self.brands = []
+        self.aux_ids = []
+        self.product_ids = []
+        self.product_names = []
+        self._aux_set = set()
+
+    # match_key Y brand_key SON LOS VALORES YA NORMALIZADOS QUE GUARDA Product
+    def add(self, aux_id, product_id, name, match_key, brand_key):
+        if aux_id in self._aux_set:
+            return
+        self._aux_set.add(aux_id)
+        self.names_units.append(match_key)
+        self.brands.append(brand_key)
+        self.aux_ids.append(aux_id)
+        self.product_ids.append(product_id)
+        self.product_names.append(name)
+
+    def remove(self, aux_id):
+        if aux_id not in self._aux_set:
+            return
+        self._aux_set.discard(aux_id)
+        idx = self.aux_ids.index(aux_id)
+        for values in (self.names_units, self.brands, self.aux_ids, self.product_ids, self.product_names):
+            del values[idx]
+
+    def __len__(self):
+        return len(self.aux_ids)
+
+
+# LRU DE ÍNDICES POR (USUARIO, CATEGORÍA). CUANDO EL INVENTARIO DE UN USUARIO CAMBIA, SE
+# PARCHEAN LOS ÍNDICES LOCALES Y SE INCREMENTA SU GENERACIÓN EN EL CACHE 'default', DE MODO
+# QUE LOS DEMÁS PROCESOS (SI EL CACHE ES COMPARTIDO) RECONSTRUYEN EL SUYO. CON EL LocMemCache
+# POR DEFECTO LOS OTROS PROCESOS NO SE ENTERAN, ASÍ QUE UN ITEM QUE NO SE ENCUENTRA EN UN ÍNDICE
+# CON MÁS DE miss_refresh SEGUNDOS TAMBIÉN LO RECONSTRUYE (ver rebuild_after_miss).
+class InventoryIndex:
+    def __init__(self, max_entries, ttl, miss_refresh):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.miss_refresh = miss_refresh
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    # category=None ES EL ÍNDICE DE TODO EL INVENTARIO DEL USUARIO
+    @staticmethod
+    def _key(user_id, category):
+        return (user_id, (category or '').lower())
+
+    @staticmethod
+    def _generation(user_id):
+        return caches['default'].get(f"inventory_gen:{user_id}", 0)
+
+    @staticmethod
+    def _bump_generation(user_id):
+        cache = caches['default']
+        key = f"inventory_gen:{user_id}"
+        try:
+            return cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+            return 1
+
+    def get(self, user, category):
+        key = self._key(user.id, category)
+        generation = self._generation(user.id)
+        with self._lock:
+            index = self._entries.get(key)
+            if index is not None:
+                fresh = index.generation == generation and time.monotonic() - index.built_at < self.ttl
+                if fresh:
+                    self._entries.move_to_end(key)
+                    return index
+                del self._entries[key]
+
+        return self._store(key, self._build(user, category, generation))
+
+    # UN PRODUCTO QUE NO ESTÁ EN EL ÍNDICE PUDO HABERLO AGREGADO OTRO PROCESO. DEVUELVE EL
+    # ÍNDICE RECONSTRUIDO, O None SI index ES RECIENTE Y NO VALE LA PENA VOLVER A LEERLO.
+    def rebuild_after_miss(self, user, category, index):
+        if time.monotonic() - index.built_at < self.miss_refresh:
+            return None
+        index = self._build(user, category, self._generation(user.id))
+        return self._store(self._key(user.id, category), index)
+
+    def _store(self, key, index):
+        with self._lock:
+            self._entries[key] = index
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return index
+
+    def _build(self, user, category, generation):
+        index = CategoryIndex(generation)
+        rows = AuxProdUser.objects.filter(user_aux=user)
+        if category:
+            # lower(category) usa el índice product_category_lower_idx (iexact no lo usaría)
+            rows = rows.alias(category_lower=Lower('product_aux__category')).filter(category_lower=category.lower())
+        rows = rows.values_list(
+            'id', 'product_aux_id', 'product_aux__name', 'product_aux__match_key', 'product_aux__brand_key'
+        )
+        for aux_id, product_id, name, match_key, brand_key in rows:
+            index.add(aux_id, product_id, name, match_key, brand_key)
+        logger.debug("Índice construido para usuario %s, categoría '%s': %s productos", user.id, category, len(index))
+        return index
+
+    def _patch(self, user_id, apply):
+        generation = self._bump_generation(user_id)
+        with self._lock:
+            for (entry_user_id, category), index in self._entries.items():
+                if entry_user_id == user_id:
+                    apply(category, index)
+                    index.generation = generation
+
+    def add_product(self, user_id, product, aux_id):
+        category = (product.category or '').lower()
+
+        def apply(entry_category, index):
+            if entry_category in (category, ''):
+                index.add(aux_id, product.id, product.name, product.match_key, product.brand_key)
+
+        self._patch(user_id, apply)
+
+    def remove_aux(self, user_id, aux_ids):
+        aux_ids = set(aux_ids)
+
+        def apply(entry_category, index):
+            for aux_id in aux_ids:
+                index.remove(aux_id)
+
+        self._patch(user_id, apply)
+
+    def invalidate_user(self, user_id):
+        self._bump_generation(user_id)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+inventory_index = InventoryIndex(
+    max_entries=settings.PRODUCT_INDEX_MAX_ENTRIES,
+    ttl=settings.PRODUCT_INDEX_TTL,
+    miss_refresh=settings.PRODUCT_INDEX_MISS_REFRESH,
+)
+
+
+# RESULTADO DEL MATCHING DE UN ITEM. reason ES 'no_category', 'no_match' O 'brand' CUANDO
+# NO HUBO COINCIDENCIA (EN ESE ORDEN DE PRIORIDAD PARA EL MENSAJE AL USUARIO).
+ItemMatch = namedtuple('ItemMatch', ['aux_id', 'product_id', 'product_name', 'score', 'reason'])
+SaleItem = namedtuple('SaleItem', ['nombre_unidad', 'marca', 'categoria'])
+
+_REASON_PRIORITY = {'no_category': 0, 'no_match': 1, 'brand': 2}
+
+
+def _no_match(reason):
+    return ItemMatch(None, None, None, 0, reason)
+
+
+def _score_rows(queries, choices, threshold):
+    # Los hilos de cdist solo compensan su costo con matrices grandes
+    workers = settings.PRODUCT_MATCH_WORKERS if len(queries) * len(choices) >= 50000 else 1
+    return process.cdist(
+        queries, choices,
+        scorer=fuzz.token_sort_ratio,
+        score_cutoff=threshold,
+        dtype=np.uint8,
+        workers=workers,
+    )
+
+
+def _match_in_index(index, items, positions, results, threshold):
+    if not len(index):
+        return
+    # Con un solo item extractOne es más rápido: poda con el mejor puntaje encontrado
+    if np is None or len(positions) == 1:
+        return _match_in_index_loop(index, items, positions, results, threshold)
+
+    # Una sola pasada por el lote: nombres contra nombres, y marcas solo contra los productos
+    # cuyo nombre ya superó el umbral para algún item
+    name_scores = _score_rows([items[i].nombre_unidad for i in positions], index.names_units, threshold)
+    columns = np.unique(np.nonzero(name_scores >= threshold)[1])
+    if columns.size:
+        brand_scores = _score_rows(
+            [items[i].marca for i in positions], [index.brands[c] for c in columns], threshold
+        )
+
+    for row, i in enumerate(positions):
+        if not columns.size:
+            _set_reason(results, i, 'no_match')
+            continue
+
+        names = name_scores[row, columns]
+        # Solo cuentan los productos cuya marca también coincide
+        combined = np.where(brand_scores[row] >= threshold, names, 0) if items[i].marca else names
+        best = int(combined.argmax())
+
+        if combined[best] >= threshold:
+            column = int(columns[best])
+            results[i] = ItemMatch(
+                index.aux_ids[column], index.product_ids[column], index.product_names[column], int(combined[best]), None
+            )
+        else:
+            _set_reason(results, i, 'brand' if names.max() >= threshold else 'no_match')
+
+
+def _match_in_index_loop(index, items, positions, results, threshold):
+    for i in positions:
+        item = items[i]
+        match = process.extractOne(
+            item.nombre_unidad, index.names_units, scorer=fuzz.token_sort_ratio, score_cutoff=threshold
+        )
+        candidates = [match] if match else []
+        if match and item.marca and fuzz.token_sort_ratio(item.marca, index.brands[match[2]]) < threshold:
+            # Todos los nombres sobre el umbral, de mejor a peor, para elegir el primero con marca similar
+            candidates = process.extract(
+                item.nombre_unidad, index.names_units, scorer=fuzz.token_sort_ratio, score_cutoff=threshold, limit=None
+            )
+
+        if not candidates:
+            _set_reason(results, i, 'no_match')
+            continue
+
+        for _, score, idx in candidates:
+            if not item.marca or fuzz.token_sort_ratio(item.marca, index.brands[idx]) >= threshold:
+                results[i] = ItemMatch(index.aux_ids[idx], index.product_ids[idx], index.product_names[idx], int(score), None)
+                break
+        else:
+            _set_reason(results, i, 'brand')
+
+
+def _set_reason(results, i, reason):
+    if _REASON_PRIORITY[reason] > _REASON_PRIORITY[results[i].reason]:
+        results[i] = _no_match(reason)
+
+
+# COINCIDENCIAS EXACTAS CON LAS CLAVES NORMALIZADAS QUE GUARDA Product, EN UNA SOLA QUERY
+# INDEXADA. LA MARCA PUEDE SER SOLO EL INICIO DE LA GUARDADA ("coca" / "cocacola"): POR CADA
+# CLAVE LAS FILAS SE ORDENAN POR MARCA Y bisect DA LA PRIMERA QUE EMPIEZA CON LA DEL ITEM; LA
+# MARCA EXACTA, SI EXISTE, ES ESA PRIMERA. LOS ITEMS QUE NO COINCIDEN PASAN AL MATCHING DIFUSO.
+def _match_exact(user, items, results):
+    rows = AuxProdUser.objects.filter(
+        user_aux=user, product_aux__match_key__in={item.nombre_unidad for item in items}
+    ).values_list(
+        'id', 'product_aux_id', 'product_aux__name', 'product_aux__match_key', 'product_aux__brand_key',
+        'product_aux__category',
+    ).order_by('id')
+
+    candidates = defaultdict(list)
+    for row in rows:
+        candidates[row[3]].append(row)
+    # sorted es estable: entre filas de la misma marca se conserva el orden por id
+    by_brand = {key: sorted(group, key=lambda row: row[4]) for key, group in candidates.items()}
+    brand_keys = {key: [row[4] for row in group] for key, group in by_brand.items()}
+
+    for i, item in enumerate(items):
+        group = candidates.get(item.nombre_unidad, [])
+        if item.marca:
+            if len(item.marca) < MIN_BRAND_PREFIX:
+                group = [row for row in group if row[4] == item.marca]
+            elif group:
+                start = bisect.bisect_left(brand_keys[item.nombre_unidad], item.marca)
+                group = itertools.takewhile(
+                    lambda row: row[4].startswith(item.marca), by_brand[item.nombre_unidad][start:]
+                )
+        category = (item.categoria or '').lower()
+        for aux_id, product_id, name, _, brand_key, product_category in group:
+            if product_category.lower() != category and not settings.PRODUCT_MATCH_ANY_CATEGORY:
+                continue
+            results[i] = ItemMatch(aux_id, product_id, name, 100, None)
+            break
+
+
+# ÍNDICE CON SOLO LOS PRODUCTOS DEL INVENTARIO QUE EL BACKEND DE BÚSQUEDA PROPONE COMO
+# PARECIDOS A LOS ITEMS, PARA NO RECORRER TODO EL INVENTARIO DEL USUARIO.
+def _search_index(user, items, positions):
+    index = CategoryIndex(generation=None)
+    candidates = get_search_backend().search(
+        [items[i].nombre_unidad for i in positions], settings.PRODUCT_SEARCH_LIMIT, user=user
+    )
+    product_ids = {product_id for ids in candidates.values() for product_id in ids}
+    if product_ids:
+        rows = AuxProdUser.objects.filter(user_aux=user, product_aux_id__in=product_ids).values_list(
+            'id', 'product_aux_id', 'product_aux__name', 'product_aux__match_key', 'product_aux__brand_key'
+        )
+        for aux_id, product_id, name, match_key, brand_key in rows:
+            index.add(aux_id, product_id, name, match_key, brand_key)
+    return index
+
+
+# MATCHING DE TODOS LOS ITEMS DE UNA VENTA A LA VEZ. PRIMERO POR CLAVE EXACTA, LUEGO EN LA
+# CATEGORÍA QUE INDICÓ EL ASISTENTE Y, PARA LOS QUE NO COINCIDIERON, ENTRE LOS CANDIDATOS
+# DEL BACKEND DE BÚSQUEDA EN TODO EL INVENTARIO.
+def match_items(user, items, threshold=80):
+    results = [_no_match('no_category') for _ in items]
+    _match_exact(user, items, results)
+
+    by_category = defaultdict(list)
+    for i, item in enumerate(items):
+        if results[i].aux_id is None:
+            by_category[(item.categoria or '').lower()].append(i)
+
+    for category, positions in by_category.items():
+        index = inventory_index.get(user, category)
+        _match_in_index(index, items, positions, results, threshold)
+        missed = [i for i in positions if results[i].aux_id is None]
+        if missed:
+            index = inventory_index.rebuild_after_miss(user, category, index)
+            if index is not None:
+                _match_in_index(index, items, missed, results, threshold)
+
+    pending = [i for i, result in enumerate(results) if result.aux_id is None]
+    if pending and settings.PRODUCT_MATCH_ANY_CATEGORY:
+        _match_in_index(_search_index(user, items, pending), items, pending, results, threshold)
+
+    return results
@@ -0,0 +1,150 @@
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# MÉTRICAS EN MEMORIA DEL PROCESO: CONTADORES, VALORES INSTANTÁNEOS (gauges) Y MUESTRAS DE LATENCIA.
+# CADA WORKER LAS REPORTA PERIÓDICAMENTE EN EL LOG (ver report_if_due) Y LAS GUARDA EN
+# WorkerMetrics (ver publish), DE DONDE /metrics/ LAS LEE AUNQUE CORRA EN OTRO PROCESO.
+MAX_SAMPLES = 2048
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_gauges = {}
+_timings = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+_last_report = time.monotonic()
+
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    with _lock:
+        _timings[name].append(seconds)
+
+
+@contextmanager
+def timer(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - started)
+
+
+def _percentile(ordered, fraction):
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def snapshot():
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+        samples = {name: sorted(values) for name, values in _timings.items()}
+
+    timings = {}
+    for name, ordered in samples.items():
+        timings[name] = {
+            'count': len(ordered),
+            'p50': _percentile(ordered, 0.50),
+            'p95': _percentile(ordered, 0.95),
+            'p99': _percentile(ordered, 0.99),
+            'max': ordered[-1] if ordered else 0.0,
+        }
+    return {'counters': counters, 'gauges': gauges, 'timings': timings}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timings.clear()
+
+
+def report_if_due(interval):
+    # Solo un hilo por proceso escribe el reporte en cada intervalo
+    global _last_report
+    now = time.monotonic()
+    with _lock:
+        if now - _last_report < interval:
+            return False
+        _last_report = now
+
+    if not logger.isEnabledFor(logging.INFO):
+        return True
+
+    data = snapshot()
+    timings = ", ".join(
+        f"{name} p50={t['p50'] * 1000:.0f}ms p95={t['p95'] * 1000:.0f}ms n={t['count']}"
+        for name, t in sorted(data['timings'].items())
+    )
+    logger.info("Metrics counters=%s gauges=%s timings=[%s]", data['counters'], data['gauges'], timings)
+    return True
+
+
+def process_name():
+    # Se calcula en cada llamada: los procesos hijos de run_bot_worker tienen otro pid
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def publish():
+    # Se importa aquí para que este módulo no dependa de los modelos
+    from .models import WorkerMetrics
+
+    WorkerMetrics.objects.update_or_create(process=process_name(), defaults={'data': snapshot()})
+
+
+# COMBINA LOS SNAPSHOTS DE VARIOS PROCESOS. CONTADORES Y GAUGES SE SUMAN; LOS PERCENTILES SON
+# UNA APROXIMACIÓN (PROMEDIO PONDERADO POR EL NÚMERO DE MUESTRAS DE CADA PROCESO).
+def merge(snapshots):
+    counters = defaultdict(int)
+    gauges = defaultdict(int)
+    timings = {}
+    for data in snapshots:
+        for name, value in data.get('counters', {}).items():
+            counters[name] += value
+        for name, value in data.get('gauges', {}).items():
+            gauges[name] += value
+        for name, t in data.get('timings', {}).items():
+            merged = timings.setdefault(name, {'count': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0})
+            count = merged['count'] + t['count']
+            if not count:
+                continue
+            for key in ('p50', 'p95', 'p99'):
+                merged[key] = (merged[key] * merged['count'] + t[key] * t['count']) / count
+            merged['max'] = max(merged['max'], t['max'])
+            merged['count'] = count
+    return {'counters': dict(counters), 'gauges': dict(gauges), 'timings': timings}
+
+
+# MÉTRICAS DE TODOS LOS PROCESOS QUE PUBLICARON EN LOS ÚLTIMOS max_age SEGUNDOS, INCLUIDO EL
+# ACTUAL. LOS CONTADORES SON ACUMULADOS DESDE QUE ARRANCÓ CADA PROCESO.
+def collect(max_age):
+    from datetime import timedelta
+
+    from django.utils import timezone
+
+    from .models import WorkerMetrics
+
+    publish()
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    WorkerMetrics.objects.filter(updated_at__lt=cutoff).delete()
+    rows = list(WorkerMetrics.objects.order_by('process'))
+    data = merge(row.data for row in rows)
+    data['processes'] = {row.process: row.updated_at.isoformat() for row in rows}
+    return data
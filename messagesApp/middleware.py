@@ -15,5 +15,5 @@ class GlobalExceptionMiddleware:
         except Exception as e:
             # Log full traceback for any error
             error_details = traceback.format_exc()
-            logger.error(f"Unhandled exception in request: {str(e)}\nTraceback:\n{error_details}")
+            logger.error("Unhandled exception in request: %s\nTraceback:\n%s", str(e), error_details)
             return JsonResponse({"error": "An internal server error occurred."}, status=500)
@@ -0,0 +1,84 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:39
+
+import django.contrib.auth.models
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('first_name', models.CharField(blank=True, max_length=150, verbose_name='first name')),
+                ('last_name', models.CharField(blank=True, max_length=150, verbose_name='last name')),
+                ('is_staff', models.BooleanField(default=False, help_text='Designates whether the user can log into this admin site.', verbose_name='staff status')),
+                ('is_active', models.BooleanField(default=True, help_text='Designates whether this user should be treated as active. Unselect this instead of deleting accounts.', verbose_name='active')),
+                ('date_joined', models.DateTimeField(default=django.utils.timezone.now, verbose_name='date joined')),
+                ('phone', models.CharField(max_length=20, unique=True)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.permission', verbose_name='user permissions')),
+            ],
+            options={
+                'verbose_name': 'user',
+                'verbose_name_plural': 'users',
+                'abstract': False,
+            },
+            managers=[
+                ('objects', django.contrib.auth.models.UserManager()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Product',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('brand', models.CharField(blank=True, max_length=100, null=True)),
+                ('category', models.CharField(choices=[('Lácteos', 'Lácteos'), ('Carnes y embutidos', 'Carnes y embutidos'), ('Panadería', 'Panadería'), ('Frutas', 'Frutas'), ('Verduras', 'Verduras'), ('Bebidas no alcohólicas', 'Bebidas no alcohólicas'), ('Bebidas alcohólicas', 'Bebidas alcohólicas'), ('Botanas', 'Botanas'), ('Dulces', 'Dulces'), ('Cereales', 'Cereales'), ('Salsas y condimentos', 'Salsas y condimentos'), ('Especias', 'Especias'), ('Enlatados', 'Enlatados'), ('Pastas', 'Pastas'), ('Arroz y granos', 'Arroz y granos'), ('Harinas', 'Harinas'), ('Aceites', 'Aceites'), ('Congelados', 'Congelados'), ('Bebés', 'Bebés'), ('Higiene personal', 'Higiene personal'), ('Limpieza', 'Limpieza'), ('Papel y desechables', 'Papel y desechables'), ('Cuidado femenino', 'Cuidado femenino'), ('Mascotas', 'Mascotas'), ('Farmacia', 'Farmacia'), ('Café y té', 'Café y té'), ('Azúcar y endulzantes', 'Azúcar y endulzantes'), ('Energéticas', 'Energéticas'), ('Importados', 'Importados'), ('Festivos', 'Festivos'), ('Otros', 'Otros')], default='Otros', max_length=100)),
+                ('amount', models.CharField(max_length=20)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('thread_id', models.CharField(max_length=31)),
+                ('user_conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AuxProdUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField(default=0)),
+                ('buying_price', models.FloatField()),
+                ('user_aux', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('product_aux', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messagesApp.product')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Transaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('buying_price_unitario', models.FloatField()),
+                ('selling_price_unitario', models.FloatField()),
+                ('time', models.DateTimeField(auto_now_add=True)),
+                ('product_transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messagesApp.product')),
+                ('user_transaction', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+# LAS BASES CREADAS ANTES DE LAS RESTRICCIONES DE 0003 PUEDEN TENER FILAS REPETIDAS. SE FUNDEN
+# EN LA DE MENOR id: PRIMERO LOS PRODUCTOS (name, brand, amount), LUEGO EL INVENTARIO DE CADA
+# USUARIO (QUE PUEDE HABER QUEDADO REPETIDO AL FUNDIR PRODUCTOS) Y LAS CONVERSACIONES.
+# LOS PRODUCTOS SIN MARCA SE FUNDEN EN 0009, CUANDO LA RESTRICCIÓN TAMBIÉN LOS CUBRE.
+def _repetidos(queryset, campos):
+    return (
+        queryset.values(*campos)
+        .annotate(filas=Count('id'), conservar=Min('id'))
+        .filter(filas__gt=1)
+        .order_by()
+    )
+
+
+def merge_duplicates(apps, schema_editor):
+    Product = apps.get_model('messagesApp', 'Product')
+    AuxProdUser = apps.get_model('messagesApp', 'AuxProdUser')
+    Transaction = apps.get_model('messagesApp', 'Transaction')
+    Conversation = apps.get_model('messagesApp', 'Conversation')
+
+    for grupo in _repetidos(Product.objects.filter(brand__isnull=False), ['name', 'brand', 'amount']):
+        conservar = grupo.pop('conservar')
+        grupo.pop('filas')
+        duplicados = list(Product.objects.filter(**grupo).exclude(id=conservar).values_list('id', flat=True))
+        Transaction.objects.filter(product_transaction_id__in=duplicados).update(product_transaction_id=conservar)
+        AuxProdUser.objects.filter(product_aux_id__in=duplicados).update(product_aux_id=conservar)
+        Product.objects.filter(id__in=duplicados).delete()
+
+    # El inventario repetido se suma en la fila que se conserva, con su precio de compra
+    for grupo in _repetidos(AuxProdUser.objects.all(), ['user_aux', 'product_aux']):
+        filas = AuxProdUser.objects.filter(user_aux_id=grupo['user_aux'], product_aux_id=grupo['product_aux'])
+        total = sum(filas.values_list('quantity', flat=True))
+        filas.filter(id=grupo['conservar']).update(quantity=total)
+        filas.exclude(id=grupo['conservar']).delete()
+
+    # El bot siempre usó la primera conversación de cada usuario (la de menor id)
+    for grupo in _repetidos(Conversation.objects.all(), ['user_conversation']):
+        Conversation.objects.filter(user_conversation_id=grupo['user_conversation']).exclude(
+            id=grupo['conservar']
+        ).delete()
+
+
+# En PostgreSQL las llaves foráneas se revisan al final de la transacción: la fusión va en su
+# propia migración para que 0003 pueda crear las restricciones e índices
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicates, migrations.RunPython.noop),
+    ]
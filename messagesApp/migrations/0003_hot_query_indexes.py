@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:39
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0002_merge_duplicates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('phone', models.CharField(max_length=20)),
+                ('body', models.TextField(blank=True, default='')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'id'], name='messagejob_status_id_idx'), models.Index(fields=['phone', 'status', 'id'], name='messagejob_phone_status_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailySales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.FloatField(default=0)),
+                ('cost', models.FloatField(default=0)),
+                ('user_rollup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ('product_rollup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='messagesApp.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_rollup', 'day'], name='dailysales_user_day_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_rollup', 'product_rollup', 'day'), name='unique_daily_sales')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(fields=('name', 'brand', 'amount'), name='unique_product'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(django.db.models.functions.text.Lower('category'), name='product_category_lower_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='auxproduser',
+            constraint=models.UniqueConstraint(fields=('user_aux', 'product_aux'), name='unique_aux_prod_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='conversation',
+            constraint=models.UniqueConstraint(fields=('user_conversation',), name='unique_conversation_user'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['user_transaction', 'time'], name='transaction_user_time_idx'),
+        ),
+    ]
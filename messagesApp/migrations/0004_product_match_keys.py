@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 06:42
+
+from django.db import migrations, models
+
+from messagesApp.normalization import name_unit_key, normalize_text
+
+
+def backfill_match_keys(apps, schema_editor):
+    Product = apps.get_model('messagesApp', 'Product')
+    batch = []
+    for product in Product.objects.only('name', 'amount', 'brand').iterator(chunk_size=2000):
+        product.match_key = name_unit_key(product.name, product.amount)
+        product.brand_key = normalize_text(product.brand)
+        batch.append(product)
+        if len(batch) >= 2000:
+            Product.objects.bulk_update(batch, ['match_key', 'brand_key'])
+            batch = []
+    if batch:
+        Product.objects.bulk_update(batch, ['match_key', 'brand_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0003_hot_query_indexes'),
+    ]
+
+    # Las columnas se llenan antes de crear los índices para no actualizarlos fila por fila
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='brand_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='match_key',
+            field=models.CharField(default='', editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_match_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='product',
+            name='brand_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='product',
+            name='match_key',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=255),
+        ),
+    ]
@@ -0,0 +1,38 @@
+import logging
+
+from django.db import DatabaseError, migrations, transaction
+
+logger = logging.getLogger(__name__)
+
+
+# El índice GIN de trigramas solo existe en PostgreSQL y requiere la extensión pg_trgm. Si el
+# usuario de la base no puede instalarla, la búsqueda usa el índice de n-gramas en memoria.
+def create_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    except DatabaseError:
+        logger.warning("No se pudo instalar pg_trgm; se usará la búsqueda de productos en memoria")
+        return
+    schema_editor.execute(
+        'CREATE INDEX IF NOT EXISTS product_match_key_trgm_idx '
+        'ON "messagesApp_product" USING gin (match_key gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS product_match_key_trgm_idx")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0004_product_match_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0007_conversation_rotation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagejob',
+            name='available_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,63 @@
+from django.db import migrations
+from django.db.models import Count, Min, Q
+
+
+# Los productos sin marca (NULL o '') con el mismo nombre y unidad se funden en el de menor id,
+# sumando su inventario y sus ventas diarias, antes de crear la restricción que los prohíbe
+def merge_products_without_brand(apps, schema_editor):
+    Product = apps.get_model('messagesApp', 'Product')
+    AuxProdUser = apps.get_model('messagesApp', 'AuxProdUser')
+    Transaction = apps.get_model('messagesApp', 'Transaction')
+    DailySales = apps.get_model('messagesApp', 'DailySales')
+
+    sin_marca = Q(brand__isnull=True) | Q(brand='')
+    grupos = (
+        Product.objects.filter(sin_marca)
+        .values('name', 'amount')
+        .annotate(productos=Count('id'), conservar=Min('id'))
+        .filter(productos__gt=1)
+    )
+    for grupo in grupos:
+        conservar = grupo['conservar']
+        duplicados = list(
+            Product.objects.filter(sin_marca, name=grupo['name'], amount=grupo['amount'])
+            .exclude(id=conservar).values_list('id', flat=True)
+        )
+
+        Transaction.objects.filter(product_transaction_id__in=duplicados).update(product_transaction_id=conservar)
+        for aux in AuxProdUser.objects.filter(product_aux_id__in=duplicados):
+            existente = AuxProdUser.objects.filter(user_aux_id=aux.user_aux_id, product_aux_id=conservar).first()
+            if existente is None:
+                aux.product_aux_id = conservar
+                aux.save(update_fields=['product_aux'])
+            else:
+                existente.quantity += aux.quantity
+                existente.save(update_fields=['quantity'])
+                aux.delete()
+        for fila in DailySales.objects.filter(product_rollup_id__in=duplicados):
+            existente = DailySales.objects.filter(
+                user_rollup_id=fila.user_rollup_id, product_rollup_id=conservar, day=fila.day
+            ).first()
+            if existente is None:
+                fila.product_rollup_id = conservar
+                fila.save(update_fields=['product_rollup'])
+            else:
+                existente.quantity += fila.quantity
+                existente.revenue += fila.revenue
+                existente.cost += fila.cost
+                existente.save(update_fields=['quantity', 'revenue', 'cost'])
+                fila.delete()
+        Product.objects.filter(id__in=duplicados).delete()
+
+
+# En PostgreSQL las llaves foráneas se revisan al final de la transacción: la fusión va en su
+# propia migración para que 0010 pueda cambiar la restricción de Product
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0008_messagejob_available_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_products_without_brand, migrations.RunPython.noop),
+    ]
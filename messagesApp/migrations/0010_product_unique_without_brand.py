@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:37
+
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0009_merge_products_without_brand'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='product',
+            name='unique_product',
+        ),
+        migrations.AddConstraint(
+            model_name='product',
+            constraint=models.UniqueConstraint(models.F('name'), django.db.models.functions.comparison.Coalesce('brand', models.Value('')), models.F('amount'), name='unique_product'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 07:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messagesApp', '0011_workermetrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagejob',
+            name='run_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='messagejob',
+            name='thread_id',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='messagejob',
+            name='tools_ran',
+            field=models.BooleanField(default=False),
+        ),
+    ]
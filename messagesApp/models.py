@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Coalesce, Lower
+
+from .normalization import name_unit_key, normalize_text
 
 
 class CustomUser(AbstractUser):
@@ -54,6 +57,32 @@ class Product(models.Model):
         choices=CATEGORY_CHOICES,
         default="Otros")
     amount = models.CharField(max_length=20)
+    # Textos normalizados para el matching de ventas; se calculan a partir de name, amount y brand
+    match_key = models.CharField(max_length=255, db_index=True, default="", editable=False)
+    brand_key = models.CharField(max_length=255, db_index=True, default="", editable=False)
+
+    class Meta:
+        constraints = [
+            # Sin marca es NULL o '': Coalesce hace que ambos choquen (NULL nunca choca en un UNIQUE normal)
+            models.UniqueConstraint('name', Coalesce('brand', models.Value('')), 'amount', name='unique_product'),
+        ]
+        indexes = [
+            # sell_product filtra el inventario por categoría sin distinguir mayúsculas
+            models.Index(Lower('category'), name='product_category_lower_idx'),
+        ]
+
+    # bulk_create no llama a save(), así que quien crea productos en lote debe usar este método
+    def with_match_keys(self):
+        self.match_key = name_unit_key(self.name, self.amount)
+        self.brand_key = normalize_text(self.brand)
+        return self
+
+    def save(self, *args, **kwargs):
+        self.with_match_keys()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'name', 'amount', 'brand'} & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'match_key', 'brand_key'}
+        super().save(*args, **kwargs)
 
 class AuxProdUser(models.Model):
     user_aux = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
@@ -61,9 +90,26 @@ class AuxProdUser(models.Model):
     quantity = models.IntegerField(default=0)
     buying_price = models.FloatField()
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_aux', 'product_aux'], name='unique_aux_prod_user'),
+        ]
+
 class Conversation(models.Model):
     thread_id = models.CharField(max_length=31)
     user_conversation = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    # Tamaño del thread actual; al pasar los límites se rota a uno nuevo (ver threads.py)
+    message_count = models.IntegerField(default=0)
+    context_tokens = models.IntegerField(default=0)
+    # Resumen y datos del inventario con los que se sembró el thread actual
+    summary = models.TextField(blank=True, default="")
+    facts = models.TextField(blank=True, default="")
+    rotated_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_conversation'], name='unique_conversation_user'),
+        ]
 
 class Transaction(models.Model):
     product_transaction = models.ForeignKey(Product, on_delete=models.CASCADE)
@@ -72,3 +118,70 @@ class Transaction(models.Model):
     buying_price_unitario = models.FloatField()
     selling_price_unitario = models.FloatField()
     time = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_transaction', 'time'], name='transaction_user_time_idx'),
+        ]
+
+class MessageJob(models.Model):
+    STATUS_PENDING = "pending"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_PENDING, "Pending"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    phone = models.CharField(max_length=20)
+    body = models.TextField(blank=True, default="")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    attempts = models.IntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Un job que falló por un error transitorio no se vuelve a tomar antes de esta hora
+    available_at = models.DateTimeField(null=True, blank=True)
+    # Hasta dónde llegó el bot, para que un reintento no repita nada: el thread al que ya se
+    # mandó el mensaje, el run que lo atiende y si alguna herramienta empezó a registrar algo
+    thread_id = models.CharField(max_length=64, blank=True, default="")
+    run_id = models.CharField(max_length=64, blank=True, default="")
+    tools_ran = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # claim_next_jobs: pendientes en orden y el job más antiguo de cada número
+            models.Index(fields=['status', 'id'], name='messagejob_status_id_idx'),
+            models.Index(fields=['phone', 'status', 'id'], name='messagejob_phone_status_idx'),
+        ]
+
+class DailySales(models.Model):
+    user_rollup = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    product_rollup = models.ForeignKey(Product, on_delete=models.CASCADE)
+    day = models.DateField()
+    quantity = models.IntegerField(default=0)
+    revenue = models.FloatField(default=0)
+    cost = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_rollup', 'product_rollup', 'day'], name='unique_daily_sales'),
+        ]
+        indexes = [
+            models.Index(fields=['user_rollup', 'day'], name='dailysales_user_day_idx'),
+        ]
+
+# MessageSid DE CADA WEBHOOK YA RECIBIDO, PARA IGNORAR LOS REENVÍOS DE TWILIO (ver idempotency.py)
+class ProcessedMessage(models.Model):
+    sid = models.CharField(max_length=64, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+# ÚLTIMO SNAPSHOT DE MÉTRICAS DE CADA PROCESO (ver metrics.publish); /metrics/ LOS COMBINA
+class WorkerMetrics(models.Model):
+    process = models.CharField(max_length=100, unique=True)
+    data = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
@@ -0,0 +1,20 @@
+import re
+import unicodedata
+
+
+def normalize_text(text):
+    if not text:
+        return ''
+    # Eliminar acentos y caracteres especiales
+    text = unicodedata.normalize('NFKD', str(text)).encode('ASCII', 'ignore').decode('utf-8')
+    # Convertir a minúsculas
+    text = text.lower()
+    # Eliminar caracteres especiales como guiones, apóstrofes, puntos, comas, etc.
+    text = re.sub(r'[^a-z0-9\s]', '', text)
+    # Eliminar espacios adicionales
+    text = re.sub(r'\s+', ' ', text).strip()
+    return text
+
+
+def name_unit_key(name, amount):
+    return f"{normalize_text(name)} {normalize_text(amount)}"
@@ -0,0 +1,188 @@
+import logging
+import queue
+import random
+import threading
+import time
+import zlib
+
+import requests
+from decouple import config
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from . import clients, metrics
+
+logger = logging.getLogger(__name__)
+
+# ENVÍO DE MENSAJES DE WHATSAPP POR LA API REST DE TWILIO CON UNA SESIÓN HTTP COMPARTIDA.
+# send LOS ENCOLA Y UNOS HILOS EN SEGUNDO PLANO LOS ENTREGAN; LOS MENSAJES DE UN MISMO NÚMERO
+# SIEMPRE LOS ENTREGA EL MISMO HILO, ASÍ QUE LLEGAN EN ORDEN. TWILIO_API_BASE_URL PERMITE
+# APUNTAR A UN SERVIDOR FALSO EN PRUEBAS.
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DeliveryError(Exception):
+    pass
+
+
+# SOLO SE REINTENTA SI LA PETICIÓN NUNCA LLEGÓ A TWILIO. UN POST QUE AGOTÓ EL TIEMPO DE LECTURA
+# O SE CORTÓ DESPUÉS DE ENVIARSE PUDO HABER CREADO EL MENSAJE, Y REINTENTARLO LO DUPLICARÍA.
+def connect_failed(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', error.args[0]), NewConnectionError)
+    return False
+
+
+def chunk_message(body, limit):
+    # Parte el texto en pedazos de a lo más limit caracteres, cortando en saltos de línea y,
+    # si una línea sola no cabe, en espacios
+    chunks = []
+    current = ""
+    for line in body.split("\n"):
+        while len(line) > limit:
+            cut = line.rfind(" ", 0, limit + 1)
+            cut = cut if cut > 0 else limit
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:cut].rstrip())
+            line = line[cut:].lstrip()
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    chunks.append(current)
+    return [chunk.rstrip() for chunk in chunks if chunk.strip()] or [""]
+
+
+class TwilioSender:
+    def __init__(self):
+        self.account_sid = config("TWILIO_ACCOUNT_SID")
+        self.auth_token = config("TWILIO_AUTH_TOKEN")
+        self.from_number = config("TWILIO_NUMBER")
+        self.url = f"{settings.TWILIO_API_BASE_URL.rstrip('/')}/2010-04-01/Accounts/{self.account_sid}/Messages.json"
+
+        # Una sola sesión mantiene abiertas las conexiones TLS entre mensajes
+        self.session = requests.Session()
+        self.session.auth = (self.account_sid, self.auth_token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.OUTBOUND_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _post(self, to_number, body):
+        for attempt in range(settings.OUTBOUND_MAX_RETRIES + 1):
+            started = time.monotonic()
+            retry_after = None
+            try:
+                response = self.session.post(
+                    self.url,
+                    data={"From": f"whatsapp:{self.from_number}", "To": f"whatsapp:{to_number}", "Body": body},
+                    timeout=settings.OUTBOUND_TIMEOUT,
+                )
+                metrics.observe('outbound.request', time.monotonic() - started)
+                if response.status_code < 400:
+                    return response
+                if response.status_code not in RETRY_STATUSES:
+                    raise DeliveryError(f"Twilio respondió {response.status_code}: {response.text[:200]}")
+                error = f"Twilio respondió {response.status_code}"
+                retry_after = response.headers.get("Retry-After")
+            except requests.RequestException as e:
+                metrics.observe('outbound.request', time.monotonic() - started)
+                if not connect_failed(e):
+                    raise DeliveryError(str(e)) from e
+                error = str(e)
+
+            if attempt == settings.OUTBOUND_MAX_RETRIES:
+                raise DeliveryError(error)
+            metrics.incr('outbound.retries')
+            delay = settings.OUTBOUND_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            logger.warning("Error enviando mensaje a %s (%s), reintento en %.1fs", to_number, error, delay)
+            time.sleep(delay)
+
+    # ENTREGA SÍNCRONA DE UN MENSAJE, PARTIDO EN PEDAZOS SI EXCEDE EL LÍMITE DE WHATSAPP
+    def deliver(self, to_number, body):
+        chunks = chunk_message(body, settings.WHATSAPP_MAX_LENGTH)
+        for chunk in chunks:
+            self._post(to_number, chunk)
+            metrics.incr('outbound.chunks')
+        metrics.incr('outbound.sent')
+        logger.info("Message sent to %s (%s parts)", to_number, len(chunks))
+
+
+class OutboundQueue:
+    def __init__(self, sender, workers):
+        self.sender = sender
+        self.queues = [queue.Queue() for _ in range(workers)]
+        self.threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.threads:
+                return
+            for i, worker_queue in enumerate(self.queues):
+                thread = threading.Thread(target=self._work, args=(worker_queue,), name=f"outbound-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, to_number, body):
+        self._start()
+        # crc32 es estable entre procesos, a diferencia de hash()
+        worker_queue = self.queues[zlib.crc32(to_number.encode()) % len(self.queues)]
+        worker_queue.put((to_number, body, time.monotonic()))
+        metrics.gauge('outbound.queue_depth', self.depth())
+
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self.queues)
+
+    def _work(self, worker_queue):
+        while True:
+            to_number, body, queued_at = worker_queue.get()
+            metrics.gauge('outbound.queue_depth', self.depth())
+            metrics.observe('outbound.queue_wait', time.monotonic() - queued_at)
+            try:
+                self.sender.deliver(to_number, body)
+            except Exception as e:
+                metrics.incr('outbound.failed')
+                logger.error("Error sending message to %s: %s", to_number, e)
+            finally:
+                worker_queue.task_done()
+
+    def flush(self, timeout=None):
+        # Espera a que se entreguen los mensajes encolados (por ejemplo, al detener el worker)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for worker_queue in self.queues:
+            while worker_queue.unfinished_tasks:
+                if deadline is not None and time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.05)
+        return True
+
+
+# EL SENDER Y LA COLA VIVEN EN EL REGISTRO DE CLIENTES: UNO POR PROCESO (ver clients.py)
+def get_sender():
+    return clients.get('twilio', TwilioSender)
+
+
+def get_queue():
+    return clients.get('outbound_queue', lambda: OutboundQueue(get_sender(), settings.OUTBOUND_WORKERS))
+
+
+def send(to_number, body):
+    if settings.OUTBOUND_ASYNC:
+        get_queue().put(to_number, body)
+    else:
+        get_sender().deliver(to_number, body)
+
+
+def flush(timeout=None):
+    outbound_queue = clients.peek('outbound_queue')
+    return outbound_queue.flush(timeout) if outbound_queue is not None else True
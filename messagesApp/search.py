@@ -0,0 +1,238 @@
+import abc
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils.module_loading import import_string
+from rapidfuzz import fuzz
+
+from .models import AuxProdUser, Product
+from .normalization import name_unit_key, normalize_text
+
+logger = logging.getLogger(__name__)
+
+CATALOG_GENERATION_KEY = "catalog_gen"
+
+
+def trigrams(text):
+    # Igual que pg_trgm: cada palabra se rellena con dos espacios al inicio y uno al final
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+def bump_catalog_generation():
+    cache = caches['default']
+    try:
+        cache.incr(CATALOG_GENERATION_KEY)
+    except ValueError:
+        cache.set(CATALOG_GENERATION_KEY, 1, None)
+
+
+# BÚSQUEDA DE PRODUCTOS PARECIDOS EN TODO EL CATÁLOGO. search DEVUELVE, PARA CADA CLAVE
+# NORMALIZADA (ver Product.match_key), LOS IDS DE LOS PRODUCTOS CANDIDATOS DEL MÁS AL MENOS
+# PARECIDO. EL PUNTAJE FINAL LO CALCULA QUIEN LLAMA, CON rapidfuzz.
+class ProductSearchBackend(abc.ABC):
+    @abc.abstractmethod
+    def search(self, keys, limit, user=None):
+        pass
+
+
+# pg_trgm CON UN ÍNDICE GIN SOBRE match_key (migración 0003). EL OPERADOR % USA EL UMBRAL
+# pg_trgm.similarity_threshold DE LA SESIÓN, QUE SE FIJA EN min_similarity ANTES DE BUSCAR.
+class TrigramSearchBackend(ProductSearchBackend):
+    def __init__(self, min_similarity):
+        self.min_similarity = min_similarity
+
+    @staticmethod
+    def available():
+        if connection.vendor != 'postgresql':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            return cursor.fetchone() is not None
+
+    # TODAS LAS CLAVES VAN EN UNA SOLA QUERY: CADA UNA SE CRUZA (LATERAL) CON SUS limit
+    # PRODUCTOS MÁS PARECIDOS, Y CADA SUBCONSULTA SIGUE USANDO EL ÍNDICE GIN CON EL OPERADOR %.
+    def search(self, keys, limit, user=None):
+        keys = list(set(keys))
+        product = connection.ops.quote_name(Product._meta.db_table)
+        inventory = connection.ops.quote_name(AuxProdUser._meta.db_table)
+        user_filter = (
+            f"AND EXISTS (SELECT 1 FROM {inventory} aux WHERE aux.product_aux_id = p.id AND aux.user_aux_id = %s)"
+            if user is not None else ""
+        )
+        params = [keys] + ([user.pk] if user is not None else []) + [limit]
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, false)", [str(self.min_similarity)])
+            cursor.execute(
+                f"SELECT k.key, p.id FROM unnest(%s::text[]) AS k(key) CROSS JOIN LATERAL ("
+                f"SELECT p.id, similarity(p.match_key, k.key) AS score FROM {product} p "
+                f"WHERE p.match_key %% k.key {user_filter} ORDER BY score DESC, p.id LIMIT %s"
+                f") p ORDER BY k.key, p.score DESC, p.id",
+                params,
+            )
+            rows = cursor.fetchall()
+
+        results = {key: [] for key in keys}
+        for key, product_id in rows:
+            results[key].append(product_id)
+        return results
+
+
+# ÍNDICE INVERTIDO DE TRIGRAMAS EN MEMORIA, PARA SQLite, PRUEBAS O SERVIDORES SIN pg_trgm.
+# LOS PRODUCTOS SOLO SE AGREGAN AL CATÁLOGO, ASÍ QUE CUANDO CAMBIA LA GENERACIÓN SE CARGAN
+# LOS IDS NUEVOS; CADA ttl SEGUNDOS SE RECONSTRUYE COMPLETO PARA VER EDICIONES Y BORRADOS.
+class NgramSearchBackend(ProductSearchBackend):
+    def __init__(self, ttl, min_similarity):
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._grams = {}
+        self._last_id = 0
+        self._generation = None
+        self._built_at = None
+
+    def _refresh(self):
+        generation = caches['default'].get(CATALOG_GENERATION_KEY, 0)
+        with self._lock:
+            if self._built_at is None or time.monotonic() - self._built_at >= self.ttl:
+                postings, product_grams, last_id = defaultdict(list), {}, 0
+                self._built_at = time.monotonic()
+            elif generation != self._generation:
+                postings, product_grams, last_id = self._postings, self._grams, self._last_id
+            else:
+                return
+
+            rows = Product.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'match_key')
+            for product_id, match_key in rows.iterator(chunk_size=5000):
+                grams = frozenset(trigrams(match_key))
+                for gram in grams:
+                    postings[gram].append(product_id)
+                product_grams[product_id] = grams
+                last_id = product_id
+
+            # Las búsquedas en curso siguen usando las estructuras anteriores
+            self._postings, self._grams, self._last_id = postings, product_grams, last_id
+            self._generation = generation
+            logger.debug("Índice de n-gramas del catálogo: %s productos", len(product_grams))
+
+    # LOS TRIGRAMAS COMUNES ("ml ", " 1 ") APARECEN EN MEDIO CATÁLOGO Y RECORRER SUS LISTAS ES
+    # LO CARO. UN PRODUCTO CON SIMILITUD >= min_similarity COMPARTE AL MENOS
+    # ceil(min_similarity * len(grams)) TRIGRAMAS CON LA CLAVE, ASÍ QUE SI SE OMITEN MENOS QUE
+    # ESOS (LOS MÁS FRECUENTES) TODO PRODUCTO SUFICIENTEMENTE PARECIDO APARECE EN LOS DEMÁS. LOS
+    # OMITIDOS SOLO SE CUENTAN PARA LOS CANDIDATOS QUE AÚN PUEDEN LLEGAR AL UMBRAL.
+    def search(self, keys, limit, user=None):
+        self._refresh()
+        postings, product_grams = self._postings, self._grams
+        allowed = None
+        if user is not None:
+            allowed = set(AuxProdUser.objects.filter(user_aux=user).values_list('product_aux_id', flat=True))
+
+        results = {}
+        for key in set(keys):
+            grams = sorted(trigrams(key), key=lambda gram: len(postings.get(gram, ())))
+            needed = max(1, math.ceil(self.min_similarity * len(grams)))
+            skipped = grams[len(grams) - needed + 1:]
+            shared = Counter()
+            for gram in grams[:len(grams) - len(skipped)]:
+                shared.update(postings.get(gram, ()))
+
+            scored = []
+            for product_id, count in shared.items():
+                if allowed is not None and product_id not in allowed:
+                    continue
+                other = product_grams[product_id]
+                if skipped:
+                    # Cota superior: aunque tuviera todos los omitidos, ¿llega al umbral?
+                    best = count + len(skipped)
+                    if best < self.min_similarity * (len(grams) + len(other) - best):
+                        continue
+                    count += sum(gram in other for gram in skipped)
+                # Similitud de Jaccard entre los conjuntos de trigramas, como similarity() de pg_trgm
+                similarity = count / (len(grams) + len(other) - count)
+                if similarity >= self.min_similarity:
+                    scored.append((similarity, product_id))
+            results[key] = [product_id for _, product_id in heapq.nlargest(limit, scored)]
+        return results
+
+
+BACKENDS = {
+    'trigram': TrigramSearchBackend,
+    'ngram': NgramSearchBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def _create_backend(name):
+    if name == 'auto':
+        name = 'trigram' if TrigramSearchBackend.available() else 'ngram'
+    backend_class = BACKENDS[name] if name in BACKENDS else import_string(name)
+    if backend_class is NgramSearchBackend:
+        return NgramSearchBackend(settings.PRODUCT_SEARCH_TTL, settings.PRODUCT_SEARCH_MIN_SIMILARITY)
+    if backend_class is TrigramSearchBackend:
+        return TrigramSearchBackend(settings.PRODUCT_SEARCH_MIN_SIMILARITY)
+    return backend_class()
+
+
+def get_search_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_backend(settings.PRODUCT_SEARCH_BACKEND)
+                logger.info("Backend de búsqueda de productos: %s", type(_backend).__name__)
+    return _backend
+
+
+def _unit_key(amount):
+    # "600 ml" y "600ml" son la misma unidad
+    return normalize_text(amount).replace(' ', '')
+
+
+# BUSCA EN EL CATÁLOGO UN PRODUCTO EXISTENTE PARA CADA (name, brand, amount) QUE NO COINCIDIÓ
+# EXACTAMENTE: MISMA UNIDAD Y NOMBRE Y MARCA SIMILARES AL MENOS threshold. DEVUELVE
+# {(name, brand, amount): Product} SOLO PARA LOS QUE ENCONTRÓ.
+def _similarity(a, b):
+    # Tolera palabras en otro orden y palabras separadas o juntas ("coca cola" / "cocacola")
+    return max(fuzz.token_sort_ratio(a, b), fuzz.ratio(a.replace(' ', ''), b.replace(' ', '')))
+
+
+def find_canonical_products(keys, threshold):
+    wanted = {
+        (name, brand, amount): (name_unit_key(name, amount), normalize_text(name), normalize_text(brand), _unit_key(amount))
+        for name, brand, amount in keys
+    }
+    candidates = get_search_backend().search(
+        [match_key for match_key, _, _, _ in wanted.values()], settings.PRODUCT_SEARCH_LIMIT
+    )
+    products = Product.objects.in_bulk({product_id for ids in candidates.values() for product_id in ids})
+
+    found = {}
+    for key, (match_key, name_key, brand_key, unit_key) in wanted.items():
+        best, best_score = None, threshold - 1
+        for product_id in candidates.get(match_key, ()):
+            product = products.get(product_id)
+            if product is None or _unit_key(product.amount) != unit_key:
+                continue
+            if (brand_key or product.brand_key) and _similarity(brand_key, product.brand_key) < threshold:
+                continue
+            score = _similarity(name_key, normalize_text(product.name))
+            if score > best_score:
+                best, best_score = product, score
+        if best is not None:
+            found[key] = best
+    return found
@@ -1,3 +1,1190 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import json
+import logging
+import time
+from types import SimpleNamespace
 
-# Create your tests here.
+import requests
+from rapidfuzz import fuzz
+from urllib3.exceptions import NewConnectionError
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError
+from django.db.models import F, Sum
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+
+from .botClass import (
+    AsyncBot, Bot, dispatch_tool_calls, generate_sales_report, process_product_batch, restar_meses, sell_product,
+    thread_cache_key,
+)
+from .fastpath import _find_product, parse_intent
+from .idempotency import afirst_delivery, purge_processed_messages
+from .jobs import claim_next_jobs, enqueue_message, process_jobs, requeue_stale_jobs
+from .logs import SamplingFilter
+from .matching import (
+    SaleItem, _match_exact, _match_in_index, _match_in_index_loop, _no_match, inventory_index, match_items,
+)
+from .models import (
+    AuxProdUser, Conversation, CustomUser, DailySales, MessageJob, ProcessedMessage, Product, Transaction,
+    WorkerMetrics,
+)
+from .normalization import name_unit_key
+from .outbound import DeliveryError, TwilioSender, chunk_message
+from .search import NgramSearchBackend, ProductSearchBackend, TrigramSearchBackend, trigrams
+from . import metrics, threads, views
+
+
+# LOS LOGS DE DEPURACIÓN NO DEBEN EJECUTAR CONSULTAS: CON DEBUG DESACTIVADO LAS HERRAMIENTAS
+# HACEN SOLO SUS PROPIAS QUERIES, Y ACTIVARLO NO AGREGA NINGUNA.
+class DebugLoggingQueriesTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        inventory_index.clear()
+        self.user = CustomUser.objects.create(phone="+5215500000000")
+        product = Product.objects.create(
+            name="Coca Cola", brand="Coca-Cola", category="Bebidas no alcohólicas", amount="600 ml"
+        )
+        AuxProdUser.objects.create(user_aux=self.user, product_aux=product, quantity=1000, buying_price=11)
+        self.logger = logging.getLogger('messagesApp')
+        self.addCleanup(self.logger.setLevel, self.logger.level)
+
+    def sale(self):
+        return sell_product({
+            'productos': [{
+                'nombre': "Coca Cola",
+                'marca': "Coca-Cola",
+                'categoría': "Bebidas no alcohólicas",
+                'unidad_medida': "600 ml",
+                'cantidad': 2,
+            }],
+            'precio_venta': 18,
+        }, self.user)
+
+    def assert_queries(self, expected, function):
+        function()  # Calienta los índices y cachés en memoria
+
+        # Sin DEBUG solo corren las queries propias de la herramienta
+        self.logger.setLevel(logging.INFO)
+        with self.assertNumQueries(expected):
+            output = function()
+
+        # Con DEBUG los registros se escriben, pero no agregan queries
+        with self.assertLogs('messagesApp', level='DEBUG') as logs, self.assertNumQueries(expected):
+            function()
+        self.assertTrue(any(record.levelno == logging.DEBUG for record in logs.records))
+        return output
+
+    def test_sell_product(self):
+        output = self.assert_queries(8, self.sale)
+        self.assertTrue(output.endswith("Status: 201"), output)
+
+    def test_generate_sales_report(self):
+        self.sale()
+        output = self.assert_queries(2, lambda: generate_sales_report(self.user, 'days', 1, 'product', 3))
+        self.assertIn("Reporte de Ventas", output)
+
+
+class SamplingFilterTest(TestCase):
+    def record(self, level):
+        return logging.LogRecord('messagesApp', level, __file__, 1, "mensaje", None, None)
+
+    def test_drops_sampled_levels_only(self):
+        sampling = SamplingFilter(debug_rate=0, info_rate=1)
+        self.assertFalse(sampling.filter(self.record(logging.DEBUG)))
+        self.assertTrue(sampling.filter(self.record(logging.INFO)))
+        self.assertTrue(sampling.filter(self.record(logging.WARNING)))
+
+
+@override_settings(BOT_COALESCE_WINDOW=0, BOT_COALESCE_MAX_WAIT=0, BOT_JOB_MAX_ATTEMPTS=2, BOT_JOB_RETRY_BACKOFF=60)
+class JobQueueTest(TestCase):
+    def test_claims_oldest_number_first_and_never_two_runs_of_one_number(self):
+        primero = enqueue_message("+5215500000001", "hola")
+        segundo = enqueue_message("+5215500000001", "vendí 2 coca")
+        otro = enqueue_message("+5215500000002", "reporte de hoy")
+
+        # Se toman juntos todos los pendientes del número más antiguo, en orden
+        self.assertEqual([job.id for job in claim_next_jobs()], [primero.id, segundo.id])
+        # Mientras corren, un mensaje nuevo de ese número espera; se atiende el otro número
+        tercero = enqueue_message("+5215500000001", "y 3 sabritas")
+        self.assertEqual([job.id for job in claim_next_jobs()], [otro.id])
+        self.assertEqual(claim_next_jobs(), [])
+
+        MessageJob.objects.filter(id__in=[primero.id, segundo.id]).update(status=MessageJob.STATUS_DONE)
+        self.assertEqual([job.id for job in claim_next_jobs()], [tercero.id])
+
+    def process(self, error):
+        with mock.patch('messagesApp.fastpath.try_fast_path', return_value=None), \
+                mock.patch('messagesApp.botClass.Bot', side_effect=error), \
+                mock.patch('messagesApp.utils.send_message') as send_message:
+            jobs = claim_next_jobs()
+            self.assertTrue(jobs)
+            process_jobs(jobs)
+        return send_message
+
+    def test_transient_error_is_retried_with_backoff_then_answered(self):
+        job = enqueue_message("+5215500000001", "hola")
+
+        send_message = self.process(OperationalError("database is locked"))
+        job.refresh_from_db()
+        self.assertEqual(job.status, MessageJob.STATUS_PENDING)
+        self.assertGreater(job.available_at, timezone.now() + timedelta(seconds=50))
+        send_message.assert_not_called()
+        # Antes del backoff no se vuelve a tomar
+        self.assertEqual(claim_next_jobs(), [])
+
+        MessageJob.objects.filter(id=job.id).update(available_at=timezone.now())
+        send_message = self.process(OperationalError("database is locked"))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (MessageJob.STATUS_FAILED, 2))
+        send_message.assert_called_once_with("+5215500000001", mock.ANY)
+
+    def test_thread_creation_connection_error_is_retried(self):
+        from openai import APIConnectionError
+
+        job = enqueue_message("+5215500000001", "hola")
+        client = mock.Mock()
+        client.beta.threads.create.side_effect = APIConnectionError(request=mock.Mock())
+        with mock.patch('messagesApp.fastpath.try_fast_path', return_value=None), \
+                mock.patch('messagesApp.clients.openai', return_value=client), \
+                mock.patch('messagesApp.utils.send_message') as send_message:
+            process_jobs(claim_next_jobs())
+        job.refresh_from_db()
+        self.assertEqual(job.status, MessageJob.STATUS_PENDING)
+        send_message.assert_not_called()
+
+    def test_permanent_error_fails_at_once_with_a_reply(self):
+        job = enqueue_message("+5215500000001", "hola")
+        send_message = self.process(ValueError("bad tool arguments"))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (MessageJob.STATUS_FAILED, 1))
+        send_message.assert_called_once()
+
+
+def fake_run(status, *tool_names, run_id="run_1"):
+    tool_calls = [
+        SimpleNamespace(id=f"call_{i}", function=SimpleNamespace(name=name, arguments="{}"))
+        for i, name in enumerate(tool_names)
+    ]
+    return SimpleNamespace(
+        id=run_id, status=status, usage=None,
+        required_action=SimpleNamespace(
+            type='submit_tool_outputs', submit_tool_outputs=SimpleNamespace(tool_calls=tool_calls)
+        ),
+    )
+
+
+def tool_outputs(tool_calls, user):
+    return [{'tool_call_id': call.id, 'output': "Status: 201"} for call in tool_calls]
+
+
+# UN JOB GUARDA HASTA DÓNDE LLEGÓ EL BOT: UN REINTENTO NO REPITE UNA VENTA, NO VUELVE A MANDAR
+# EL MENSAJE AL THREAD Y NO DEJA CORRIENDO EL RUN DEL INTENTO ANTERIOR.
+@override_settings(BOT_COALESCE_WINDOW=0, BOT_COALESCE_MAX_WAIT=0, BOT_RUN_STREAMING=False, BOT_FAST_PATH=False)
+class JobProgressTest(TestCase):
+    def setUp(self):
+        caches['threads'].clear()
+        self.phone = "+5215500000014"
+        user = CustomUser.objects.create(phone=self.phone)
+        Conversation.objects.create(user_conversation=user, thread_id="thread_1")
+        self.client = mock.Mock()
+        self.client.beta.threads.messages.list.return_value = SimpleNamespace(data=[
+            SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value="listo"))])
+        ])
+        for target, replacement in (('messagesApp.clients.openai', mock.Mock(return_value=self.client)),
+                                    ('messagesApp.utils.send_message', mock.Mock())):
+            patcher = mock.patch(target, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        from .utils import send_message
+        self.send_message = send_message
+
+    def stale(self, **progress):
+        job = enqueue_message(self.phone, "vendí 2 coca")
+        MessageJob.objects.filter(id=job.id).update(
+            status=MessageJob.STATUS_RUNNING, attempts=1, started_at=timezone.now() - timedelta(hours=1), **progress
+        )
+        return job
+
+    def test_stale_job_whose_tools_ran_is_not_requeued(self):
+        job = self.stale(thread_id="thread_1", run_id="run_1", tools_ran=True)
+        other = enqueue_message("+5215500000015", "hola")
+        MessageJob.objects.filter(id=other.id).update(
+            status=MessageJob.STATUS_RUNNING, attempts=1, started_at=timezone.now() - timedelta(hours=1)
+        )
+
+        self.assertEqual(requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((job.status, other.status), (MessageJob.STATUS_FAILED, MessageJob.STATUS_PENDING))
+        self.send_message.assert_called_once_with(self.phone, settings.BOT_TOOLS_DONE_REPLY)
+
+    def test_progress_is_recorded_before_the_tools_run(self):
+        job = enqueue_message(self.phone, "vendí 2 coca")
+        self.client.beta.threads.runs.create.return_value = fake_run('requires_action', "vender_producto")
+        self.client.beta.threads.runs.submit_tool_outputs.return_value = fake_run('completed')
+        seen = []
+
+        def tools(tool_calls, user):
+            seen.append(MessageJob.objects.values_list('thread_id', 'run_id', 'tools_ran').get(id=job.id))
+            return tool_outputs(tool_calls, user)
+
+        with mock.patch('messagesApp.botClass.dispatch_tool_calls', side_effect=tools):
+            self.assertTrue(process_jobs(claim_next_jobs()))
+        self.assertEqual(seen, [("thread_1", "run_1", True)])
+
+    def test_retry_reuses_the_reply_of_a_run_that_completed(self):
+        self.stale(thread_id="thread_1", run_id="run_1")
+        requeue_stale_jobs()
+        self.client.beta.threads.runs.retrieve.return_value = fake_run('completed')
+
+        self.assertTrue(process_jobs(claim_next_jobs()))
+        self.client.beta.threads.messages.create.assert_not_called()
+        self.client.beta.threads.runs.create.assert_not_called()
+        self.send_message.assert_called_once_with(self.phone, "listo")
+
+    def test_retry_cancels_the_active_run_and_does_not_repost_the_message(self):
+        self.stale(thread_id="thread_1", run_id="run_1")
+        requeue_stale_jobs()
+        self.client.beta.threads.runs.retrieve.side_effect = [fake_run('in_progress'), fake_run('cancelled')]
+        self.client.beta.threads.runs.create.return_value = fake_run('completed', run_id="run_2")
+
+        self.assertTrue(process_jobs(claim_next_jobs()))
+        self.client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+        self.client.beta.threads.messages.create.assert_not_called()
+        self.client.beta.threads.runs.create.assert_called_once()
+        self.assertEqual(MessageJob.objects.get().run_id, "run_2")
+
+
+def event(name, data):
+    return SimpleNamespace(event=name, data=data)
+
+
+def message(text):
+    return SimpleNamespace(content=[SimpleNamespace(text=SimpleNamespace(value=text))])
+
+
+# EL CICLO DEL RUN: CON POLLING LAS ESPERAS CRECEN AL DOBLE HASTA BOT_POLL_MAX_DELAY Y VUELVEN
+# A EMPEZAR CUANDO CAMBIA EL ESTADO; CON STREAMING LAS HERRAMIENTAS SE ENTREGAN EN UN STREAM NUEVO.
+@override_settings(BOT_POLL_INITIAL_DELAY=0.05, BOT_POLL_MAX_DELAY=0.15, BOT_RUN_DEADLINE_SECONDS=60)
+class BotRunLoopTest(TestCase):
+    def setUp(self):
+        caches['threads'].clear()
+        self.user = CustomUser.objects.create(phone="+5215500000018")
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_1")
+        self.client = mock.Mock()
+        with mock.patch('messagesApp.clients.openai', return_value=self.client):
+            self.bot = Bot(self.user)
+        patcher = mock.patch('messagesApp.botClass.dispatch_tool_calls', side_effect=tool_outputs)
+        self.tools = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(BOT_RUN_STREAMING=False)
+    def test_polling_backs_off_and_restarts_when_the_status_changes(self):
+        statuses = ['queued', 'queued', 'in_progress', 'in_progress', 'in_progress', 'completed']
+        self.client.beta.threads.runs.create.return_value = fake_run('queued')
+        self.client.beta.threads.runs.retrieve.side_effect = [fake_run(status) for status in statuses]
+        self.client.beta.threads.messages.list.return_value = SimpleNamespace(data=[message("listo")])
+
+        # Sin jitter cada espera es el tope de su intervalo
+        with mock.patch('messagesApp.botClass.random.uniform', side_effect=lambda low, high: high), \
+                mock.patch('messagesApp.botClass.time.sleep') as sleep:
+            self.assertEqual(self.bot.run("hola"), "listo")
+
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [0.05, 0.1, 0.15, 0.05, 0.1, 0.15])
+
+    @override_settings(BOT_RUN_STREAMING=True)
+    def test_streaming_submits_tool_outputs_and_reads_the_next_stream(self):
+        requires_action = fake_run('requires_action', "vender_producto", "generar_reporte_ventas")
+        self.client.beta.threads.runs.stream.return_value = contextlib.nullcontext([
+            event('thread.run.created', fake_run('queued')),
+            event('thread.run.requires_action', requires_action),
+            event('thread.message.completed', message("no se debe leer")),
+        ])
+        self.client.beta.threads.runs.submit_tool_outputs_stream.return_value = contextlib.nullcontext([
+            event('thread.message.completed', message("listo")),
+            event('thread.run.completed', fake_run('completed')),
+        ])
+
+        self.assertEqual(self.bot.run("vendí 2 coca"), "listo")
+        tool_calls = requires_action.required_action.submit_tool_outputs.tool_calls
+        self.tools.assert_called_once_with(tool_calls, self.user)
+        self.client.beta.threads.runs.submit_tool_outputs_stream.assert_called_once_with(
+            thread_id="thread_1", run_id="run_1", tool_outputs=tool_outputs(tool_calls, self.user), timeout=mock.ANY,
+        )
+
+
+# SI SE ACABA EL PLAZO DEL MENSAJE SE CANCELA EL RUN. ANTES DE LAS HERRAMIENTAS EL USUARIO
+# PUEDE REINTENTAR; DESPUÉS NO, PORQUE LA VENTA YA QUEDÓ REGISTRADA.
+@override_settings(BOT_RUN_STREAMING=False, BOT_RUN_DEADLINE_SECONDS=0.05)
+class RunDeadlineTest(TestCase):
+    def setUp(self):
+        caches['threads'].clear()
+        self.user = CustomUser.objects.create(phone="+5215500000013")
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_1")
+
+    def sync_bot(self, tool_seconds):
+        client = mock.Mock()
+        client.beta.threads.runs.create.return_value = fake_run('requires_action', "vender_producto")
+        client.beta.threads.runs.submit_tool_outputs.return_value = fake_run('in_progress')
+        client.beta.threads.runs.retrieve.return_value = fake_run('in_progress')
+
+        def slow_tools(tool_calls, user):
+            time.sleep(tool_seconds)
+            return tool_outputs(tool_calls, user)
+
+        with mock.patch('messagesApp.clients.openai', return_value=client):
+            bot = Bot(self.user)
+        patcher = mock.patch('messagesApp.botClass.dispatch_tool_calls', side_effect=slow_tools)
+        self.tools = patcher.start()
+        self.addCleanup(patcher.stop)
+        return bot, client
+
+    def test_tool_that_outlives_the_deadline_is_reported_as_registered(self):
+        bot, client = self.sync_bot(tool_seconds=0.1)
+        self.assertEqual(bot.run("vendí 2 coca"), settings.BOT_TOOLS_DONE_REPLY)
+
+        # Las salidas se entregan al asistente y después se cancela el run
+        client.beta.threads.runs.submit_tool_outputs.assert_called_once()
+        client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+
+    def test_deadline_before_any_tool_asks_to_try_again(self):
+        bot, client = self.sync_bot(tool_seconds=0)
+
+        def slow_run(**kwargs):
+            bot.deadline = time.monotonic()
+            return fake_run('requires_action', "vender_producto")
+
+        client.beta.threads.runs.create.side_effect = slow_run
+        self.assertEqual(bot.run("vendí 2 coca"), settings.BOT_TIMEOUT_REPLY)
+        self.tools.assert_not_called()
+        client.beta.threads.runs.cancel.assert_called_once_with(thread_id="thread_1", run_id="run_1")
+
+    async def test_async_reply_waits_for_tools_still_running(self):
+        client = mock.Mock()
+        client.beta.threads.messages.create = mock.AsyncMock()
+        client.beta.threads.runs.create = mock.AsyncMock(return_value=fake_run('requires_action', "vender_producto"))
+        client.beta.threads.runs.submit_tool_outputs = mock.AsyncMock(return_value=fake_run('in_progress'))
+        client.beta.threads.runs.cancel = mock.AsyncMock()
+        finished = []
+
+        def slow_tools(tool_calls, user):
+            # asyncio.wait_for no puede detener este hilo
+            time.sleep(0.6)
+            finished.append(True)
+            return tool_outputs(tool_calls, user)
+
+        with mock.patch('messagesApp.clients.async_openai', return_value=client), \
+                mock.patch('messagesApp.botClass.dispatch_tool_calls_in_thread', side_effect=slow_tools):
+            bot = await AsyncBot.create(self.user)
+            # El plazo no debe incluir la primera importación de openai (la hace converse)
+            import openai  # noqa: F401
+            bot.deadline = time.monotonic() + 0.2
+            reply = await bot.run("vendí 2 coca")
+
+        self.assertEqual(reply, settings.BOT_TOOLS_DONE_REPLY)
+        self.assertEqual(finished, [True])
+        client.beta.threads.runs.cancel.assert_awaited_once_with(thread_id="thread_1", run_id="run_1")
+
+
+# EL CACHÉ DE THREADS ES LOCAL A CADA PROCESO: AL REEMPLAZAR UN THREAD QUE YA NO EXISTE SE
+# USA EL QUE OTRO WORKER HAYA GUARDADO, Y NUNCA SE PISA UN REEMPLAZO AJENO.
+class ThreadReplacementTest(TestCase):
+    def setUp(self):
+        caches['threads'].clear()
+        self.user = CustomUser.objects.create(phone="+5215500000003")
+        self.bot = Bot.__new__(Bot)
+        self.bot.user = self.user
+        self.bot.thread_id = "thread_old"
+        self.bot.client = mock.Mock()
+        self.bot.client.beta.threads.create.return_value.id = "thread_mine"
+
+    def test_creates_a_thread_when_the_stored_one_is_gone(self):
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_old", message_count=7)
+        self.assertEqual(self.bot.replace_thread(), "thread_mine")
+        conversation = Conversation.objects.get(user_conversation=self.user)
+        self.assertEqual((conversation.thread_id, conversation.message_count), ("thread_mine", 0))
+        self.assertEqual(caches['threads'].get(thread_cache_key(self.user)), "thread_mine")
+
+    def test_reuses_a_thread_another_worker_already_stored(self):
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_other")
+        self.assertEqual(self.bot.replace_thread(), "thread_other")
+        self.bot.client.beta.threads.create.assert_not_called()
+        self.assertEqual(Conversation.objects.get(user_conversation=self.user).thread_id, "thread_other")
+
+    def test_keeps_a_replacement_saved_in_between(self):
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_old")
+
+        def replaced_by_another_worker(**kwargs):
+            Conversation.objects.filter(user_conversation=self.user).update(thread_id="thread_other")
+            return mock.Mock(id="thread_mine")
+
+        self.bot.client.beta.threads.create.side_effect = replaced_by_another_worker
+        self.assertEqual(self.bot.replace_thread(), "thread_other")
+        self.assertEqual(Conversation.objects.get(user_conversation=self.user).thread_id, "thread_other")
+
+    def test_run_on_a_thread_rotated_by_another_worker_reloads_it(self):
+        # Otro worker rotó el thread; el cache local de este proceso sigue con el viejo
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_other", message_count=3)
+        caches['threads'].set(thread_cache_key(self.user), "thread_old")
+
+        self.assertIsNone(threads.record_run(self.user, "thread_old", 100))
+        self.bot.reload_thread()
+        self.assertEqual(self.bot.thread_id, "thread_other")
+        self.assertEqual(caches['threads'].get(thread_cache_key(self.user)), "thread_other")
+        self.assertFalse(threads.record_run(self.user, self.bot.thread_id, 100))
+        self.assertEqual(Conversation.objects.get(user_conversation=self.user).message_count, 4)
+
+
+# ROTACIÓN COMPLETA: EL RUN QUE LLEGA AL LÍMITE DEJA LA ROTACIÓN PENDIENTE, Y DESPUÉS DE
+# RESPONDER SE CREA EL THREAD NUEVO SEMBRADO CON EL RESUMEN Y REEMPLAZA AL VIEJO EN UN SOLO
+# UPDATE CONDICIONAL.
+@override_settings(BOT_RUN_STREAMING=False, BOT_THREAD_MAX_MESSAGES=2, BOT_THREAD_MAX_TOKENS=0)
+class ThreadRotationTest(TestCase):
+    def setUp(self):
+        caches['threads'].clear()
+        self.user = CustomUser.objects.create(phone="+5215500000022")
+        Conversation.objects.create(user_conversation=self.user, thread_id="thread_1")
+        self.client = mock.Mock()
+        self.client.beta.threads.runs.create.return_value = fake_run('completed')
+        self.client.beta.threads.messages.list.return_value = SimpleNamespace(data=[
+            SimpleNamespace(role='assistant', metadata={}, content=message("listo").content),
+            SimpleNamespace(role='user', metadata={}, content=message("vendí 2 coca").content),
+        ])
+        self.client.beta.threads.create.return_value = SimpleNamespace(id="thread_2")
+
+    def converse(self):
+        with mock.patch('messagesApp.clients.openai', return_value=self.client):
+            bot = Bot(self.user)
+        self.assertEqual(bot.run("vendí 2 coca"), "listo")
+        bot.rotate_if_due()
+        return bot
+
+    def test_threshold_rotates_into_a_seeded_thread(self):
+        # El primer mensaje no llega al límite
+        self.assertEqual(self.converse().thread_id, "thread_1")
+        self.client.beta.threads.create.assert_not_called()
+
+        bot = self.converse()
+        self.assertEqual(bot.thread_id, "thread_2")
+        self.assertEqual(caches['threads'].get(thread_cache_key(self.user)), "thread_2")
+        conversation = Conversation.objects.get(user_conversation=self.user)
+        self.assertEqual((conversation.thread_id, conversation.message_count), ("thread_2", 0))
+        self.assertIn("Tendero: vendí 2 coca", conversation.summary)
+        seed, = self.client.beta.threads.create.call_args.kwargs['messages']
+        self.assertIn(conversation.summary, seed['content'])
+
+        # El siguiente mensaje ya va al thread nuevo
+        self.converse()
+        self.assertEqual(self.client.beta.threads.messages.create.call_args.kwargs['thread_id'], "thread_2")
+
+    def test_rotation_by_another_worker_is_kept(self):
+        Conversation.objects.filter(user_conversation=self.user).update(message_count=1)
+
+        def rotated_by_another_worker(**kwargs):
+            Conversation.objects.filter(user_conversation=self.user).update(thread_id="thread_other", message_count=0)
+            return SimpleNamespace(id="thread_2")
+
+        self.client.beta.threads.create.side_effect = rotated_by_another_worker
+        bot = self.converse()
+        self.assertEqual(bot.thread_id, "thread_other")
+        self.assertEqual(Conversation.objects.get(user_conversation=self.user).thread_id, "thread_other")
+        self.assertEqual(caches['threads'].get(thread_cache_key(self.user)), "thread_other")
+
+
+# OTRO PROCESO AGREGA UN PRODUCTO SIN QUE ESTE SE ENTERE (CACHÉ LOCAL): UN ITEM QUE NO SE
+# ENCUENTRA EN UN ÍNDICE VIEJO LO RECONSTRUYE.
+class InventoryIndexMissTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        inventory_index.clear()
+        self.addCleanup(inventory_index.clear)
+        self.user = CustomUser.objects.create(phone="+5215500000004")
+        self.stock("Coca Cola", "600 ml")
+        self.item = SaleItem(name_unit_key("Gansitos Marinela", "1 pieza"), "", "Botanas")
+
+    def stock(self, name, amount):
+        product = Product.objects.create(name=name, category="Botanas", amount=amount)
+        AuxProdUser.objects.create(user_aux=self.user, product_aux=product, quantity=10, buying_price=5)
+
+    def test_stale_index_is_rebuilt_on_a_miss(self):
+        index = inventory_index.get(self.user, "Botanas")
+        self.stock("Gansito Marinela", "1 pieza")
+
+        with override_settings(PRODUCT_MATCH_ANY_CATEGORY=False):
+            # Un índice recién construido no se vuelve a leer en cada item desconocido
+            self.assertIsNone(match_items(self.user, [self.item])[0].aux_id)
+            index.built_at -= inventory_index.miss_refresh
+            self.assertIsNotNone(match_items(self.user, [self.item])[0].aux_id)
+
+
+# LA MARCA QUE DA EL ASISTENTE PUEDE SER SOLO EL INICIO DE LA GUARDADA ("coca" / "Coca-Cola")
+class ExactMatchTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(phone="+5215500000017")
+        self.aux = {brand: self.stock(brand) for brand in ("Coca-Cola", "Coca")}
+
+    def stock(self, brand):
+        product = Product.objects.create(name="Refresco", brand=brand, category="Bebidas", amount="600 ml")
+        return AuxProdUser.objects.create(user_aux=self.user, product_aux=product, quantity=10, buying_price=5).id
+
+    def match(self, *brands):
+        items = [SaleItem(name_unit_key("Refresco", "600 ml"), brand, "Bebidas") for brand in brands]
+        results = [_no_match('no_category') for _ in items]
+        _match_exact(self.user, items, results)
+        return [result.aux_id for result in results]
+
+    def test_brand_prefix_matches_and_exact_brand_wins(self):
+        self.assertEqual(
+            self.match("coca", "cocacola", "cocac", "", "pepsi", "co"),
+            [self.aux["Coca"], self.aux["Coca-Cola"], self.aux["Coca-Cola"], self.aux["Coca-Cola"], None, None],
+        )
+
+
+# EL MATCHING POR LOTES (cdist) DEBE ELEGIR LO MISMO QUE extractOne ITEM POR ITEM: EN EMPATE EL
+# PRIMER PRODUCTO DEL ÍNDICE, UN PUNTAJE IGUAL AL UMBRAL CUENTA Y LA MARCA DEBE COINCIDIR.
+class BatchMatcherTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        inventory_index.clear()
+        self.addCleanup(inventory_index.clear)
+        self.user = CustomUser.objects.create(phone="+5215500000019")
+        self.aux = {}
+        for name, brand, category, amount in [
+            ("Agua Natural", "Bonafont", "Bebidas", "1 l"),
+            ("Agua Natural", "Ciel", "Bebidas", "1 l"),
+            ("Papas Adobadas", "Sabritas", "Botanas", "45 g"),
+            ("Papas Saladas", "Sabritas", "Botanas", "45 g"),
+        ]:
+            product = Product.objects.create(name=name, brand=brand, category=category, amount=amount)
+            self.aux[(name, brand)] = AuxProdUser.objects.create(
+                user_aux=self.user, product_aux=product, quantity=10, buying_price=5
+            ).id
+
+    def items(self):
+        return [
+            SaleItem(name_unit_key("Agua Natural", "1 l"), "", "Bebidas"),
+            SaleItem(name_unit_key("Agua Natural", "1l"), "ciel", "Bebidas"),
+            SaleItem(name_unit_key("Papas Adobada", "45 g"), "sabritas", "Botanas"),
+            SaleItem(name_unit_key("Papas Adobadas", "45 g"), "barcel", "Botanas"),
+            SaleItem(name_unit_key("Leche Entera", "1 l"), "", "Lacteos"),
+        ]
+
+    def batch(self, matcher, threshold):
+        items = self.items()
+        results = [_no_match('no_category') for _ in items]
+        matcher(inventory_index.get(self.user, None), items, range(len(items)), results, threshold)
+        return results
+
+    def test_batch_agrees_with_one_by_one(self):
+        for threshold in (60, 80, 95):
+            with self.subTest(threshold=threshold):
+                self.assertEqual(
+                    self.batch(_match_in_index, threshold), self.batch(_match_in_index_loop, threshold)
+                )
+
+        results = self.batch(_match_in_index, 80)
+        self.assertEqual([result.aux_id for result in results[:3]], [
+            self.aux[("Agua Natural", "Bonafont")],  # Empate: el primero del índice
+            self.aux[("Agua Natural", "Ciel")],
+            self.aux[("Papas Adobadas", "Sabritas")],
+        ])
+        self.assertEqual([result.reason for result in results[3:]], ['brand', 'no_match'])
+
+    def test_score_equal_to_the_threshold_matches(self):
+        score = int(fuzz.token_sort_ratio(self.items()[2].nombre_unidad, name_unit_key("Papas Adobadas", "45 g")))
+        self.assertIsNotNone(self.batch(_match_in_index, score)[2].aux_id)
+        self.assertIsNone(self.batch(_match_in_index, score + 1)[2].aux_id)
+
+    # Cada item se busca en su categoría; con PRODUCT_MATCH_ANY_CATEGORY también en el resto
+    def test_mixed_category_batch(self):
+        items = [
+            SaleItem(name_unit_key("Papas Saladas", "45g"), "sabritas", "Botanas"),
+            SaleItem(name_unit_key("Agua Natural", "1l"), "bonafont", "Bebidas"),
+            SaleItem(name_unit_key("Papas Adobadas", "45g"), "sabritas", "Bebidas"),
+        ]
+        expected = [self.aux[("Papas Saladas", "Sabritas")], self.aux[("Agua Natural", "Bonafont")]]
+        with override_settings(PRODUCT_MATCH_ANY_CATEGORY=False):
+            self.assertEqual([result.aux_id for result in match_items(self.user, items)], expected + [None])
+        with override_settings(PRODUCT_MATCH_ANY_CATEGORY=True):
+            self.assertEqual(
+                [result.aux_id for result in match_items(self.user, items)],
+                expected + [self.aux[("Papas Adobadas", "Sabritas")]],
+            )
+
+
+# VENTAS: EL CARRITO SE REGISTRA COMPLETO O NO SE REGISTRA, NUNCA SE VENDE MÁS DE LO QUE HAY
+# Y EL RESUMEN DIARIO CUADRA CON LAS TRANSACCIONES.
+class SellProductTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        inventory_index.clear()
+        self.addCleanup(inventory_index.clear)
+        self.user = CustomUser.objects.create(phone="+5215500000005")
+        self.coca = self.stock("Coca Cola", "Coca-Cola", "600 ml", 5, 11)
+        self.sabritas = self.stock("Papas Sabritas", "Sabritas", "45 g", 3, 9)
+
+    def stock(self, name, brand, amount, quantity, buying_price):
+        product = Product.objects.create(name=name, brand=brand, category="Botanas", amount=amount)
+        return AuxProdUser.objects.create(
+            user_aux=self.user, product_aux=product, quantity=quantity, buying_price=buying_price
+        )
+
+    def sell(self, price, *lines):
+        return sell_product({
+            'productos': [
+                {'nombre': aux.product_aux.name, 'marca': aux.product_aux.brand, 'categoría': "Botanas",
+                 'unidad_medida': aux.product_aux.amount, 'cantidad': cantidad}
+                for aux, cantidad in lines
+            ],
+            'precio_venta': price,
+        }, self.user)
+
+    def quantities(self):
+        return dict(AuxProdUser.objects.filter(user_aux=self.user).values_list('id', 'quantity'))
+
+    def test_oversell_is_rejected(self):
+        output = self.sell(18, (self.coca, 6), (self.sabritas, 1))
+
+        self.assertIn("No hay suficientes unidades del producto 'Coca Cola'", output)
+        self.assertEqual(self.quantities(), {self.coca.id: 5, self.sabritas.id: 2})
+        self.assertEqual(
+            list(Transaction.objects.values_list('product_transaction__name', 'quantity')), [("Papas Sabritas", 1)]
+        )
+
+    def test_failure_mid_basket_rolls_back_everything(self):
+        with mock.patch('messagesApp.botClass.actualizar_ventas_diarias', side_effect=IntegrityError):
+            output = self.sell(18, (self.coca, 2), (self.sabritas, 3))
+
+        self.assertIn("cambió mientras se procesaba la venta", output)
+        self.assertEqual(self.quantities(), {self.coca.id: 5, self.sabritas.id: 3})
+        self.assertFalse(Transaction.objects.exists())
+        self.assertFalse(DailySales.objects.exists())
+
+    def test_daily_sales_match_transactions(self):
+        self.sell(18, (self.coca, 2), (self.sabritas, 1))
+        self.sell(20, (self.coca, 1))
+        self.sell(15, (self.sabritas, 2), (self.coca, 1))
+
+        # Papas Sabritas se agotó: su fila de inventario se elimina
+        self.assertEqual(self.quantities(), {self.coca.id: 1})
+        transacciones = {
+            fila['product_transaction']: fila
+            for fila in Transaction.objects.values('product_transaction').annotate(
+                unidades=Sum('quantity'),
+                ingresos=Sum(F('quantity') * F('selling_price_unitario')),
+                costo=Sum(F('quantity') * F('buying_price_unitario')),
+            )
+        }
+        resumen = {
+            fila.product_rollup_id: fila for fila in DailySales.objects.filter(user_rollup=self.user)
+        }
+        self.assertEqual(set(resumen), set(transacciones))
+        for product_id, fila in resumen.items():
+            esperado = transacciones[product_id]
+            self.assertEqual(fila.quantity, esperado['unidades'])
+            self.assertAlmostEqual(fila.revenue, esperado['ingresos'])
+            self.assertAlmostEqual(fila.cost, esperado['costo'])
+        self.assertEqual(resumen[self.coca.product_aux_id].quantity, 4)
+
+
+# EL REPORTE SOBRE EL RESUMEN DIARIO DEBE DAR LO MISMO QUE SOBRE LAS TRANSACCIONES, TAMBIÉN
+# CUANDO EL PERIODO EMPIEZA A MEDIO DÍA.
+class SalesReportRollupTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(phone="+5215500000006")
+        self.now = timezone.make_aware(datetime(2026, 3, 15, 12))
+        coca = Product.objects.create(name="Coca Cola", brand="Coca-Cola", category="Bebidas", amount="600 ml")
+        papas = Product.objects.create(name="Papas", brand="Sabritas", category="Botanas", amount="45 g")
+        ventas = [
+            (coca, 4, timedelta(days=3, hours=1)),  # Antes del inicio, en el primer día
+            (coca, 2, timedelta(days=3, hours=-1)),  # Después del inicio, en el primer día
+            (papas, 3, timedelta(days=2, hours=20)),
+            (papas, 1, timedelta(days=1)),
+            (coca, 5, timedelta(hours=1)),
+        ]
+        for product, quantity, antes in ventas:
+            venta = Transaction.objects.create(
+                product_transaction=product, user_transaction=self.user, quantity=quantity,
+                buying_price_unitario=7, selling_price_unitario=12,
+            )
+            Transaction.objects.filter(id=venta.id).update(time=self.now - antes)
+        call_command('rebuild_sales_rollup', stdout=mock.Mock())
+
+    def report(self, use_rollup, *args):
+        with override_settings(SALES_REPORT_USE_ROLLUP=use_rollup), mock.patch('django.utils.timezone.now', return_value=self.now):
+            return generate_sales_report(self.user, *args)
+
+    def test_rollup_matches_transactions(self):
+        for args in [('days', 3, None, 0), ('days', 3, 'product', 2), ('days', 3, 'day', 0), ('weeks', 1, 'category', 1)]:
+            with self.subTest(args=args):
+                self.assertEqual(self.report(True, *args), self.report(False, *args))
+        self.assertIn("Total de productos vendidos: 11\n", self.report(True, 'days', 3))
+
+    def test_breakdown_and_top_come_ordered_and_limited_from_the_database(self):
+        report = self.report(True, 'days', 3, 'day', 1)
+        dias = [line[2:12] for line in report.splitlines() if line.startswith("- ")]
+        self.assertEqual(dias, sorted(dias))
+        self.assertEqual(len(dias), len(set(dias)))
+        self.assertIn("1. Coca Cola 600 ml (Coca-Cola): 7 unidades\n", report)
+        self.assertNotIn("2. ", report)
+
+
+# UNA CARGA DE INVENTARIO JUNTA LAS LÍNEAS REPETIDAS, CUENTA BIEN LOS REGISTROS CREADOS Y
+# ACTUALIZADOS Y CUESTA LAS MISMAS QUERIES SIN IMPORTAR CUÁNTAS LÍNEAS TRAE.
+@override_settings(PRODUCT_CANONICAL_THRESHOLD=0)
+class ProductBatchTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(phone="+5215500000020")
+        product = Product.objects.create(name="Coca Cola", brand="Coca-Cola", category="Bebidas", amount="600 ml")
+        AuxProdUser.objects.create(user_aux=self.user, product_aux=product, quantity=5, buying_price=11)
+
+    def line(self, name, quantity, brand="Coca-Cola"):
+        return {'name': name, 'brand': brand, 'category': "Bebidas", 'amount': "600 ml", 'buying_price': 11, 'quantity': quantity}
+
+    def test_duplicate_lines_are_merged(self):
+        with self.assertNumQueries(8):
+            output = process_product_batch({'products': [
+                self.line("Coca Cola", 3), self.line("Coca Cola Light", 2), self.line("Coca Cola", 4),
+                self.line("Coca Cola Light", 6), self.line("Coca Cola Zero", 0),
+            ]}, self.user)
+
+        self.assertEqual(output, "Batch processed successfully. Created: 1, updated: 1. Status: 201")
+        self.assertEqual(
+            dict(AuxProdUser.objects.filter(user_aux=self.user).values_list('product_aux__name', 'quantity')),
+            {"Coca Cola": 12, "Coca Cola Light": 8},
+        )
+        self.assertFalse(Product.objects.filter(name="Coca Cola Zero").exists())
+
+    def test_queries_do_not_grow_with_the_batch(self):
+        lines = [self.line(f"Refresco {i}", 1, brand=f"Marca {i}") for i in range(20)] + [self.line("Coca Cola", 1)]
+        with self.assertNumQueries(8):
+            output = process_product_batch({'products': lines * 2}, self.user)
+        self.assertEqual(output, "Batch processed successfully. Created: 20, updated: 1. Status: 201")
+
+
+# LOS REPORTES POR MESES USAN MESES CALENDARIO: EL MISMO DÍA N MESES ANTES, RECORTADO AL FIN DE
+# MES, AUNQUE EL PERIODO CRUCE DE AÑO.
+class CalendarMonthTest(TestCase):
+    def test_months_back_keep_the_day_or_clip_it(self):
+        casos = [
+            ((2026, 3, 31), 1, (2026, 2, 28)),
+            ((2024, 3, 31), 1, (2024, 2, 29)),
+            ((2026, 5, 31), 3, (2026, 2, 28)),
+            ((2026, 1, 15), 2, (2025, 11, 15)),
+            ((2026, 2, 28), 14, (2024, 12, 28)),
+            ((2026, 12, 31), 12, (2025, 12, 31)),
+        ]
+        for fecha, meses, esperada in casos:
+            with self.subTest(fecha=fecha, meses=meses):
+                self.assertEqual(restar_meses(datetime(*fecha, 12), meses), datetime(*esperada, 12))
+
+    def test_report_window_crosses_the_year(self):
+        user = CustomUser.objects.create(phone="+5215500000021")
+        product = Product.objects.create(name="Papas", brand="Sabritas", category="Botanas", amount="45 g")
+        now = timezone.make_aware(datetime(2026, 1, 15, 12))
+        for quantity, time in [(1, datetime(2025, 11, 15, 11)), (2, datetime(2025, 11, 15, 13)), (4, datetime(2026, 1, 2, 12))]:
+            venta = Transaction.objects.create(
+                product_transaction=product, user_transaction=user, quantity=quantity,
+                buying_price_unitario=7, selling_price_unitario=12,
+            )
+            Transaction.objects.filter(id=venta.id).update(time=timezone.make_aware(time))
+
+        with override_settings(SALES_REPORT_USE_ROLLUP=False), mock.patch('django.utils.timezone.now', return_value=now):
+            report = generate_sales_report(user, 'months', 2, 'month')
+        self.assertIn("Total de productos vendidos: 6\n", report)
+        self.assertIn("- 2025-11-01: 2 unidades", report)
+        self.assertIn("- 2026-01-01: 4 unidades", report)
+
+
+# UN PRODUCTO SIN MARCA (NULL O '') NO SE PUEDE DUPLICAR, Y CARGARLO DE NUEVO SUMA AL MISMO
+class ProductWithoutBrandTest(TestCase):
+    def setUp(self):
+        self.user = CustomUser.objects.create(phone="+5215500000007")
+
+    def test_null_and_empty_brand_are_the_same_product(self):
+        Product.objects.create(name="Tortillas", brand=None, amount="1 kg")
+        with self.assertRaises(IntegrityError):
+            Product.objects.create(name="Tortillas", brand="", amount="1 kg")
+
+    @override_settings(PRODUCT_CANONICAL_THRESHOLD=0)
+    def test_batch_reuses_the_product_without_brand(self):
+        for brand in ("", None):
+            output = process_product_batch({'products': [
+                {'name': "Tortillas", 'brand': brand, 'category': "Otros", 'amount': "1 kg", 'buying_price': 20, 'quantity': 3},
+            ]}, self.user)
+            self.assertTrue(output.endswith("Status: 201"), output)
+
+        self.assertEqual(Product.objects.filter(name="Tortillas").count(), 1)
+        self.assertEqual(AuxProdUser.objects.get(user_aux=self.user).quantity, 6)
+
+
+# OMITIR LOS TRIGRAMAS MÁS COMUNES NO CAMBIA EL RESULTADO: DA LO MISMO QUE COMPARAR LA CLAVE
+# CON TODO EL CATÁLOGO.
+class NgramSearchBackendTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        names = ["coca cola", "coca cola light", "pepsi", "agua natural", "leche entera", "leche light",
+                 "galletas maria", "papas", "cola de caballo", "agua mineral"]
+        Product.objects.bulk_create([
+            Product(name=name, amount=amount).with_match_keys()
+            for name in names for amount in ("600 ml", "1 l", "355 ml")
+        ])
+
+    def brute_force(self, key, limit, min_similarity):
+        grams = trigrams(key)
+        scored = []
+        for product_id, match_key in Product.objects.values_list('id', 'match_key'):
+            other = trigrams(match_key)
+            similarity = len(grams & other) / len(grams | other)
+            if similarity >= min_similarity:
+                scored.append((similarity, product_id))
+        return [product_id for _, product_id in sorted(scored, reverse=True)[:limit]]
+
+    def test_matches_brute_force(self):
+        keys = [name_unit_key(name, amount) for name, amount in [
+            ("coca cola", "600 ml"), ("coca", "600ml"), ("leche", "1 l"), ("agua", "355 ml"), ("xyz", "1 kg"),
+        ]]
+        for min_similarity in (0.1, 0.3, 0.6):
+            results = NgramSearchBackend(ttl=3600, min_similarity=min_similarity).search(keys, 5)
+            for key in keys:
+                with self.subTest(key=key, min_similarity=min_similarity):
+                    self.assertEqual(results[key], self.brute_force(key, 5, min_similarity))
+
+    # Solo corre en PostgreSQL con pg_trgm: todas las claves se buscan en una sola query
+    def test_trigram_backend_searches_every_key_at_once(self):
+        if not TrigramSearchBackend.available():
+            self.skipTest("requiere PostgreSQL con pg_trgm")
+        keys = [name_unit_key(name, amount) for name, amount in [("coca cola", "600 ml"), ("leche", "1 l"), ("xyz", "1 kg")]]
+        with self.assertNumQueries(2):
+            results = TrigramSearchBackend(min_similarity=0.3).search(keys + keys[:1], 50)
+        for key in keys:
+            with self.subTest(key=key):
+                self.assertEqual(set(results[key]), set(self.brute_force(key, 50, 0.3)))
+
+    def test_backends_must_implement_search(self):
+        with self.assertRaises(TypeError):
+            type('Incomplete', (ProductSearchBackend,), {})()
+
+
+# token_set_ratio DA 100 CON UNA SOLA PALABRA DEL NOMBRE: EL FAST PATH NO DEBE ADIVINAR NI EL
+# PRODUCTO NI SU PRESENTACIÓN
+class FastPathMatchTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+        inventory_index.clear()
+        self.user = CustomUser.objects.create(phone="+5215500000016")
+        for name, amount in [("Coca Cola Light", "2 l"), ("Agua", "1 l"), ("Agua", "600 ml")]:
+            product = Product.objects.create(name=name, brand="", category="Bebidas", amount=amount)
+            AuxProdUser.objects.create(user_aux=self.user, product_aux=product, quantity=10, buying_price=10)
+
+    def find(self, producto, unidad=None):
+        product, reason = _find_product(self.user, {'producto': producto, 'unidad': unidad})
+        return (product.name, product.amount) if product else reason
+
+    def test_one_word_of_a_longer_name_is_not_enough(self):
+        self.assertEqual(self.find("coca"), 'no_product')
+        self.assertEqual(self.find("coca light", "2 l"), ("Coca Cola Light", "2 l"))
+
+    def test_several_presentations_need_a_unit(self):
+        self.assertEqual(self.find("agua"), 'ambiguous_unit')
+        self.assertEqual(self.find("agua", "600ml"), ("Agua", "600 ml"))
+
+
+class FastPathParserTest(TestCase):
+    def test_sale_restock_and_report(self):
+        self.assertEqual(parse_intent("Vendí 2 coca 600ml a $18.50"), ('sale', {
+            'cantidad': 2, 'producto': "coca", 'unidad': "600ml", 'precio': 18.5,
+        }))
+        self.assertEqual(parse_intent("me llegaron doce sabritas de 45 g"), ('restock', {
+            'cantidad': 12, 'producto': "sabritas", 'unidad': "45 g", 'precio': None,
+        }))
+        self.assertEqual(parse_intent("dame el reporte de los ultimos 3 dias por producto top 5"), ('report', {
+            'timeframe': 'days', 'units': 3, 'breakdown': 'product', 'top': 5,
+        }))
+
+    def test_zero_quantity_is_not_an_intent(self):
+        for text in ("vendi 0 coca a 18", "vendi 00 coca 600 ml a 18", "compre 0 sabritas a 9"):
+            with self.subTest(text=text):
+                self.assertIsNone(parse_intent(text))
+
+    # jobs.process_jobs une con saltos de línea los mensajes que llegaron juntos
+    def test_multi_line_body_is_left_to_the_assistant(self):
+        self.assertIsNone(parse_intent("vendi 2 coca a 18\nvendi 3 pepsi a 15"))
+        self.assertIsNone(parse_intent("vendi 2 coca\na 18"))
+        self.assertEqual(parse_intent("vendi 2 coca a 18\n").kind, 'sale')
+
+    def test_unsupported_messages(self):
+        for text in ("vendi 2 coca y 3 pepsi a 18", "vendi 2 coca por 36", "hola", ""):
+            with self.subTest(text=text):
+                self.assertIsNone(parse_intent(text))
+
+
+# PIPELINE ASÍNCRONO: UNA SOLA CONVERSACIÓN A LA VEZ POR NÚMERO, EN ORDEN, Y LOS MENSAJES QUE
+# LLEGAN DURANTE UN RUN SE JUNTAN EN EL SIGUIENTE.
+@override_settings(BOT_COALESCE_WINDOW=0.01, BOT_COALESCE_MAX_WAIT=0.05)
+class AsyncPipelineTest(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.handled = []
+        self.running = set()
+        self.release = None
+        patcher = mock.patch('messagesApp.views.afirst_delivery', side_effect=self.first_delivery)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.sids = set()
+
+    async def first_delivery(self, sid):
+        if sid in self.sids:
+            return False
+        self.sids.add(sid)
+        return True
+
+    async def handle(self, number, body):
+        self.assertNotIn(number, self.running, "dos runs del mismo número a la vez")
+        self.running.add(number)
+        self.handled.append((number, body))
+        if self.release is not None:
+            await self.release.wait()
+        self.running.discard(number)
+
+    async def post(self, number, body, sid=None):
+        request = self.factory.post('/reply_async/', {
+            'From': f"whatsapp:{number}", 'Body': body, 'MessageSid': sid or f"SM{len(self.sids)}",
+        })
+        await views.reply_async(request)
+
+    async def drain(self):
+        while views._conversations:
+            await asyncio.gather(*views._conversations.values())
+
+    async def test_messages_are_handled_in_order_per_number(self):
+        with mock.patch('messagesApp.views.handle_message_async', side_effect=self.handle):
+            await self.post("+5215500000010", "uno")
+            await self.post("+5215500000011", "otro")
+            await self.post("+5215500000010", "dos")
+            await self.drain()
+
+        self.assertEqual(sorted(self.handled), [("+5215500000010", "uno\ndos"), ("+5215500000011", "otro")])
+
+    async def test_messages_during_a_run_are_merged_into_the_next_one(self):
+        self.release = asyncio.Event()
+        with mock.patch('messagesApp.views.handle_message_async', side_effect=self.handle):
+            await self.post("+5215500000010", "primero")
+            while not self.handled:
+                await asyncio.sleep(0.01)
+            # El run sigue en curso: estos dos esperan y se juntan
+            await self.post("+5215500000010", "segundo")
+            await self.post("+5215500000010", "tercero")
+            self.assertEqual(len(views._conversations), 1)
+            self.release.set()
+            await self.drain()
+
+        self.assertEqual(self.handled, [("+5215500000010", "primero"), ("+5215500000010", "segundo\ntercero")])
+
+    # Otro worker de uvicorn tiene un run de este número: el mensaje queda para él
+    async def test_number_running_in_another_worker_is_left_to_it(self):
+        number = "+5215500000013"
+        other = await MessageJob.objects.acreate(phone=number, body="antes", status=MessageJob.STATUS_RUNNING)
+        with mock.patch('messagesApp.views.handle_message_async', side_effect=self.handle):
+            await self.post(number, "después")
+            await self.drain()
+            self.assertEqual(self.handled, [])
+
+            # Al terminar, la tarea del otro worker vuelve a buscar y lo encuentra
+            await MessageJob.objects.filter(id=other.id).aupdate(status=MessageJob.STATUS_DONE)
+            views._last_arrival[number] = 0
+            await views.drain_messages(number)
+
+        self.assertEqual(self.handled, [(number, "después")])
+        self.assertFalse(await MessageJob.objects.exclude(status=MessageJob.STATUS_DONE).aexists())
+
+    async def test_resent_message_is_handled_once(self):
+        with mock.patch('messagesApp.views.handle_message_async', side_effect=self.handle):
+            await self.post("+5215500000010", "vendi 2 coca a 18", sid="SMdup")
+            await self.post("+5215500000010", "vendi 2 coca a 18", sid="SMdup")
+            await self.drain()
+
+        self.assertEqual(self.handled, [("+5215500000010", "vendi 2 coca a 18")])
+
+    # Dos ventas que llegaron juntas no pueden registrarse como una sola por el fast path
+    @override_settings(BOT_FAST_PATH=True)
+    async def test_coalesced_sales_go_to_the_assistant(self):
+        bot = mock.Mock(run=mock.AsyncMock(return_value="listo"), rotate_if_due=mock.AsyncMock())
+        with mock.patch('messagesApp.botClass.AsyncBot.create', mock.AsyncMock(return_value=bot)), \
+                mock.patch('messagesApp.utils.asend_message', mock.AsyncMock()) as send, \
+                mock.patch('messagesApp.fastpath._run_intent') as run_intent:
+            await self.post("+5215500000012", "vendi 2 coca a 18")
+            await self.post("+5215500000012", "vendi 3 pepsi a 15")
+            await self.drain()
+
+        run_intent.assert_not_called()
+        bot.run.assert_awaited_once_with("vendi 2 coca a 18\nvendi 3 pepsi a 15")
+        send.assert_awaited_once_with("+5215500000012", "listo")
+
+
+# LOS REPORTES PEDIDOS EN EL MISMO LOTE QUE UNA VENTA DEBEN INCLUIRLA
+@override_settings(BOT_TOOL_WORKERS=4)
+class DispatchToolCallsTest(TestCase):
+    def tool_call(self, position, name):
+        return SimpleNamespace(id=f"call_{position}", function=SimpleNamespace(name=name, arguments=json.dumps({})))
+
+    def test_reports_run_after_stock_changes(self):
+        finished = []
+
+        def execute(function_name, args, user):
+            if function_name != "generar_reporte_ventas":
+                time.sleep(0.05)
+            finished.append(function_name)
+            return function_name
+
+        names = ["generar_reporte_ventas", "vender_producto", "generar_reporte_ventas", "mandar_productos_inventario"]
+        with mock.patch('messagesApp.botClass.execute_tool_call', side_effect=execute):
+            outputs = dispatch_tool_calls([self.tool_call(i, name) for i, name in enumerate(names)], user=None)
+
+        self.assertEqual([output['output'] for output in outputs], names)
+        self.assertEqual(finished[:2], ["vender_producto", "mandar_productos_inventario"])
+        self.assertEqual(finished[2:], ["generar_reporte_ventas"] * 2)
+
+
+class ChunkMessageTest(TestCase):
+    def test_short_message_is_one_chunk(self):
+        self.assertEqual(chunk_message("hola", 10), ["hola"])
+        self.assertEqual(chunk_message("", 10), [""])
+
+    def test_splits_on_lines_then_spaces(self):
+        self.assertEqual(chunk_message("uno dos\ntres cuatro", 12), ["uno dos", "tres cuatro"])
+        self.assertEqual(chunk_message("uno dos tres cuatro", 9), ["uno dos", "tres", "cuatro"])
+        self.assertEqual(chunk_message("abcdefghij", 4), ["abcd", "efgh", "ij"])
+
+    def test_chunks_respect_the_limit_and_keep_the_text(self):
+        body = "\n".join(f"- Producto {i}: {i} unidades, ${i * 3}.00 ingresos" for i in range(200))
+        chunks = chunk_message(body, 1600)
+        self.assertTrue(all(len(chunk) <= 1600 for chunk in chunks))
+        self.assertEqual("\n".join(chunks), body)
+
+
+# SOLO SE REINTENTA LO QUE NUNCA LLEGÓ A TWILIO O LO QUE TWILIO PIDE REINTENTAR
+@override_settings(OUTBOUND_MAX_RETRIES=2, OUTBOUND_BACKOFF=0)
+class OutboundRetryTest(TestCase):
+    def setUp(self):
+        self.sender = TwilioSender.__new__(TwilioSender)
+        self.sender.url = "https://api.twilio.test/Messages.json"
+        self.sender.from_number = "+15550000000"
+        self.sender.session = mock.Mock()
+
+    def response(self, status):
+        return mock.Mock(status_code=status, headers={}, text="")
+
+    def post(self, *results):
+        self.sender.session.post.reset_mock()
+        self.sender.session.post.side_effect = results
+        try:
+            return self.sender._post("+5215500000020", "hola")
+        finally:
+            self.attempts = self.sender.session.post.call_count
+
+    def test_connect_errors_and_retryable_statuses_are_retried(self):
+        refused = requests.ConnectionError(mock.Mock(reason=NewConnectionError(None, "refused")))
+        self.assertEqual(self.post(refused, self.response(503), self.response(201)).status_code, 201)
+        self.assertEqual(self.attempts, 3)
+        self.assertEqual(self.post(requests.ConnectTimeout(), self.response(201)).status_code, 201)
+
+    def test_read_timeout_is_not_retried(self):
+        with self.assertRaises(DeliveryError):
+            self.post(requests.ReadTimeout("read timed out"), self.response(201))
+        self.assertEqual(self.attempts, 1)
+
+    def test_dropped_connection_is_not_retried(self):
+        with self.assertRaises(DeliveryError):
+            self.post(requests.ConnectionError("Connection aborted."), self.response(201))
+        self.assertEqual(self.attempts, 1)
+
+    def test_client_errors_fail_at_once_and_retries_are_bounded(self):
+        with self.assertRaises(DeliveryError):
+            self.post(self.response(400))
+        self.assertEqual(self.attempts, 1)
+        with self.assertRaises(DeliveryError):
+            self.post(*[self.response(429)] * 3)
+        self.assertEqual(self.attempts, 3)
+
+
+# TWILIO REENVÍA EL WEBHOOK SI LA RESPUESTA TARDA: CADA MessageSid SE ENCOLA UNA SOLA VEZ
+@override_settings(WEBHOOK_DEDUP_TTL=3600)
+class WebhookIdempotencyTest(TestCase):
+    def setUp(self):
+        caches['webhooks'].clear()
+
+    def deliver(self, sid, body="vendi 2 coca a 18"):
+        request = RequestFactory().post('/message/', {'From': "whatsapp:+5215500000030", 'Body': body, 'MessageSid': sid})
+        with self.captureOnCommitCallbacks(execute=True):
+            response = views.reply(request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_duplicate_message_sid_is_enqueued_once(self):
+        self.deliver("SMaaa")
+        self.deliver("SMaaa")
+        # Otro proceso no comparte el cache: el índice único de ProcessedMessage lo detecta
+        caches['webhooks'].clear()
+        self.deliver("SMaaa")
+        self.deliver("SMbbb", "vendi 1 pepsi a 15")
+
+        self.assertEqual(
+            list(MessageJob.objects.order_by('id').values_list('body', flat=True)),
+            ["vendi 2 coca a 18", "vendi 1 pepsi a 15"],
+        )
+
+    async def test_async_duplicate_is_detected(self):
+        self.assertTrue(await afirst_delivery("SMccc"))
+        self.assertFalse(await afirst_delivery("SMccc"))
+        await caches['webhooks'].aclear()
+        self.assertFalse(await afirst_delivery("SMccc"))
+
+    def test_purge_keeps_recent_message_sids(self):
+        ProcessedMessage.objects.create(sid="SMold")
+        ProcessedMessage.objects.create(sid="SMnew")
+        ProcessedMessage.objects.filter(sid="SMold").update(created_at=timezone.now() - timedelta(hours=2))
+
+        self.assertEqual(purge_processed_messages(), 1)
+        self.assertEqual(list(ProcessedMessage.objects.values_list('sid', flat=True)), ["SMnew"])
+
+
+# LOS CONTADORES SE REGISTRAN EN LOS WORKERS: /metrics/ LOS LEE DE WorkerMetrics
+@override_settings(BOT_METRICS_TOKEN="secreto", BOT_METRICS_MAX_AGE=300)
+class MetricsViewTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def get(self):
+        return self.client.get('/metrics/', headers={'X-Metrics-Token': "secreto"})
+
+    def test_merges_metrics_published_by_other_processes(self):
+        WorkerMetrics.objects.create(process="worker:1", data={
+            'counters': {'fastpath.hit': 3, 'fastpath.miss': 1},
+            'gauges': {'outbound.queue_depth': 2},
+            'timings': {'bot.total': {'count': 3, 'p50': 2.0, 'p95': 4.0, 'p99': 4.0, 'max': 4.0}},
+        })
+        WorkerMetrics.objects.create(process="worker:old", data={'counters': {'fastpath.hit': 100}})
+        WorkerMetrics.objects.filter(process="worker:old").update(updated_at=timezone.now() - timedelta(hours=1))
+        metrics.incr('fastpath.hit')
+        metrics.observe('bot.total', 6.0)
+
+        data = self.get().json()
+
+        self.assertEqual(data['counters']['fastpath.hit'], 4)
+        self.assertEqual(data['fast_path']['hits'], 4)
+        self.assertEqual(data['outbound_queue_depth'], 2)
+        self.assertEqual(data['timings']['bot.total']['count'], 4)
+        self.assertAlmostEqual(data['timings']['bot.total']['p50'], 3.0)
+        self.assertEqual(data['timings']['bot.total']['max'], 6.0)
+        self.assertEqual(len(data['processes']), 2)
+        self.assertFalse(WorkerMetrics.objects.filter(process="worker:old").exists())
+
+    def test_requires_the_token(self):
+        self.assertEqual(self.client.get('/metrics/').status_code, 404)
@@ -0,0 +1,157 @@
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from .models import AuxProdUser, Conversation, DailySales
+
+# ROTACIÓN DE THREADS DE OPENAI. UN THREAD CRECE CON CADA MENSAJE Y CADA RUN VUELVE A LEER
+# TODO SU CONTENIDO, ASÍ QUE DESPUÉS DE BOT_THREAD_MAX_MESSAGES MENSAJES O CUANDO UN RUN
+# CONSUME MÁS DE BOT_THREAD_MAX_TOKENS TOKENS DE ENTRADA, EL BOT PASA A UN THREAD NUEVO.
+# EL THREAD NUEVO EMPIEZA CON UN SOLO MENSAJE: UN RESUMEN DE LOS ÚLTIMOS MENSAJES Y LOS DATOS
+# CLAVE DEL INVENTARIO, QUE TAMBIÉN SE GUARDAN EN Conversation.
+
+SEED_METADATA = {'seed': 'rotation'}
+
+
+def rotation_due(message_count, context_tokens):
+    max_messages = settings.BOT_THREAD_MAX_MESSAGES
+    max_tokens = settings.BOT_THREAD_MAX_TOKENS
+    return bool(
+        (max_messages and message_count >= max_messages) or (max_tokens and context_tokens >= max_tokens)
+    )
+
+
+# SUMA EL RUN AL THREAD ACTUAL Y DICE SI YA HAY QUE ROTARLO. prompt_tokens ES LO QUE LEYÓ
+# EL MODELO EN EL RUN (None SI LA API NO LO REPORTÓ). DEVUELVE None SI thread_id YA NO ES EL
+# THREAD GUARDADO: OTRO WORKER LO ROTÓ O REEMPLAZÓ Y EL CACHE 'threads' DE ESTE PROCESO QUEDÓ VIEJO.
+def record_run(user, thread_id, prompt_tokens):
+    rows = Conversation.objects.filter(user_conversation=user, thread_id=thread_id)
+    changes = {'message_count': F('message_count') + 1}
+    if prompt_tokens is not None:
+        changes['context_tokens'] = prompt_tokens
+    if not rows.update(**changes):
+        return None
+    counts = rows.values_list('message_count', 'context_tokens').first()
+    return counts is not None and rotation_due(*counts)
+
+
+def _shorten(text, limit):
+    text = re.sub(r"\s+", " ", text or "").strip()
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+
+# RESUMEN EXTRACTIVO: EL RESUMEN ANTERIOR MÁS LOS ÚLTIMOS MENSAJES (history ES UNA LISTA DE
+# (rol, texto) DEL MÁS ANTIGUO AL MÁS RECIENTE). SI NO CABE EN BOT_THREAD_SUMMARY_CHARS SE
+# DESCARTA LO MÁS ANTIGUO.
+def summarize(previous, history):
+    lines = [previous] if previous else []
+    for role, text in history:
+        speaker = "Tendero" if role == 'user' else "Asistente"
+        lines.append(f"{speaker}: {_shorten(text, settings.BOT_THREAD_SUMMARY_LINE_CHARS)}")
+
+    summary = "\n".join(lines)
+    limit = settings.BOT_THREAD_SUMMARY_CHARS
+    if len(summary) > limit:
+        summary = summary[-limit:].split("\n", 1)[-1]
+    return summary
+
+
+def _product(name, amount):
+    return f"{name} {amount}".strip()
+
+
+def inventory_facts(user):
+    inventario = AuxProdUser.objects.filter(user_aux=user).aggregate(productos=Count('id'), unidades=Sum('quantity'))
+    facts = [f"Productos en inventario: {inventario['productos']} ({inventario['unidades'] or 0} unidades)"]
+
+    poco_inventario = (
+        AuxProdUser.objects.filter(user_aux=user, quantity__lte=settings.BOT_THREAD_LOW_STOCK)
+        .order_by('quantity', 'id')
+        .values_list('product_aux__name', 'product_aux__amount', 'quantity')[:10]
+    )
+    if poco_inventario:
+        facts.append("Con poco inventario: " + ", ".join(
+            f"{_product(name, amount)} ({quantity})" for name, amount, quantity in poco_inventario
+        ))
+
+    # DailySales ya tiene las ventas agregadas por día (ver actualizar_ventas_diarias)
+    desde = timezone.localdate() - timedelta(days=30)
+    mas_vendidos = (
+        DailySales.objects.filter(user_rollup=user, day__gte=desde)
+        .values('product_rollup__name', 'product_rollup__amount')
+        .annotate(unidades=Sum('quantity'))
+        .order_by('-unidades')[:5]
+    )
+    if mas_vendidos:
+        facts.append("Más vendidos en 30 días: " + ", ".join(
+            f"{_product(fila['product_rollup__name'], fila['product_rollup__amount'])} ({fila['unidades']})"
+            for fila in mas_vendidos
+        ))
+    return "\n".join(facts)
+
+
+def prepare_rotation(user, history):
+    previous = Conversation.objects.filter(user_conversation=user).values_list('summary', flat=True).first()
+    return summarize(previous, history), inventory_facts(user)
+
+
+def seed_message(summary, facts):
+    content = (
+        "Contexto guardado de la conversación anterior con este tendero (no requiere respuesta).\n"
+        f"Datos del inventario:\n{facts}"
+    )
+    if summary:
+        content += f"\nResumen de la conversación:\n{summary}"
+    return {'role': 'assistant', 'content': content, 'metadata': SEED_METADATA}
+
+
+# LOS MENSAJES DEL THREAD QUE ENTRAN AL RESUMEN, SIN EL MENSAJE DE CONTEXTO CON EL QUE SE SEMBRÓ
+def history_from_messages(messages):
+    history = []
+    for message in messages:
+        if (message.metadata or {}).get('seed') or not message.content:
+            continue
+        content = message.content[0]
+        if getattr(content, 'text', None) is not None:
+            history.append((message.role, content.text.value))
+    return history
+
+
+# UPDATE CONDICIONAL: SI OTRO WORKER YA ROTÓ ESTE THREAD, SE CONSERVA EL SUYO
+def save_rotation(user, old_thread_id, thread_id, summary, facts):
+    return bool(Conversation.objects.filter(user_conversation=user, thread_id=old_thread_id).update(
+        thread_id=thread_id,
+        message_count=0,
+        context_tokens=0,
+        summary=summary,
+        facts=facts,
+        rotated_at=timezone.now(),
+    ))
+
+
+def current_thread_id(user):
+    return Conversation.objects.filter(user_conversation=user).values_list('thread_id', flat=True).first()
+
+
+# GUARDA EL THREAD QUE REEMPLAZA A UNO QUE YA NO EXISTE EN OPENAI, CON UN UPDATE CONDICIONAL
+# SOBRE EL THREAD VIEJO: SI OTRO WORKER LO REEMPLAZÓ PRIMERO SE CONSERVA EL SUYO. DEVUELVE EL
+# THREAD QUE QUEDÓ GUARDADO.
+def save_replacement(user, stale_thread_id, thread_id):
+    updated = Conversation.objects.filter(user_conversation=user, thread_id=stale_thread_id).update(
+        thread_id=thread_id, message_count=0, context_tokens=0
+    )
+    if updated:
+        return thread_id
+    conversation, _ = Conversation.objects.get_or_create(user_conversation=user, defaults={'thread_id': thread_id})
+    return conversation.thread_id
+
+
+def stored_seed(user):
+    # El contexto guardado, para sembrar un thread que hubo que reemplazar
+    stored = Conversation.objects.filter(user_conversation=user).values_list('summary', 'facts').first()
+    if not stored or not any(stored):
+        return []
+    return [seed_message(*stored)]
@@ -0,0 +1,218 @@
+import asyncio
+import inspect
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager, contextmanager
+
+from django.conf import settings
+
+from . import metrics
+
+# CONTROL DE CARGA HACIA OPENAI, POR PROCESO:
+# - TokenBucket LIMITA LAS LLAMADAS POR SEGUNDO A client.beta.threads.* (ver ThrottledClient).
+# - ConcurrencyLimiter / AsyncConcurrencyLimiter LIMITAN CUÁNTAS CONVERSACIONES CORREN A LA
+#   VEZ, EN TOTAL Y POR USUARIO, ATENDIENDO EN ORDEN DE LLEGADA. SI LA ESPERA ESTIMADA O REAL
+#   SUPERA max_wait SE LANZA Overloaded Y EL BOT RESPONDE BOT_BUSY_REPLY.
+
+
+class Overloaded(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # Toma un token (el saldo puede quedar negativo) y devuelve cuánto hay que esperar por él
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            metrics.incr('openai.throttled')
+            metrics.observe('openai.bucket_wait', wait)
+        return wait
+
+    def take(self):
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def atake(self):
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+# PROXY DE UN CLIENTE DE OPENAI: CADA LLAMADA A UN MÉTODO (client.beta.threads.runs.create,
+# ETC.) TOMA ANTES UN TOKEN DEL BUCKET. CON is_async LAS CORRUTINAS ESPERAN SIN BLOQUEAR EL LOOP.
+class ThrottledClient:
+    def __init__(self, target, bucket, is_async=False):
+        self._target = target
+        self._bucket = bucket
+        self._is_async = is_async
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not (inspect.ismethod(attr) or inspect.isfunction(attr)):
+            return ThrottledClient(attr, self._bucket, self._is_async)
+
+        bucket = self._bucket
+        if not self._is_async:
+            def call(*args, **kwargs):
+                bucket.take()
+                return attr(*args, **kwargs)
+            return call
+
+        def acall(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if not inspect.isawaitable(result):
+                # runs.stream devuelve un administrador de contexto; no se puede esperar aquí
+                bucket.reserve()
+                return result
+
+            async def throttled():
+                await bucket.atake()
+                return await result
+            return throttled()
+        return acall
+
+
+class _LimiterState:
+    def __init__(self, limit, per_user, max_wait, name):
+        self.limit = limit
+        self.per_user = per_user
+        self.max_wait = max_wait
+        self.name = name
+        self._active = 0
+        self._active_by_key = Counter()
+        self._waiting = []
+        self._hold = 0.0
+
+    def _next_eligible(self):
+        # El primero en la fila cuyo usuario no haya llegado a su límite
+        if self._active >= self.limit:
+            return None
+        for ticket, key in self._waiting:
+            if self._active_by_key[key] < self.per_user:
+                return ticket
+        return None
+
+    def _expected_wait(self):
+        # Tandas de conversaciones por delante por la duración promedio de cada una
+        if self._active < self.limit:
+            return 0.0
+        return (len(self._waiting) // self.limit + 1) * self._hold
+
+    def _enqueue(self, key):
+        if self._expected_wait() > self.max_wait:
+            metrics.incr(f"{self.name}.shed")
+            raise Overloaded()
+        ticket = object()
+        self._waiting.append((ticket, key))
+        metrics.gauge(f"{self.name}.queue_depth", len(self._waiting))
+        return ticket
+
+    def _dequeue(self, ticket, key):
+        self._waiting.remove((ticket, key))
+        metrics.gauge(f"{self.name}.queue_depth", len(self._waiting))
+
+    def _start(self, key, queued_at):
+        self._active += 1
+        self._active_by_key[key] += 1
+        metrics.gauge(f"{self.name}.active", self._active)
+        metrics.observe(f"{self.name}.queue_wait", time.monotonic() - queued_at)
+
+    def _finish(self, key, started):
+        self._active -= 1
+        self._active_by_key[key] -= 1
+        if not self._active_by_key[key]:
+            del self._active_by_key[key]
+        # Promedio móvil exponencial de la duración de cada conversación
+        held = time.monotonic() - started
+        self._hold = held if not self._hold else 0.8 * self._hold + 0.2 * held
+        metrics.gauge(f"{self.name}.active", self._active)
+
+
+class ConcurrencyLimiter(_LimiterState):
+    def __init__(self, limit, per_user, max_wait, name='openai'):
+        super().__init__(limit, per_user, max_wait, name)
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, key):
+        queued_at = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(key)
+            try:
+                while self._next_eligible() is not ticket:
+                    remaining = queued_at + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        metrics.incr(f"{self.name}.shed")
+                        raise Overloaded()
+                    self._cond.wait(remaining)
+            finally:
+                self._dequeue(ticket, key)
+                self._cond.notify_all()
+            self._start(key, queued_at)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._finish(key, started)
+                self._cond.notify_all()
+
+
+class AsyncConcurrencyLimiter(_LimiterState):
+    def __init__(self, limit, per_user, max_wait, name='openai'):
+        super().__init__(limit, per_user, max_wait, name)
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def slot(self, key):
+        queued_at = time.monotonic()
+        async with self._cond:
+            ticket = self._enqueue(key)
+            try:
+                while self._next_eligible() is not ticket:
+                    remaining = queued_at + self.max_wait - time.monotonic()
+                    if remaining <= 0:
+                        metrics.incr(f"{self.name}.shed")
+                        raise Overloaded()
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+            finally:
+                self._dequeue(ticket, key)
+                self._cond.notify_all()
+            self._start(key, queued_at)
+
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._finish(key, started)
+                self._cond.notify_all()
+
+
+openai_bucket = TokenBucket(settings.BOT_OPENAI_RATE, settings.BOT_OPENAI_BURST)
+openai_limiter = ConcurrencyLimiter(
+    settings.BOT_OPENAI_CONCURRENCY, settings.BOT_OPENAI_PER_USER, settings.BOT_QUEUE_MAX_WAIT
+)
+async_openai_limiter = AsyncConcurrencyLimiter(
+    settings.BOT_OPENAI_CONCURRENCY, settings.BOT_OPENAI_PER_USER, settings.BOT_QUEUE_MAX_WAIT
+)
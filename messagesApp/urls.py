@@ -1,6 +1,8 @@
+from django.conf import settings
 from django.urls import path
-from .views import reply
+from .views import metrics_view, reply, reply_async
 
 urlpatterns = [
-    path("message/", reply)
+    path("message/", reply_async if settings.BOT_PIPELINE == 'async' else reply),
+    path("metrics/", metrics_view),
 ]
@@ -1,39 +1,28 @@
 import logging
 import traceback
 
-from twilio.rest import Client
-from decouple import config
+from asgiref.sync import sync_to_async
+from django.conf import settings
 
-account_sid = config("TWILIO_ACCOUNT_SID")
-auth_token = config("TWILIO_AUTH_TOKEN")
-client = Client(account_sid, auth_token)
-twilio_number = config('TWILIO_NUMBER')
+from . import outbound
 
-# Set up logging to a file and console
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("twilio_errors.log"),
-        logging.StreamHandler()
-    ]
-)
 logger = logging.getLogger(__name__)
 
+# CON OUTBOUND_ASYNC EL MENSAJE SE ENCOLA Y LO ENTREGA UN HILO EN SEGUNDO PLANO CON
+# REINTENTOS (ver outbound.py); SI NO, SE ENTREGA AQUÍ MISMO.
 def send_message(to_number, body_text):
     try:
-        message = client.messages.create(
-            from_=f"whatsapp:{twilio_number}",
-            body=body_text,
-            to=f"whatsapp:{to_number}"
-        )
-
-        if message is not None:
-            logger.info(f"Message sent to {to_number}: {message.body}")
-        else:
-            logger.error(f"Failed to create message to {to_number}: Twilio API returned None.")
-
+        outbound.send(to_number, body_text)
     except Exception as e:
         # Log the error with traceback details
         error_details = traceback.format_exc()
-        logger.error(f"Error sending message to {to_number}: {e}\nTraceback details:\n{error_details}")
+        logger.error("Error sending message to %s: %s\nTraceback details:\n%s", to_number, e, error_details)
+
+
+async def asend_message(to_number, body_text):
+    if settings.OUTBOUND_ASYNC:
+        # Encolar no bloquea el event loop
+        send_message(to_number, body_text)
+    else:
+        # La entrega es bloqueante; en el pipeline asíncrono se hace desde un hilo aparte
+        await sync_to_async(send_message, thread_sensitive=False)(to_number, body_text)
@@ -1,48 +1,153 @@
-from openai import OpenAI
+import asyncio
 from decouple import config 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-import os
-from dotenv import load_dotenv
-from .botClass import Bot
-from .models import CustomUser
-from .utils import send_message, logger
+from django.db import transaction
+from django.utils import timezone
+from .idempotency import afirst_delivery, first_delivery
+from .jobs import claim_next_jobs, enqueue_message
+from .models import CustomUser, MessageJob
+from . import metrics
 from django.views.decorators.http import require_POST
+from asgiref.sync import sync_to_async
 
 import logging
 import traceback
-import sys
 
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-api_key = os.getenv('OPENAI_API_KEY')
-
-client = OpenAI()
 
+# EL WEBHOOK SOLO ENCOLA EL MENSAJE Y RESPONDE DE INMEDIATO A TWILIO.
+# LA RESPUESTA DEL BOT SE ENVÍA DESDE run_bot_worker.
 @require_POST
 @csrf_exempt
 def reply(request):
-    logger.debug(f"NEW ITER")
+    logger.debug("NEW ITER")
     whatsapp_number = request.POST.get('From').split('whatsapp:')[-1]
-    user, created = CustomUser.objects.get_or_create(phone=str(whatsapp_number))
     body = request.POST.get('Body', '')
-    logger.debug(f"body found: {body}")
-    bot = Bot(user)
-    try:
-        response = bot.run(body)
-        send_message(whatsapp_number, response)
-    except Exception as e:
-        # Get the current function and line number
-        exc_type, exc_obj, exc_tb = sys.exc_info()
-        fname = exc_tb.tb_frame.f_code.co_filename
-        line_number = exc_tb.tb_lineno
+    logger.debug("body found: %s", body)
+    with transaction.atomic():
+        # Si el mensaje ya se había recibido, Twilio solo lo está reenviando
+        if first_delivery(request.POST.get('MessageSid')):
+            enqueue_message(whatsapp_number, body)
 
-        # Log the error with full context
-        logger.error(
-             f"Error in file '{fname}', function '{exc_tb.tb_frame.f_code.co_name}', "
-             f"line {line_number}: {str(e)}\nTraceback:\n{traceback.format_exc()}"
-        )
+    return HttpResponse('')
+
+
+# MÉTRICAS DE ESTE PROCESO Y DE LOS WORKERS (CONTADORES Y LATENCIAS), QUE LAS PUBLICAN EN
+# WorkerMetrics CADA BOT_METRICS_REPORT_INTERVAL SEGUNDOS. REQUIERE EL HEADER X-Metrics-Token.
+def metrics_view(request):
+    # Se importa aquí para que el webhook no cargue botClass
+    from .fastpath import stats
+
+    token = settings.BOT_METRICS_TOKEN
+    if not token or request.headers.get('X-Metrics-Token') != token:
+        return HttpResponse(status=404)
+
+    data = metrics.collect(settings.BOT_METRICS_MAX_AGE)
+    data['fast_path'] = stats(data)
+    data['outbound_queue_depth'] = data['gauges'].get('outbound.queue_depth', 0)
+    return JsonResponse(data)
+
+
+# PIPELINE ASÍNCRONO (BOT_PIPELINE = 'async', DESPLEGADO CON UVICORN SOBRE tiendia.asgi).
+# LA CONVERSACIÓN CORRE COMO UNA TAREA DEL EVENT LOOP Y EL WEBHOOK RESPONDE DE INMEDIATO.
+# LOS MENSAJES SE GUARDAN COMO MessageJob, ASÍ QUE VARIOS WORKERS DE UVICORN COMPARTEN LA
+# COLA; EN MEMORIA SOLO QUEDAN LA TAREA DE CADA NÚMERO Y LA HORA DE SU ÚLTIMO MENSAJE.
+_background_tasks = set()
+_last_arrival = {}
+_conversations = {}
+
+
+async def reply_async(request):
+    # require_POST y csrf_exempt no soportan vistas asíncronas antes de Django 5.0
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    whatsapp_number = request.POST.get('From').split('whatsapp:')[-1]
+    body = request.POST.get('Body', '')
+    logger.debug("body found: %s", body)
+
+    # Si el mensaje ya se había recibido, Twilio solo lo está reenviando
+    if not await afirst_delivery(request.POST.get('MessageSid')):
+        return HttpResponse('')
+
+    await sync_to_async(enqueue_message)(whatsapp_number, body)
+    # Sin await desde aquí: la tarea del número ve este mensaje o todavía no terminó
+    _last_arrival[whatsapp_number] = asyncio.get_running_loop().time()
+    if whatsapp_number not in _conversations:
+        task = asyncio.create_task(drain_messages(whatsapp_number))
+        _conversations[whatsapp_number] = task
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
 
     return HttpResponse('')
 
+reply_async.csrf_exempt = True
+
+
+# UNA SOLA TAREA POR NÚMERO EN CADA PROCESO: ESPERA A QUE EL USUARIO DEJE DE ESCRIBIR
+# (BOT_COALESCE_WINDOW, COMO MÁXIMO BOT_COALESCE_MAX_WAIT), TOMA DE LA BASE TODOS LOS JOBS
+# PENDIENTES DEL NÚMERO, CORRE EL BOT CON ELLOS JUNTOS Y REPITE CON LOS QUE LLEGARON MIENTRAS
+# TANTO. claim_next_jobs NO TOMA UN NÚMERO QUE YA TIENE UN JOB CORRIENDO EN OTRO WORKER: ESE
+# WORKER LOS TOMA AL TERMINAR. ASÍ NUNCA HAY DOS RUNS DEL MISMO THREAD A LA VEZ.
+
+async def drain_messages(whatsapp_number):
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            first = loop.time()
+            while True:
+                delay = min(
+                    _last_arrival[whatsapp_number] + settings.BOT_COALESCE_WINDOW,
+                    first + settings.BOT_COALESCE_MAX_WAIT,
+                ) - loop.time()
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            arrival = _last_arrival[whatsapp_number]
+            jobs = await sync_to_async(claim_next_jobs)(whatsapp_number)
+            if not jobs:
+                # Un mensaje que se guardó mientras se buscaba se revisa en otra vuelta
+                if _last_arrival[whatsapp_number] != arrival:
+                    continue
+                break
+
+            if len(jobs) > 1:
+                metrics.incr('jobs.coalesced', len(jobs) - 1)
+            await handle_message_async(whatsapp_number, "\n".join(job.body for job in jobs))
+            await MessageJob.objects.filter(id__in=[job.id for job in jobs]).aupdate(
+                status=MessageJob.STATUS_DONE, finished_at=timezone.now(),
+            )
+            if metrics.report_if_due(settings.BOT_METRICS_REPORT_INTERVAL):
+                await sync_to_async(metrics.publish)()
+    finally:
+        # Sin await entre la última revisión y este punto: un mensaje nuevo no puede perderse
+        _conversations.pop(whatsapp_number, None)
+        _last_arrival.pop(whatsapp_number, None)
+
+
+async def handle_message_async(whatsapp_number, body):
+    # Se importa aquí para que el pipeline síncrono no cargue AsyncOpenAI
+    from .botClass import AsyncBot
+    from .fastpath import try_fast_path_in_thread
+    from .utils import asend_message
+
+    try:
+        user, created = await CustomUser.objects.aget_or_create(phone=str(whatsapp_number))
+        # Los mensajes comunes se resuelven sin el asistente
+        response = await sync_to_async(try_fast_path_in_thread, thread_sensitive=False)(user, body)
+        bot = None
+        if response is None:
+            bot = await AsyncBot.create(user)
+            response = await bot.run(body)
+        await asend_message(whatsapp_number, response)
+        # Con la respuesta ya enviada, se rota el thread si llegó a su límite
+        if bot is not None:
+            await bot.rotate_if_due()
+    except Exception as e:
+        logger.error(
+            "Error handling message from %s: %s\nTraceback:\n%s", whatsapp_number, str(e), traceback.format_exc()
+        )
@@ -5,6 +5,15 @@ It exposes the ASGI callable as a module-level variable named ``application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.0/howto/deployment/asgi/
+
+For the async webhook pipeline set BOT_PIPELINE=async and run, for example:
+
+    uvicorn tiendia.asgi:application --workers 2
+
+Messages are stored as MessageJob rows and a number is only claimed while no
+other worker is running it, so several workers can share the webhook. Keep one
+``python manage.py run_bot_worker`` running as well: its maintenance loop
+requeues the jobs of a worker that died and purges finished ones.
 """
 
 import os
@@ -88,6 +88,27 @@ DATABASES = {
     }
 }
 
+# Cache 'threads': teléfono -> thread_id de OpenAI. LocMemCache es un LRU en memoria con TTL;
+# para compartirlo entre procesos basta con cambiar el BACKEND (p. ej. Redis).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'threads': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'threads',
+        'TIMEOUT': 24 * 3600,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+    # MessageSid recientes: responde a los reenvíos de Twilio sin consultar la base de datos
+    'webhooks': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'webhooks',
+        'TIMEOUT': 3600,
+        'OPTIONS': {'MAX_ENTRIES': 50000},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -136,22 +157,169 @@ AUTH_USER_MODEL  = "messagesApp.CustomUser"
 
 import os
 
+# Logs de messagesApp: se escriben desde un hilo aparte (messagesApp.logs.BackgroundFileHandler).
+# LOG_DEBUG_SAMPLE_RATE y LOG_INFO_SAMPLE_RATE dejan pasar solo esa fracción de los registros
+# DEBUG e INFO; WARNING y superiores siempre se escriben.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'default': {
+            'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'messagesApp.logs.SamplingFilter',
+            'debug_rate': float(os.getenv('LOG_DEBUG_SAMPLE_RATE', 1.0)),
+            'info_rate': float(os.getenv('LOG_INFO_SAMPLE_RATE', 1.0)),
+        },
+    },
     'handlers': {
         'file_combined': {
-            'class': 'logging.FileHandler',
+            'class': 'messagesApp.logs.BackgroundFileHandler',
             'filename': os.path.join(BASE_DIR, 'messagesApp_combined.log'),
-            'level': 'DEBUG',  # Capture both debug and error logs
+            'formatter': 'default',
+            'filters': ['sampling'],
         },
     },
     'loggers': {
         'messagesApp': {
             'handlers': ['file_combined'],
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'propagate': False,
         },
     },
 }
 
+
+# 'queue': el webhook encola y run_bot_worker procesa (WSGI/gunicorn).
+# 'async': el webhook corre el bot como tarea asyncio (ASGI/uvicorn, ver tiendia/asgi.py).
+BOT_PIPELINE = os.getenv('BOT_PIPELINE', 'queue')
+
+# Cola de mensajes entrantes. El webhook solo encola; los mensajes se procesan con
+# python manage.py run_bot_worker
+BOT_WORKER_CONCURRENCY = int(os.getenv('BOT_WORKER_CONCURRENCY', 4))
+BOT_WORKER_MODE = os.getenv('BOT_WORKER_MODE', 'threads')  # 'threads' o 'processes'
+BOT_WORKER_POLL_INTERVAL = float(os.getenv('BOT_WORKER_POLL_INTERVAL', 0.5))
+BOT_JOB_STALE_SECONDS = int(os.getenv('BOT_JOB_STALE_SECONDS', 300))
+# Un job que falla por un error transitorio (timeout o 5xx de OpenAI, error de conexión a la
+# base de datos) vuelve a la cola tras BOT_JOB_RETRY_BACKOFF * 2^(intento - 1) segundos, hasta
+# BOT_JOB_MAX_ATTEMPTS intentos; al último fallo el usuario recibe BOT_FAILURE_REPLY
+BOT_JOB_MAX_ATTEMPTS = int(os.getenv('BOT_JOB_MAX_ATTEMPTS', 3))
+BOT_JOB_RETRY_BACKOFF = float(os.getenv('BOT_JOB_RETRY_BACKOFF', 5))
+BOT_JOB_RETENTION_SECONDS = int(os.getenv('BOT_JOB_RETENTION_SECONDS', 7 * 24 * 3600))
+# Tiempo que se guarda cada MessageSid recibido para descartar reenvíos del webhook
+WEBHOOK_DEDUP_TTL = int(os.getenv('WEBHOOK_DEDUP_TTL', 24 * 3600))
+# Los mensajes seguidos de un mismo número se combinan en una sola corrida del bot: se espera
+# a que pasen BOT_COALESCE_WINDOW segundos sin mensajes nuevos, pero nunca más de
+# BOT_COALESCE_MAX_WAIT desde el primero
+BOT_COALESCE_WINDOW = float(os.getenv('BOT_COALESCE_WINDOW', 2.0))
+BOT_COALESCE_MAX_WAIT = float(os.getenv('BOT_COALESCE_MAX_WAIT', 10.0))
+
+# Runs del asistente: streaming de eventos cuando el SDK lo soporta; si no, polling con
+# backoff exponencial con jitter (segundos)
+BOT_RUN_STREAMING = os.getenv('BOT_RUN_STREAMING', 'True') == 'True'
+BOT_POLL_INITIAL_DELAY = float(os.getenv('BOT_POLL_INITIAL_DELAY', 0.05))
+BOT_POLL_MAX_DELAY = float(os.getenv('BOT_POLL_MAX_DELAY', 1.0))
+BOT_METRICS_REPORT_INTERVAL = int(os.getenv('BOT_METRICS_REPORT_INTERVAL', 60))
+# Hilos para ejecutar en paralelo las herramientas independientes de un mismo requires_action
+# (1 = en serie). Cada hilo usa su propia conexión a la base de datos.
+BOT_TOOL_WORKERS = int(os.getenv('BOT_TOOL_WORKERS', 4))
+
+# Presupuesto de tiempo por mensaje (polling + herramientas). Al agotarse se cancela el run
+# y el usuario recibe BOT_TIMEOUT_REPLY. Si alguna herramienta ya registró algo, al acabarse
+# el tiempo o fallar el run recibe BOT_TOOLS_DONE_REPLY: pedirle que lo intente de nuevo
+# duplicaría la venta o la compra.
+BOT_RUN_DEADLINE_SECONDS = float(os.getenv('BOT_RUN_DEADLINE_SECONDS', 60))
+BOT_TIMEOUT_REPLY = "Lo siento, tardé demasiado en responder. Por favor intenta de nuevo en unos momentos."
+BOT_TOOLS_DONE_REPLY = (
+    "Ya registré lo que alcancé de tu mensaje, pero no pude terminar de responderte. "
+    "Revisa tu inventario o tus ventas antes de volver a enviarlo para no registrarlo dos veces."
+)
+BOT_FAILURE_REPLY = "Lo siento, no pude procesar tu mensaje. Por favor intenta de nuevo."
+# Intérprete local de mensajes comunes (ventas, compras y reportes) que llama a las
+# herramientas sin pasar por el asistente (ver messagesApp/fastpath.py). El producto debe
+# coincidir al menos BOT_FAST_PATH_MIN_SCORE y superar al segundo candidato por BOT_FAST_PATH_MARGIN,
+# y el mensaje debe contener al menos BOT_FAST_PATH_MIN_COVERAGE de las palabras del producto.
+BOT_FAST_PATH = os.getenv('BOT_FAST_PATH', 'True') == 'True'
+BOT_FAST_PATH_MIN_SCORE = int(os.getenv('BOT_FAST_PATH_MIN_SCORE', 90))
+BOT_FAST_PATH_MARGIN = int(os.getenv('BOT_FAST_PATH_MARGIN', 5))
+BOT_FAST_PATH_MIN_COVERAGE = float(os.getenv('BOT_FAST_PATH_MIN_COVERAGE', 0.5))
+# Rotación de threads: después de BOT_THREAD_MAX_MESSAGES mensajes, o cuando un run lee más de
+# BOT_THREAD_MAX_TOKENS tokens de entrada, se empieza un thread nuevo sembrado con un resumen de
+# los últimos BOT_THREAD_SUMMARY_MESSAGES mensajes y datos del inventario (0 desactiva el límite)
+BOT_THREAD_MAX_MESSAGES = int(os.getenv('BOT_THREAD_MAX_MESSAGES', 40))
+BOT_THREAD_MAX_TOKENS = int(os.getenv('BOT_THREAD_MAX_TOKENS', 24000))
+BOT_THREAD_SUMMARY_MESSAGES = int(os.getenv('BOT_THREAD_SUMMARY_MESSAGES', 10))
+BOT_THREAD_SUMMARY_CHARS = int(os.getenv('BOT_THREAD_SUMMARY_CHARS', 2000))
+BOT_THREAD_SUMMARY_LINE_CHARS = int(os.getenv('BOT_THREAD_SUMMARY_LINE_CHARS', 200))
+BOT_THREAD_LOW_STOCK = int(os.getenv('BOT_THREAD_LOW_STOCK', 3))
+
+# Pool HTTP compartido por los clientes de OpenAI de cada proceso (ver messagesApp/clients.py).
+# OPENAI_BASE_URL permite apuntar a un servidor falso en pruebas (None = la API real).
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', 20))
+OPENAI_MAX_KEEPALIVE = int(os.getenv('OPENAI_MAX_KEEPALIVE', 20))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', 30))
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', 60))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', 5))
+
+# Control de carga hacia OpenAI (por proceso): conversaciones simultáneas en total y por
+# usuario, y llamadas por segundo a la API (token bucket; 0 = sin límite). Si la espera por un
+# cupo sería mayor a BOT_QUEUE_MAX_WAIT segundos se responde BOT_BUSY_REPLY.
+# Con BOT_PIPELINE='queue' cada hilo del worker atiende una sola conversación, así que el tope
+# real es BOT_WORKER_CONCURRENCY y aquí solo actúan el límite por usuario y el token bucket;
+# BOT_OPENAI_CONCURRENCY es el que limita con BOT_PIPELINE='async', donde no hay otro tope. Por
+# defecto valen lo mismo para que ambos pipelines admitan la misma carga; bajarlo por debajo de
+# BOT_WORKER_CONCURRENCY hace que los hilos sobrantes esperen cupo o respondan BOT_BUSY_REPLY.
+BOT_OPENAI_CONCURRENCY = int(os.getenv('BOT_OPENAI_CONCURRENCY', BOT_WORKER_CONCURRENCY))
+BOT_OPENAI_PER_USER = int(os.getenv('BOT_OPENAI_PER_USER', 1))
+BOT_OPENAI_RATE = float(os.getenv('BOT_OPENAI_RATE', 20))
+BOT_OPENAI_BURST = int(os.getenv('BOT_OPENAI_BURST', 40))
+BOT_QUEUE_MAX_WAIT = float(os.getenv('BOT_QUEUE_MAX_WAIT', 15))
+BOT_BUSY_REPLY = "Estamos ocupados en este momento. Por favor intenta de nuevo en unos minutos."
+# Si se define, /metrics/ devuelve las métricas a quien envíe el header X-Metrics-Token. Cada
+# proceso publica las suyas en la tabla WorkerMetrics cada BOT_METRICS_REPORT_INTERVAL segundos;
+# /metrics/ combina las de los procesos que publicaron en los últimos BOT_METRICS_MAX_AGE.
+BOT_METRICS_TOKEN = os.getenv('BOT_METRICS_TOKEN', '')
+BOT_METRICS_MAX_AGE = int(os.getenv('BOT_METRICS_MAX_AGE', 3 * BOT_METRICS_REPORT_INTERVAL))
+
+# Envío de respuestas por la API REST de Twilio (ver messagesApp/outbound.py). Con
+# OUTBOUND_ASYNC los mensajes se encolan y los entregan OUTBOUND_WORKERS hilos en segundo plano.
+TWILIO_API_BASE_URL = os.getenv('TWILIO_API_BASE_URL', 'https://api.twilio.com')
+OUTBOUND_ASYNC = os.getenv('OUTBOUND_ASYNC', 'True') == 'True'
+OUTBOUND_WORKERS = int(os.getenv('OUTBOUND_WORKERS', 2))
+OUTBOUND_POOL_SIZE = int(os.getenv('OUTBOUND_POOL_SIZE', 10))
+OUTBOUND_TIMEOUT = float(os.getenv('OUTBOUND_TIMEOUT', 10))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', 3))
+OUTBOUND_BACKOFF = float(os.getenv('OUTBOUND_BACKOFF', 0.5))
+# Twilio rechaza cuerpos de más de 1600 caracteres; los mensajes largos se parten por líneas
+WHATSAPP_MAX_LENGTH = int(os.getenv('WHATSAPP_MAX_LENGTH', 1600))
+
+# Índices en memoria para el matching difuso de productos, por (usuario, categoría)
+PRODUCT_INDEX_MAX_ENTRIES = int(os.getenv('PRODUCT_INDEX_MAX_ENTRIES', 512))
+PRODUCT_INDEX_TTL = int(os.getenv('PRODUCT_INDEX_TTL', 600))
+# Un item que no aparece en un índice con más de estos segundos lo reconstruye: con cachés
+# locales por proceso, así se ven los productos que otro worker acaba de agregar
+PRODUCT_INDEX_MISS_REFRESH = float(os.getenv('PRODUCT_INDEX_MISS_REFRESH', 5))
+# Hilos de rapidfuzz.process.cdist para el matching por lotes (-1 = todos los núcleos)
+PRODUCT_MATCH_WORKERS = int(os.getenv('PRODUCT_MATCH_WORKERS', -1))
+# Si un producto no coincide en la categoría indicada, buscarlo en todo el inventario
+PRODUCT_MATCH_ANY_CATEGORY = os.getenv('PRODUCT_MATCH_ANY_CATEGORY', 'True') == 'True'
+
+# Búsqueda de productos parecidos en todo el catálogo: 'auto' usa pg_trgm en PostgreSQL si la
+# extensión está instalada y, si no, un índice de n-gramas en memoria. También acepta
+# 'trigram', 'ngram' o la ruta de una clase propia (ver messagesApp/search.py)
+PRODUCT_SEARCH_BACKEND = os.getenv('PRODUCT_SEARCH_BACKEND', 'auto')
+PRODUCT_SEARCH_LIMIT = int(os.getenv('PRODUCT_SEARCH_LIMIT', 20))
+PRODUCT_SEARCH_MIN_SIMILARITY = float(os.getenv('PRODUCT_SEARCH_MIN_SIMILARITY', 0.3))
+PRODUCT_SEARCH_TTL = int(os.getenv('PRODUCT_SEARCH_TTL', 3600))
+# Al cargar inventario, un producto nuevo se asocia a uno existente del catálogo con la misma
+# unidad y nombre y marca similares al menos en este porcentaje (0 lo desactiva)
+PRODUCT_CANONICAL_THRESHOLD = int(os.getenv('PRODUCT_CANONICAL_THRESHOLD', 90))
+
+# Los reportes de ventas leen el resumen diario DailySales (python manage.py rebuild_sales_rollup
+# lo reconstruye a partir de las transacciones)
+SALES_REPORT_USE_ROLLUP = os.getenv('SALES_REPORT_USE_ROLLUP', 'True') == 'True'